@@ -0,0 +1,141 @@
+"""
+Load test of the bot runtime: simulated users send commands through
+the application to a fake Telegram Bot API, each user waiting for the
+reply before sending the next command. Reports the latency (update
+queued to reply received by the API) by number of concurrent users.
+Run from the repository root:
+    python -m benchmarks.bench_bot --docs 2000 --users 1,4,16,64
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from telegram import Update
+import bot
+import db
+import messages
+import storage
+from benchmarks import corpus
+from benchmarks.telegram_stub import TelegramStub, command_update
+
+
+def commands(conn, rng, number):
+    """Random mix of commands answered with one message each"""
+    cur = conn.cursor()
+    cur.execute('SELECT name FROM topic ORDER BY random() LIMIT 50')
+    topics = [row[0] for row in cur.fetchall()]
+    cur.execute('SELECT word FROM word_df ORDER BY docs DESC LIMIT 200')
+    terms = [row[0] for row in cur.fetchall()]
+    templates = (
+        lambda: '/topic ' + rng.choice(topics),
+        lambda: '/words ' + rng.choice(topics),
+        lambda: '/describe_topic ' + rng.choice(topics),
+        lambda: '/new_docs 10',
+        lambda: '/search ' + rng.choice(terms),
+    )
+    return [rng.choice(templates)() for _ in range(number)]
+
+
+async def run_users(application, stub, texts, users, requests):
+    """
+    Closed loop of users sending requests commands each
+    return: latencies in milliseconds, seconds elapsed
+    """
+    loop = asyncio.get_running_loop()
+    waiting = {}
+
+    def on_message(chat_id, text):
+        future = waiting.pop(chat_id, None)
+        if future is not None:
+            loop.call_soon_threadsafe(future.set_result, time.perf_counter())
+
+    stub.on_message = on_message
+    latencies = []
+    update_ids = iter(range(1, 1 << 30))
+
+    async def user(chat_id):
+        for index in range(requests):
+            text = texts[(chat_id * requests + index) % len(texts)]
+            future = loop.create_future()
+            waiting[chat_id] = future
+            update = Update.de_json(
+                command_update(next(update_ids), chat_id, text),
+                application.bot)
+            start = time.perf_counter()
+            await application.update_queue.put(update)
+            latencies.append((await future - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(chat_id) for chat_id in range(users)))
+    return latencies, time.perf_counter() - start
+
+
+async def benchmark(args, texts):
+    results = {}
+    with TelegramStub() as stub:
+        application = bot.build_application(
+            '123:TEST', base_url=stub.base_url)
+        async with application:
+            await application.start()
+            for users in args.users:
+                bot.RESULTS.clear()
+                bot.REPLIES.clear()
+                latencies, seconds = await run_users(
+                    application, stub, texts, users, args.requests)
+                latencies.sort()
+                results[users] = {
+                    'p50_ms': statistics.median(latencies),
+                    'p99_ms': latencies[
+                        max(0, int(len(latencies) * 0.99) - 1)],
+                    'requests_per_s': len(latencies) / seconds,
+                }
+            await application.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--users', default='1,4,16,64',
+                        help='comma-separated numbers of users')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests per user')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the result and reply caches')
+    parser.add_argument('--flood-limits', action='store_true',
+                        help='send within the flood limits of the Bot API, '
+                             'see benchmarks.bench_send')
+    args = parser.parse_args()
+    args.users = [int(item) for item in args.users.split(',')]
+
+    bot.RUNTIME.workers = args.workers
+    if not args.flood_limits:
+        bot.OUTBOX = messages.Outbox(global_rate=None, chat_rate=None)
+    if args.no_cache:
+        bot.RESULTS.maxsize = bot.REPLIES.maxsize = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        with sqlite3.connect(path) as conn:
+            db.load(conn, corpus.records(args.docs), full=True)
+            texts = commands(conn, random.Random(0), 1000)
+        storage.configure(path)
+        results = asyncio.run(benchmark(args, texts))
+        storage.pool.close()
+        bot.RUNTIME.shutdown()
+    print(json.dumps({
+        'docs': args.docs,
+        'workers': args.workers,
+        'cache': not args.no_cache,
+        'flood_limits': args.flood_limits,
+        'users': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Benchmark of page extraction: the legacy path (regex text, a full
+BeautifulSoup tree for the tag names, regex passes over topic pages)
+against the single-pass parse.extract_page, in pages per second.
+Run from the repository root:
+    python -m benchmarks.bench_extract --docs 500
+    python -m benchmarks.bench_extract --fixtures pages/
+    python -m benchmarks.bench_extract --snapshots snapshots/
+Fixtures are saved pages (*.html, *.txt such as the data1.txt dump of
+parse.py) or the last snapshot of every URL of a snapshot store (see
+snapshots.py). Pages listing items with itemprop meta are topic or
+index pages, the others articles. --save writes the pages to a
+directory so that runs can be compared on the same files.
+"""
+import argparse
+import html
+import json
+import os
+import re
+import time
+import parse
+import snapshots
+from benchmarks import corpus
+
+
+HEAD = (
+    '<!DOCTYPE html>\n<html lang="ru"><head><meta charset="utf-8">\n'
+    '<title>{title}</title>\n'
+    '<meta name="Description" content="{description}" />\n'
+    '<meta property="og:title" content="{title}">\n'
+    '<link rel="stylesheet" href="/static/main.css">\n'
+    '<style>.item__category{{color:#999}} p{{margin:0 0 1em}}</style>\n'
+    '<script>window.config = {{"ads": true, "counter": 12345}};</script>\n'
+    '</head><body>\n')
+NAVIGATION = ''.join(
+    '<li class="menu__item"><a href="/rubric/{0}" class="menu__link">'
+    'Рубрика {0}</a></li>\n'.format(index) for index in range(40))
+
+
+def article_html(doc):
+    """Article page of a parse.Doc record, one paragraph per line"""
+    sentences = doc.text.split('. ')
+    paragraphs = ''.join(
+        '<p>{}</p>\n'.format(html.escape('. '.join(sentences[i:i + 4])))
+        for i in range(0, len(sentences), 4))
+    return (
+        HEAD.format(title=html.escape(doc.Heading), description='')
+        + '<header><ul class="menu">' + NAVIGATION + '</ul></header>\n'
+        + '<div class="article" itemscope>\n'
+        + '<meta itemprop="datePublished" content="{}+03:00">\n'.format(
+            doc.LastUpdateTime.isoformat())
+        + '<h1 class="article__header">{}</h1>\n'.format(
+            html.escape(doc.Heading))
+        + '<div class="article__text">\n' + paragraphs + '</div>\n'
+        + '<div class="article__tags"><a href="/tags/1">Тег</a></div>\n'
+        + '</div>\n<footer><ul>' + NAVIGATION + '</ul></footer>\n'
+        + '<script src="/static/main.js"></script>\n</body></html>\n')
+
+
+def topic_html(topic):
+    """Topic page of a parse.Topic record"""
+    items = ''.join(
+        '<div class="item"><meta itemprop="url" content="{}">\n'
+        '<meta itemprop="name" content="{}">\n'
+        '<a href="{}" class="item__link">{}</a>\n'
+        '<span class="item__category">{} мая, 1{}:2{}</span></div>\n'.format(
+            url, name, url, name, 1 + index % 27, index % 10, index % 10)
+        for index, (url, name) in enumerate(
+            zip(topic.article_urls, topic.articles.split('\n'))))
+    return (
+        HEAD.format(title=topic.name, description=topic.description)
+        + '<header><ul class="menu">' + NAVIGATION + '</ul></header>\n'
+        + items + '</body></html>\n')
+
+
+def synthetic_pages(number_of_docs, seed=0):
+    """Topic and article pages of a synthetic corpus"""
+    pages = []
+    for record in corpus.records(number_of_docs, seed=seed):
+        if isinstance(record, parse.Topic):
+            pages.append(topic_html(record))
+        else:
+            pages.append(article_html(record))
+    return pages
+
+
+def is_listing(page):
+    """Whether the page is an index or topic page"""
+    return '<meta itemprop="url"' in page
+
+
+def legacy_topic(site):
+    """Regex extraction of topic pages before extract_page"""
+    descript = re.findall(
+        r'<meta name="Description" content="(.*)" />', site)
+    articles_url = re.findall(
+        r'<meta itemprop="url" content="(.*)">', site)
+    articles_name = re.findall(
+        r'<meta itemprop="name" content="(.*)">', site)
+    articles_update_time = [
+        parse.convert_to_time(item) for item in re.findall(
+            r'<span class="item__category">(.*)</span>', site)]
+    return descript[:1], articles_url, articles_name, articles_update_time
+
+
+def legacy(page):
+    if is_listing(page):
+        return legacy_topic(page)
+    return parse.get_text(page), parse.get_tags(page)
+
+
+def single_pass(page):
+    if is_listing(page):
+        return parse.parse_topic_page(page)
+    return parse.extract_page(page)
+
+
+def measure(function, pages, repeat):
+    """Best pages per second of function over repeat rounds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            function(page)
+        best = min(best, time.perf_counter() - start)
+    return len(pages) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=500,
+                        help='articles of the synthetic corpus')
+    parser.add_argument('--fixtures', help='directory of saved pages')
+    parser.add_argument('--snapshots', help='directory of a snapshot store')
+    parser.add_argument('--save', help='write the synthetic pages here')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        pages = []
+        for name in sorted(os.listdir(args.fixtures)):
+            if name.endswith(('.html', '.txt')):
+                with open(os.path.join(args.fixtures, name),
+                          encoding='utf-8') as file:
+                    pages.append(file.read())
+    elif args.snapshots:
+        with snapshots.SnapshotStore(args.snapshots) as store:
+            pages = [store.latest(url).decode('utf-8')
+                     for url in store.urls()]
+    else:
+        pages = synthetic_pages(args.docs)
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for index, page in enumerate(pages):
+            with open(os.path.join(args.save, '{:06d}.html'.format(index)),
+                      'w', encoding='utf-8') as file:
+                file.write(page)
+
+    before = measure(legacy, pages, args.repeat)
+    after = measure(single_pass, pages, args.repeat)
+    print(json.dumps({
+        'pages': len(pages),
+        'listing_pages': sum(map(is_listing, pages)),
+        'megabytes': sum(map(len, pages)) / 1e6,
+        'before_pages_per_s': before,
+        'after_pages_per_s': after,
+        'speedup': after / before,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
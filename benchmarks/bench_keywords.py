@@ -0,0 +1,110 @@
+"""
+Compare the latency of /words implementations on a synthetic corpus:
+    legacy  - re-tokenize every document of the topic per request
+              (select_words_best_describe before the topic aggregates)
+    counts  - most frequent words from the topic_word aggregates
+    tfidf   - precomputed keywords of keywords.refresh
+Run from the repository root:
+    python -m benchmarks.bench_keywords --docs 5000
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+import bot
+import db
+import keywords
+from benchmarks import corpus
+
+
+def legacy_words(conn, topic_name, number_of_words):
+    """select_words_best_describe as it was before the aggregates"""
+    cur = conn.cursor()
+    cur.execute('SELECT articles FROM topic WHERE name = ?', (topic_name,))
+    list_of_docs = cur.fetchall()[0][0].split('\n')
+    dic = defaultdict(int)
+    for item in list_of_docs:
+        cur.execute('SELECT text FROM doc WHERE Heading = ?', (item,))
+        text = re.split(r', | ', cur.fetchall()[0][0])
+        for word in text:
+            word = ''.join(ch for ch in word if ch.isalnum())
+            if len(word) <= 3:
+                continue
+            dic[word] += 1
+    dic = sorted(dic.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+    return [word for word, _ in dic[:number_of_words]]
+
+
+def count_words(conn, topic_name, number_of_words):
+    """Most frequent words longer than 3 letters from topic_word"""
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT word FROM topic_word
+        WHERE topic_id = ? AND length(word) > 3
+        ORDER BY count DESC, word DESC
+        LIMIT ?''', (bot.select_topic_id.__wrapped__(conn, topic_name),
+                     number_of_words))
+    return [row[0] for row in cur.fetchall()]
+
+
+def timed(function, conn, names, repeat):
+    """Latencies in milliseconds of function over names"""
+    latencies = []
+    for _ in range(repeat):
+        for name in names:
+            start = time.perf_counter()
+            function(conn, name, 5)
+            latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        'p50_ms': statistics.median(latencies),
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1],
+        'mean_ms': statistics.fmean(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--topics', type=int, default=50,
+                        help='topics queried')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        db.load(conn, corpus.records(args.docs), full=True)
+        cur = conn.cursor()
+        cur.execute('SELECT name FROM topic ORDER BY id LIMIT ?',
+                    (args.topics,))
+        names = [row[0] for row in cur.fetchall()]
+
+        cur.execute('BEGIN')
+        start = time.perf_counter()
+        keywords.refresh(cur)
+        refresh_seconds = time.perf_counter() - start
+        conn.commit()
+
+        result = {
+            'docs': args.docs,
+            'refresh_s': refresh_seconds,
+            'legacy': timed(legacy_words, conn, names, args.repeat),
+            'counts': timed(count_words, conn, names, args.repeat),
+            'tfidf': timed(bot.select_words_best_describe.__wrapped__,
+                           conn, names, args.repeat),
+            'example': {
+                'legacy': legacy_words(conn, names[0], 5),
+                'tfidf': bot.select_words_best_describe(conn, names[0], 5),
+            },
+        }
+        conn.close()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
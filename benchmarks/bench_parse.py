@@ -0,0 +1,103 @@
+"""
+Scaling of the parsing stage: the crawl pipeline is replayed from a
+snapshot store (no network) with 1..N processes extracting and
+normalizing the pages, see parse.records. Reports records per second
+by number of processes and checks that every run gives the same
+records. Run from the repository root:
+    python -m benchmarks.bench_parse --docs 2000 --workers 1,2,4
+    python -m benchmarks.bench_parse --snapshots snapshots/ \\
+        --url https://www.rbc.ru/story/
+Without --snapshots, a synthetic rbc-like site (see bench_extract) is
+written to a temporary store first.
+"""
+import argparse
+import html
+import json
+import os
+import tempfile
+import time
+import parse
+import snapshots
+from benchmarks import corpus
+from benchmarks.bench_extract import HEAD, article_html, topic_html
+
+
+INDEX = 'https://example.org/story/'
+
+
+def write_site(store, number_of_docs):
+    """
+    Store the pages of a synthetic site
+    return: URL of its story index, see sources.resolve
+    """
+    topics = []
+    for record in corpus.records(number_of_docs):
+        if isinstance(record, parse.Topic):
+            topics.append(record)
+            store.put(record.url, topic_html(record).encode('utf-8'))
+        else:
+            store.put(record.url, article_html(record).encode('utf-8'))
+    index = HEAD.format(title='Сюжеты', description='') + ''.join(
+        '<meta itemprop="url" content="{}">\n'
+        '<meta itemprop="name" content="{}">\n'.format(
+            topic.url, html.escape(topic.name))
+        for topic in topics) + '</body></html>\n'
+    store.put(INDEX, index.encode('utf-8'))
+    return 'rbc=' + INDEX
+
+
+def run(store, urls, workers):
+    """
+    Replay the crawl
+    return: list of records, seconds
+    """
+    start = time.perf_counter()
+    records = list(parse.records(
+        urls, snapshots.ReplayFetcher(store), workers=workers))
+    return records, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=2000,
+                        help='articles of the synthetic site')
+    parser.add_argument('--snapshots', help='directory of a snapshot store')
+    parser.add_argument('--url', action='append',
+                        help='story index in --snapshots, may be repeated')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='comma-separated numbers of processes')
+    args = parser.parse_args()
+    if args.snapshots and not args.url:
+        parser.error('--snapshots needs --url')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.snapshots:
+            store = snapshots.SnapshotStore(args.snapshots)
+            urls = args.url
+        else:
+            store = snapshots.SnapshotStore(os.path.join(tmp, 'snapshots'))
+            urls = [write_site(store, args.docs)]
+        # Warm up the page cache of the store
+        expected, _ = run(store, urls, 1)
+        results = {}
+        for workers in map(int, args.workers.split(',')):
+            records, seconds = run(store, urls, workers)
+            results[workers] = {
+                'seconds': seconds,
+                'records_per_s': len(records) / seconds,
+                'same_records': records == expected,
+            }
+        for item in results.values():
+            item['speedup'] = (item['records_per_s']
+                               / results[min(results)]['records_per_s'])
+        store.close()
+    print(json.dumps({
+        'records': len(expected),
+        'cpus': os.cpu_count(),
+        'chunk_size': parse.CHUNK_SIZE,
+        'workers': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
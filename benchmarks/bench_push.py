@@ -0,0 +1,209 @@
+"""
+Benchmark of the push notifications: chats subscribe to topics of a
+synthetic corpus, an incremental load adds documents to some of these
+topics, and notify.Notifier pushes them to a fake Telegram Bot API
+answering after a round-trip delay. Reports the subscribe latency, the
+load with its notification diff, and for every concurrency the
+seconds, messages per second and latency (push started to message
+received by the API) of the fan-out. Run from the repository root:
+    python -m benchmarks.bench_push --chats 5000 --concurrency 1,32,128
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from telegram import Bot
+from telegram.request import HTTPXRequest
+import db
+import messages
+import notify
+import parse
+from benchmarks import corpus
+from benchmarks.telegram_stub import TelegramStub
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, int(len(values) * q) - 1)] if values else None
+
+
+def subscribe(path, chats, topics_per_chat, rng):
+    """
+    Subscribe every chat to random topics
+    return: latencies of notify.subscribe in milliseconds
+    """
+    with sqlite3.connect(path) as conn:
+        urls = [row[0] for row in conn.execute('SELECT url FROM topic')]
+    latencies = []
+    conn = notify.connect(path)
+    try:
+        for chat_id in range(1, chats + 1):
+            for url in rng.sample(urls, min(topics_per_chat, len(urls))):
+                start = time.perf_counter()
+                notify.subscribe(conn, chat_id, url)
+                latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        conn.close()
+    return latencies
+
+
+def new_records(conn, topics, docs_per_topic, rng):
+    """
+    Records of an incremental load adding documents to random
+    subscribed topics
+    yield: parse.Doc and parse.Topic records
+    """
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT id, name, url, description, LastUpdateTime FROM topic
+        WHERE url IN (SELECT topic_url FROM subscription)''')
+    rows = cur.fetchall()
+    now = datetime.fromisoformat(max(row[4] for row in rows)) + \
+        timedelta(hours=1)
+    for number, (topic_id, name, url, description, updated) in enumerate(
+            rng.sample(rows, min(topics, len(rows)))):
+        cur.execute('''
+            SELECT doc_url FROM topic_doc WHERE topic_id = ?
+            ORDER BY position''', (topic_id,))
+        listed = [row[0] for row in cur.fetchall()]
+        added = []
+        for index in range(docs_per_topic):
+            doc_url = 'https://example.org/new/{}/{}'.format(number, index)
+            body = 'Новость {} {} {}.'.format(number, index, ' '.join(
+                rng.choice(('рост', 'рынок', 'выборы', 'погода', 'спорт'))
+                for _ in range(50)))
+            yield parse.Doc(
+                doc_url, 'Новость {} в теме {}'.format(index, name), now,
+                body, '["p"]', parse.word_counts(body))
+            added.append(doc_url)
+        yield parse.Topic(
+            name, url, description,
+            '\n'.join(['Новость'] * len(added + listed)), now,
+            tuple(added + listed))
+
+
+async def fan_out(path, concurrency, rtt, blocked, flood_limits):
+    """
+    Push the queued notifications once
+    return: dict of results
+    """
+    loop = asyncio.get_running_loop()
+    received = {}
+
+    def on_message(chat_id, text):
+        received[chat_id] = time.perf_counter()
+
+    if flood_limits:
+        outbox = messages.Outbox()
+    else:
+        outbox = messages.Outbox(global_rate=None, chat_rate=None)
+    notifier = notify.Notifier(path, outbox, concurrency=concurrency)
+    with TelegramStub(on_message, delay=rtt, blocked=blocked) as stub:
+        request = HTTPXRequest(connection_pool_size=concurrency + 1)
+        async with Bot('123:TEST', base_url=stub.base_url,
+                       request=request) as bot:
+            start = time.perf_counter()
+            replies = await loop.run_in_executor(None, notifier.collect)
+            collected = time.perf_counter()
+            result = await notifier.push(bot, replies)
+            seconds = time.perf_counter() - start
+    latencies = [(value - start) * 1000 for value in received.values()]
+    return {
+        'chats': result['chats'],
+        'messages': result['messages'],
+        'blocked': result['blocked'],
+        'failed': result['failed'],
+        'collect_ms': (collected - start) * 1000,
+        'seconds': seconds,
+        'messages_per_s': len(stub.messages) / seconds,
+        'p50_ms': statistics.median(latencies) if latencies else None,
+        'p99_ms': percentile(latencies, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--topics-per-chat', type=int, default=3)
+    parser.add_argument('--updated-topics', type=int, default=100,
+                        help='topics receiving new documents')
+    parser.add_argument('--new-docs', type=int, default=2,
+                        help='new documents per updated topic')
+    parser.add_argument('--concurrency', default='1,8,32,128',
+                        help='comma-separated chats pushed to at once')
+    parser.add_argument('--rtt', type=float, default=0.05,
+                        help='round trip to the Bot API in seconds')
+    parser.add_argument('--blocked', type=float, default=0.01,
+                        help='fraction of the chats that blocked the bot')
+    parser.add_argument('--flood-limits', action='store_true',
+                        help='send within the flood limits of the Bot API, '
+                             'see benchmarks.bench_send')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        with sqlite3.connect(path) as conn:
+            db.load(conn, corpus.records(args.docs), full=True)
+        latencies = subscribe(path, args.chats, args.topics_per_chat, rng)
+
+        with sqlite3.connect(path) as conn:
+            records = list(new_records(
+                conn, args.updated_topics, args.new_docs, rng))
+            start = time.perf_counter()
+            db.load(conn, records, full=False)
+            load_seconds = time.perf_counter() - start
+            queued = conn.execute(
+                'SELECT id, topic_url, doc_url FROM notification').fetchall()
+            subscriptions = conn.execute(
+                'SELECT topic_url, chat_id FROM subscription').fetchall()
+        blocked = set(rng.sample(range(1, args.chats + 1),
+                                 int(args.chats * args.blocked)))
+
+        results = {}
+        for concurrency in (int(item)
+                            for item in args.concurrency.split(',')):
+            # Every run pushes the same notifications to the same chats
+            with sqlite3.connect(path) as conn:
+                conn.execute('DELETE FROM notification')
+                conn.execute('DELETE FROM subscription')
+                conn.executemany('''
+                    INSERT INTO notification (id, topic_url, doc_url)
+                    VALUES (?, ?, ?)''', queued)
+                conn.executemany('''
+                    INSERT INTO subscription (topic_url, chat_id)
+                    VALUES (?, ?)''', subscriptions)
+            results[concurrency] = asyncio.run(fan_out(
+                path, concurrency, args.rtt, blocked, args.flood_limits))
+        with sqlite3.connect(path) as conn:
+            left = conn.execute(
+                'SELECT COUNT(*) FROM subscription').fetchone()[0]
+
+    print(json.dumps({
+        'docs': args.docs,
+        'chats': args.chats,
+        'subscriptions': len(subscriptions),
+        'subscribe_p50_ms': statistics.median(latencies),
+        'load': {
+            'records': len(records),
+            'seconds': load_seconds,
+            'notifications': len(queued),
+        },
+        'rtt_ms': args.rtt * 1000,
+        'flood_limits': args.flood_limits,
+        'blocked_chats': len(blocked),
+        'subscriptions_removed': len(subscriptions) - left,
+        'concurrency': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark of the delivery of chunked replies: chats receive replies of
+several messages from a fake bot with a round-trip latency and the
+flood limits of the Bot API, failing sends over the limits with
+RetryAfter. Compares awaiting every message in turn, as handlers did
+before messages.Outbox, with the outbox. Reports seconds, messages
+delivered and flood errors. Run from the repository root:
+    python -m benchmarks.bench_send --chats 20 --chunks 5 --rtt 0.1
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+from telegram.error import RetryAfter
+import messages
+
+
+class FloodBot:
+    """
+    Stand-in for telegram.Bot answering send_message after rtt seconds,
+    or raising RetryAfter over the limits of messages.Outbox defaults
+    """
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.chats = {}
+        self.total = messages.TokenBucket(messages.GLOBAL_RATE,
+                                          messages.GLOBAL_RATE)
+        self.delivered = []
+        self.floods = 0
+
+    def check(self, bucket):
+        bucket.refill()
+        if bucket.tokens < 1:
+            self.floods += 1
+            raise RetryAfter(math.ceil((1 - bucket.tokens) / bucket.rate))
+        bucket.tokens -= 1
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.rtt / 2)
+        chat = self.chats.setdefault(chat_id, messages.TokenBucket(
+            messages.CHAT_RATE, messages.CHAT_BURST))
+        self.check(chat)
+        self.check(self.total)
+        self.delivered.append((chat_id, text))
+        await asyncio.sleep(self.rtt / 2)
+
+
+async def sequential(bot, chat_id, texts):
+    for text in texts:
+        try:
+            await bot.send_message(chat_id, text)
+        except RetryAfter:
+            pass
+
+
+async def run(send, chats, chunks, rtt):
+    bot = FloodBot(rtt)
+    replies = {chat_id: ['{} {}'.format(chat_id, index)
+                         for index in range(chunks)]
+               for chat_id in range(chats)}
+    start = time.perf_counter()
+    await asyncio.gather(*(send(bot, chat_id, texts)
+                           for chat_id, texts in replies.items()))
+    seconds = time.perf_counter() - start
+    in_order = all(
+        [text for chat, text in bot.delivered if chat == chat_id] == texts
+        for chat_id, texts in replies.items())
+    return {
+        'seconds': seconds,
+        'delivered': len(bot.delivered),
+        'flood_errors': bot.floods,
+        'in_order': in_order,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--chunks', type=int, default=5,
+                        help='messages per reply')
+    parser.add_argument('--rtt', type=float, default=0.1,
+                        help='round trip to the Bot API in seconds')
+    args = parser.parse_args()
+
+    outbox = messages.Outbox()
+    print(json.dumps({
+        'messages': args.chats * args.chunks,
+        'sequential': asyncio.run(
+            run(sequential, args.chats, args.chunks, args.rtt)),
+        'outbox': asyncio.run(
+            run(outbox.send, args.chats, args.chunks, args.rtt)),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Load test of the webhook mode: recorded update JSON is POSTed to the
+webhook server, running with several worker processes, whose replies
+go to a fake Telegram Bot API. Each chat waits for the reply before
+posting its next update. Reports the latency (POST sent to reply
+received by the API) by number of workers and of concurrent chats.
+Run from the repository root:
+    python -m benchmarks.bench_webhook --workers 1,2,4 --users 16,64
+Updates may come from a JSONL file of Update objects as the Bot API
+sends them (--updates), grouped by chat; otherwise they are generated
+from a synthetic corpus.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+import bot
+import db
+import storage
+import webhook
+from benchmarks import corpus
+from benchmarks.bench_bot import commands
+from benchmarks.telegram_stub import TelegramStub, command_update
+
+
+def free_port():
+    """A port nobody listens on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(port, timeout=30.0):
+    """Wait until the server accepts connections"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_stub(port, messages):
+    """Telegram stub process, reporting the chat of every message"""
+    stub = TelegramStub(
+        lambda chat_id, text: messages.put(chat_id), port=port)
+    with stub:
+        threading.Event().wait()
+
+
+def post_chats(port, chats, replies):
+    """
+    Post the updates of every chat from its own thread and connection
+    :param chats: dict chat id -> list of update JSON
+    :param replies: dict chat id -> threading.Event set by the stub
+    return: latencies in milliseconds, seconds elapsed
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def chat(chat_id, updates):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        for update in updates:
+            replies[chat_id].clear()
+            body = json.dumps(update).encode('utf-8')
+            start = time.perf_counter()
+            conn.request('POST', webhook.PATH, body,
+                         {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+            if replies[chat_id].wait(30):
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1000)
+        conn.close()
+
+    threads = [threading.Thread(target=chat, args=item)
+               for item in chats.items()]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--workers', default='1,2,4',
+                        help='comma-separated numbers of processes')
+    parser.add_argument('--users', default='16,64',
+                        help='comma-separated numbers of chats')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='updates per chat')
+    parser.add_argument('--updates', help='JSONL file of updates')
+    args = parser.parse_args()
+
+    results = {}
+    replies = defaultdict(threading.Event)
+    context = multiprocessing.get_context('fork')
+    # The stub runs in its own process so that it keeps up with the
+    # workers, the chats of its messages come back through a queue
+    messages = context.SimpleQueue()
+    stub_port = free_port()
+    stub = context.Process(
+        target=run_stub, args=(stub_port, messages), daemon=True)
+    stub.start()
+
+    def dispatch():
+        while True:
+            replies[messages.get()].set()
+
+    threading.Thread(target=dispatch, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        with sqlite3.connect(path) as conn:
+            db.load(conn, corpus.records(args.docs), full=True)
+            texts = commands(conn, random.Random(0), 1000)
+        storage.configure(path)
+        recorded = None
+        if args.updates:
+            recorded = defaultdict(list)
+            with open(args.updates) as file:
+                for line in file:
+                    update = json.loads(line)
+                    recorded[update['message']['chat']['id']].append(update)
+
+        build = partial(bot.build_application, '123:TEST',
+                        base_url='http://127.0.0.1:{}/bot'.format(stub_port))
+        for workers in map(int, args.workers.split(',')):
+            port = free_port()
+            server = context.Process(
+                target=webhook.run,
+                args=(build, '127.0.0.1', port, workers))
+            server.start()
+            wait_listening(port)
+            # Warm up the caches and connections of the workers
+            post_chats(port, {
+                chat_id: [command_update(0, chat_id, text)]
+                for chat_id, text in enumerate(texts[:64], start=1)},
+                replies)
+            results[workers] = {}
+            for users in map(int, args.users.split(',')):
+                chats = recorded or {
+                    chat_id: [
+                        command_update(
+                            chat_id * args.requests + index, chat_id,
+                            texts[(chat_id * args.requests + index)
+                                  % len(texts)])
+                        for index in range(args.requests)]
+                    for chat_id in range(1, users + 1)}
+                latencies, seconds = post_chats(port, chats, replies)
+                latencies.sort()
+                results[workers][len(chats)] = {
+                    'p50_ms': statistics.median(latencies),
+                    'p99_ms': latencies[
+                        max(0, int(len(latencies) * 0.99) - 1)],
+                    'requests_per_s': len(latencies) / seconds,
+                    'lost': sum(map(len, chats.values())) - len(latencies),
+                }
+            server.terminate()
+            server.join()
+    stub.terminate()
+    print(json.dumps({'docs': args.docs, 'workers': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+import parse
+
+
+SYLLABLES = (
+    'ба', 'ва', 'го', 'да', 'ен', 'жи', 'за', 'ки', 'ла', 'ми', 'но', 'пра',
+    'ро', 'ст', 'та', 'ун', 'фе', 'хо', 'це', 'чи', 'ше', 'щи', 'ыв', 'эк',
+    'юр', 'ял', 'ств', 'ние', 'ова', 'ски', 'тель', 'вед', 'мир', 'гос')
+ENDINGS = ('', 'а', 'ы', 'ой', 'ом', 'ах', 'ов', 'ие', 'ия', 'ый')
+FUNCTION_WORDS = ('и', 'в', 'на', 'с', 'по', 'что', 'не', 'это', 'также',
+                  'для', 'от', 'к', 'из', 'как', 'о', 'за', 'который')
+
+
+def vocabulary(size, rng):
+    """
+    Generate Russian-like words from syllables
+    :param size: number of distinct stems
+    :param rng: random.Random instance
+    return: list of words, most frequent first
+    """
+    stems = set()
+    while len(stems) < size:
+        stems.add(''.join(
+            rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return list(FUNCTION_WORDS) + sorted(stems)
+
+
+def text(words, cum_weights, number_of_words, rng):
+    """
+    Generate the text of an article: Zipf-distributed words,
+    sentences of 8-20 words joined with commas and dots
+    :param cum_weights: cumulative weights of the words, computed once
+                        rather than for every article
+    """
+    tokens = rng.choices(words, cum_weights=cum_weights, k=number_of_words)
+    tokens = [token if token in FUNCTION_WORDS
+              else token + rng.choice(ENDINGS) for token in tokens]
+    sentences = []
+    while tokens:
+        size = rng.randint(8, 20)
+        sentence = ', '.join(
+            ' '.join(tokens[i:i + 5]) for i in range(0, size, 5))
+        sentences.append(sentence[:1].upper() + sentence[1:] + '.')
+        tokens = tokens[size:]
+    return ' '.join(sentences)
+
+
+def records(number_of_docs, docs_per_topic=20, words_per_doc=300,
+            vocabulary_size=20000, seed=0):
+    """
+    Generate a synthetic corpus as parse.Topic and parse.Doc records.
+    Documents are shared by topics like rbc.ru stories; every topic
+    lists docs_per_topic documents, newest first.
+    :param number_of_docs: number of documents
+    :param docs_per_topic: number of documents listed by each topic
+    :param words_per_doc: average number of words of a document
+    :param vocabulary_size: number of distinct stems
+    :param seed: random seed, the corpus is reproducible
+    yield: parse.Topic and parse.Doc records
+    """
+    rng = random.Random(seed)
+    words = vocabulary(vocabulary_size, rng)
+    cum_weights = list(accumulate(
+        1.0 / rank for rank in range(1, len(words) + 1)))
+    start = datetime(2021, 5, 1)
+
+    def doc_url(index):
+        return 'https://example.org/doc/{}'.format(index)
+
+    number_of_topics = max(1, number_of_docs // docs_per_topic * 2)
+    for index in range(number_of_topics):
+        first = rng.randrange(max(1, number_of_docs - docs_per_topic))
+        listed = sorted(range(first, min(number_of_docs,
+                                         first + docs_per_topic)),
+                        reverse=True)
+        name = 'Тема {} {}'.format(index, rng.choice(words[-1000:]))
+        yield parse.Topic(
+            name, 'https://example.org/story/{}'.format(index),
+            'Описание темы {}'.format(name),
+            '\n'.join('Статья {}'.format(item) for item in listed),
+            start + timedelta(minutes=listed[0] if listed else 0),
+            tuple(doc_url(item) for item in listed))
+
+    for index in range(number_of_docs):
+        body = text(words, cum_weights,
+                    rng.randint(words_per_doc // 2, words_per_doc * 3 // 2),
+                    rng)
+        yield parse.Doc(
+            doc_url(index), 'Статья {}'.format(index),
+            start + timedelta(minutes=index), body, '["p", "div"]',
+            parse.word_counts(body))
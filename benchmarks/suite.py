@@ -0,0 +1,392 @@
+"""
+Benchmark suite: ingest throughput, page extraction and every command
+handler on synthetic corpora of several sizes, with machine-readable
+results to compare runs and draw scaling curves. Run from the
+repository root:
+    python -m benchmarks.suite --docs 1000,10000 --output run.json
+    python -m benchmarks.suite --docs 100000,1000000 --workdir bench/
+    python -m benchmarks.suite --docs 1000 --compare run.json
+Scenarios, per corpus size:
+    ingest_full        - full load of the corpus (benchmarks.corpus)
+    ingest_incremental - incremental load changing 1% of the documents
+    parse              - parse.extract_page over offline HTML fixtures
+                         of the corpus (see bench_extract)
+    command            - each handler of bot.py called directly with a
+                         fake update and context, cold (caches emptied
+                         before every call) and warm
+With --workdir, corpora and fixtures are kept there and reused by the
+next runs, ingest_full then reports the load that built them.
+Results are one JSON object: "meta" (commit, python, cpus, date) and
+"results", a list of flat records {scenario, docs, ...metrics}.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+import bot
+import db
+import messages
+import parse
+import storage
+from benchmarks import corpus
+from benchmarks.bench_extract import single_pass, synthetic_pages
+
+
+# Handlers of bot.py and the arguments they are called with, from the
+# pools of names of the corpus
+COMMANDS = (
+    ('new_docs', bot.new_docs, lambda pools, rng: ['10']),
+    ('new_topics', bot.new_topics, lambda pools, rng: ['10']),
+    ('topic', bot.topic, lambda pools, rng: [rng.choice(pools['topics'])]),
+    ('doc', bot.doc, lambda pools, rng: [rng.choice(pools['docs'])]),
+    ('words', bot.words, lambda pools, rng: [rng.choice(pools['topics'])]),
+    ('describe_doc', bot.describe_doc,
+     lambda pools, rng: [rng.choice(pools['docs'])]),
+    ('describe_topic', bot.describe_topic,
+     lambda pools, rng: [rng.choice(pools['topics'])]),
+    ('search', bot.search_command,
+     lambda pools, rng: [rng.choice(pools['terms'])]),
+    ('trending', bot.trending_command,
+     lambda pools, rng: [rng.choice(['6h', '24h', '7d'])]),
+)
+
+
+class FakeBot:
+    """Stand-in for telegram.Bot keeping the messages sent"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+
+    async def reply_text(self, text):
+        await self.bot.send_message(self.chat_id, text)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeUpdate:
+    """
+    Stand-in for telegram.Update of a user sending a command in a
+    private chat, with the attributes the handlers read
+    """
+
+    def __init__(self, bot, chat_id):
+        self.effective_chat = FakeUser(chat_id)
+        self.effective_user = FakeUser(chat_id)
+        self.message = FakeMessage(bot, chat_id)
+
+
+class FakeContext:
+    """Stand-in for telegram.ext.CallbackContext"""
+
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+
+
+def summary(latencies):
+    """Latency statistics in milliseconds of a list of seconds"""
+    latencies = sorted(seconds * 1000 for seconds in latencies)
+    return {
+        'calls': len(latencies),
+        'p50_ms': statistics.median(latencies),
+        'p99_ms': latencies[max(0, int(len(latencies) * 0.99) - 1)],
+        'mean_ms': statistics.fmean(latencies),
+    }
+
+
+def load_seconds(mode):
+    """Seconds of the loads written so far, see db.LOAD_SECONDS"""
+    stats = db.LOAD_SECONDS.summary(mode)
+    return stats['sum'] if stats else 0.0
+
+
+def load(path, records, full):
+    """
+    Load records into the database at path
+    return: dict of rows, wall seconds (records generated included)
+            and write seconds
+    """
+    mode = 'full' if full else 'incremental'
+    written = load_seconds(mode)
+    start = time.perf_counter()
+    with sqlite3.connect(path) as conn:
+        rows = db.load(conn, records, full=full)
+    conn.close()
+    seconds = time.perf_counter() - start
+    write_seconds = load_seconds(mode) - written
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'write_seconds': write_seconds,
+        'rows_per_s': rows / write_seconds if write_seconds else None,
+    }
+
+
+def build_corpus(workdir, docs, seed):
+    """
+    Database of a synthetic corpus, built or reused from workdir
+    return: path of the database, ingest_full result
+    """
+    path = os.path.join(workdir, 'corpus-{}-{}.db'.format(docs, seed))
+    info = path + '.json'
+    if os.path.exists(path) and os.path.exists(info):
+        with open(info) as file:
+            result = json.load(file)
+        result['cached'] = True
+        return path, result
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+    result = load(path, corpus.records(docs, seed=seed), full=True)
+    with open(info, 'w') as file:
+        json.dump(result, file)
+    result['cached'] = False
+    return path, result
+
+
+def ingest_incremental(workdir, path, docs, seed):
+    """
+    Incremental load into a copy of the corpus: 1% of the documents
+    and their topics get new texts
+    """
+    copy = os.path.join(workdir, 'incremental.db')
+    shutil.copyfile(path, copy)
+    changed = max(10, docs // 100)
+    result = load(copy, corpus.records(changed, seed=seed + 1), full=False)
+    for name in (copy, copy + '-wal', copy + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+    return result
+
+
+def fixtures(workdir, docs, seed):
+    """
+    Offline HTML fixtures of the corpus, written to workdir once
+    return: list of pages
+    """
+    directory = os.path.join(workdir, 'fixtures-{}-{}'.format(docs, seed))
+    if not os.path.isdir(directory):
+        pages = synthetic_pages(docs, seed)
+        os.makedirs(directory + '.tmp', exist_ok=True)
+        for index, page in enumerate(pages):
+            with open(os.path.join(directory + '.tmp',
+                                   '{:07d}.html'.format(index)),
+                      'w', encoding='utf-8') as file:
+                file.write(page)
+        os.replace(directory + '.tmp', directory)
+        return pages
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), encoding='utf-8') as file:
+            pages.append(file.read())
+    return pages
+
+
+def parse_pages(pages):
+    """Pages per second of the single-pass extraction"""
+    start = time.perf_counter()
+    for page in pages:
+        single_pass(page)
+    seconds = time.perf_counter() - start
+    return {
+        'pages': len(pages),
+        'megabytes': sum(map(len, pages)) / 1e6,
+        'pages_per_s': len(pages) / seconds,
+    }
+
+
+def name_pools(path, seed, size=50):
+    """
+    Topic names, document headings and search terms of a corpus, the
+    same on every run
+    """
+    rng = random.Random(seed)
+    pools = {}
+    with sqlite3.connect(path) as conn:
+        cur = conn.cursor()
+        for pool, table, column in (('topics', 'topic', 'name'),
+                                    ('docs', 'doc', 'Heading')):
+            cur.execute('SELECT max(id) FROM {}'.format(table))
+            last = cur.fetchone()[0] or 0
+            ids = rng.sample(range(1, last + 1), min(size, last))
+            cur.execute('SELECT {} FROM {} WHERE id IN ({}) ORDER BY id'
+                        .format(column, table, ', '.join('?' * len(ids))),
+                        ids)
+            pools[pool] = [row[0] for row in cur.fetchall()]
+        cur.execute(
+            'SELECT word FROM word_df ORDER BY docs DESC, word LIMIT ?',
+            (size * 4,))
+        pools['terms'] = [row[0] for row in cur.fetchall()]
+    conn.close()
+    return pools
+
+
+async def run_command(handler, args, chat_id=1):
+    """
+    Call a handler like the application does
+    return: seconds, number of messages sent
+    """
+    fake = FakeBot()
+    update = FakeUpdate(fake, chat_id)
+    start = time.perf_counter()
+    await handler(update, FakeContext(fake, args))
+    return time.perf_counter() - start, len(fake.messages)
+
+
+async def commands(pools, repeat, seed):
+    """
+    Latencies of every command, cold and warm
+    return: list of results
+    """
+    results = []
+    for name, handler, make_args in COMMANDS:
+        rng = random.Random(seed)
+        cold, warm = [], []
+        messages_sent = 0
+        for _ in range(repeat):
+            bot.RESULTS.clear()
+            bot.REPLIES.clear()
+            args = make_args(pools, rng)
+            seconds, sent = await run_command(handler, args)
+            cold.append(seconds)
+            messages_sent += sent
+            seconds, _ = await run_command(handler, args)
+            warm.append(seconds)
+        for mode, latencies in (('cold', cold), ('warm', warm)):
+            results.append(dict(
+                scenario='command', command=name, cache=mode,
+                messages_per_call=messages_sent / repeat,
+                **summary(latencies)))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """
+    Changes of the main metric of every result present in both runs
+    return: list of {scenario, docs, key, metric, before, after, ratio}
+    """
+    def key(item):
+        return tuple((name, item[name]) for name in
+                     ('scenario', 'docs', 'command', 'cache')
+                     if name in item)
+
+    metrics = ('rows_per_s', 'pages_per_s', 'p50_ms')
+    before = {key(item): item for item in previous}
+    changes = []
+    for item in results:
+        old = before.get(key(item))
+        if old is None:
+            continue
+        for metric in metrics:
+            if item.get(metric) and old.get(metric):
+                changes.append({
+                    'key': dict(key(item)), 'metric': metric,
+                    'before': old[metric], 'after': item[metric],
+                    'ratio': item[metric] / old[metric]})
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--docs', default='1000',
+                        help='comma-separated corpus sizes, e.g. '
+                             '1000,100000,1000000')
+    parser.add_argument('--parse-docs', type=int, default=2000,
+                        help='articles of the parse fixtures at most')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='calls of every command')
+    parser.add_argument('--scenarios', default='ingest,parse,command',
+                        help='comma-separated scenarios to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir',
+                        help='keep corpora and fixtures here for reuse')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare',
+                        help='results of a previous run to compare with')
+    args = parser.parse_args()
+    sizes = [int(item) for item in args.docs.split(',')]
+    scenarios = set(args.scenarios.split(','))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        for docs in sizes:
+            path, result = build_corpus(workdir, docs, args.seed)
+            if 'ingest' in scenarios:
+                results.append(dict(scenario='ingest_full', docs=docs,
+                                    **result))
+                results.append(dict(
+                    scenario='ingest_incremental', docs=docs,
+                    **ingest_incremental(workdir, path, docs, args.seed)))
+            if 'parse' in scenarios:
+                pages = fixtures(workdir, min(docs, args.parse_docs),
+                                 args.seed)
+                results.append(dict(scenario='parse', docs=docs,
+                                    **parse_pages(pages)))
+            if 'command' in scenarios:
+                storage.configure(path)
+                # Not rate-limited, the fake bot answers at once
+                bot.OUTBOX = messages.Outbox(global_rate=None,
+                                             chat_rate=None)
+                for item in asyncio.run(commands(
+                        name_pools(path, args.seed), args.repeat, args.seed)):
+                    results.append(dict(item, docs=docs))
+                storage.pool.close()
+                bot.RUNTIME.shutdown()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'seed': args.seed,
+            'chunk_size': parse.CHUNK_SIZE,
+        },
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as file:
+            report['changes'] = compare(results, json.load(file)['results'])
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
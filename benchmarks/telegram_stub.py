@@ -0,0 +1,127 @@
+"""
+Fake Telegram Bot API for benchmarks: answers getMe and sendMessage
+like api.telegram.org and records the messages sent by the bot.
+Point the bot at it with base_url='http://127.0.0.1:<port>/bot'.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+BOT = {'id': 1, 'is_bot': True, 'first_name': 'NewsBot',
+       'username': 'news_bot'}
+
+
+def command_update(update_id, chat_id, text):
+    """
+    Update JSON of a user sending a command in a private chat
+    :param update_id: id of the update
+    :param chat_id: id of the chat, also the id of the user
+    :param text: text of the message, starting with /command
+    return: dict
+    """
+    command = text.split(' ', 1)[0]
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'User'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': user,
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0,
+                          'length': len(command)}],
+        },
+    }
+
+
+class TelegramStub:
+    """
+    Bot API server on a background thread
+    :param on_message: function (chat_id, text) called from the server
+                       threads for every message sent by the bot
+    :param port: port to listen on, 0 for any free port
+    :param delay: seconds every answer takes, like the round trip to
+                  api.telegram.org
+    :param blocked: ids of the chats that blocked the bot, sending to
+                    them fails with 403 Forbidden
+    """
+
+    def __init__(self, on_message=None, port=0, delay=0.0, blocked=()):
+        self.on_message = on_message
+        self.delay = delay
+        self.blocked = set(blocked)
+        self.messages = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Type', '').startswith(
+                        'application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode('utf-8')))
+                method = self.path.rsplit('/', 1)[-1]
+                if stub.delay:
+                    time.sleep(stub.delay)
+                status = 200
+                if method == 'sendMessage' and \
+                        int(params['chat_id']) in stub.blocked:
+                    status = 403
+                    data = json.dumps({
+                        'ok': False, 'error_code': status,
+                        'description': 'Forbidden: bot was blocked by '
+                                       'the user'}).encode()
+                else:
+                    result = stub.call(method, params)
+                    data = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.base_url = 'http://127.0.0.1:{}/bot'.format(self.port)
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    def call(self, method, params):
+        """Result of a Bot API method"""
+        if method == 'getMe':
+            return BOT
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            with self._lock:
+                self.messages.append((chat_id, params['text']))
+                message_id = len(self.messages)
+            if self.on_message is not None:
+                self.on_message(chat_id, params['text'])
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT,
+                'text': params['text'],
+            }
+        return True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
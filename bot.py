@@ -1,16 +1,69 @@
+import argparse
 import logging
+import os
 import sqlite3
-import re
-from collections import defaultdict
-from telegram.ext import Updater, CommandHandler
-
-
-MAX_MESSAGE_LENGTH = 4096
+import time
+from contextlib import closing
+from functools import partial
+from telegram.ext import Application, CommandHandler
+import cache
+import messages
+import metrics
+import notify
+import runtime
+import scheduler
+import search
+import storage
+import trending
+import webhook
+
+
+MAX_MESSAGE_LENGTH = messages.MAX_MESSAGE_LENGTH
+# Rows of a reply of /new_docs and /new_topics, the rest is listed by
+# the next command shown at its end
+PAGE_SIZE = 50
+# Most frequent words shown by /describe_topic
+TOP_WORDS = 100
+# Documents listed by /search
+SEARCH_RESULTS = 10
+# Full-text matches compared by find_name
+NAME_CANDIDATES = 20
+# Results of the select_* / get_* functions and rendered replies,
+# valid until the next ingest
+RESULTS = cache.Cache(maxsize=4096, name='results')
+REPLIES = cache.Cache(maxsize=1024, name='replies')
+# Blocking work of the handlers: worker threads, requests of a chat
+# handled at a time and waiting at most
+RUNTIME = runtime.Runtime(workers=4, per_chat=1, backlog=4)
+# Messages sent within the flood limits of the Bot API
+OUTBOX = messages.Outbox()
+# Updates handled concurrently by the application
+CONCURRENT_UPDATES = 256
+# Ids of the users allowed to run /stats
+ADMINS = set()
+# metrics.Profiler of the commands, None to profile nothing
+PROFILER = None
+# notify.Notifier pushing the new documents of subscribed topics, None
+# to push nothing
+NOTIFIER = None
+COMMAND_SECONDS = metrics.histogram(
+    'newsbot_command_seconds',
+    'Seconds from a command handled to its reply sent', ('command',))
+RENDER_SECONDS = metrics.histogram(
+    'newsbot_render_seconds',
+    'Seconds rendering the reply of a command on a worker thread',
+    ('command',))
+COMMAND_ERRORS = metrics.counter(
+    'newsbot_command_errors_total', 'Commands answered with an error',
+    ('command', 'reason'))
 # Enable logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO)
 
+# httpx logs every request to the Bot API, token included
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,51 +73,207 @@ def get_parts_of_text(text, character):
     we have to separate into small texts (part)
     :param text: text to be handled
     :param character: character used to separate text
+    return: list of parts, see messages.chunks
     """
-    _text = text
-    if len(text) > MAX_MESSAGE_LENGTH:
-        parts = []
-        while len(_text) > MAX_MESSAGE_LENGTH:
-            part = _text[:MAX_MESSAGE_LENGTH]
-            first_lnbr = part.rfind(character)
-            parts.append(part[:first_lnbr + 1])
-            _text = _text[first_lnbr + 1:]
-        parts.append(_text)
-        return parts
-    else:
-        return text
+    return list(messages.chunks(messages.split_after(text, character),
+                                MAX_MESSAGE_LENGTH))
 
 
-def select_new_docs(conn, number_of_docs):
+@cache.cached(RESULTS)
+def select_new_docs(conn, number_of_docs, after=None):
     """
-    Select a given number of newest documents
+    Select a given number of newest documents, one per story: the
+    near-duplicates of a document (see dedup) and the documents without
+    a date are left out
     :param conn: A SQLite database connection
     :param number_of_docs: number of documents to select
+    :param after: (LastUpdateTime, id) of the last row of the previous
+                  page, None for the first page
+    return: list of (Heading, LastUpdateTime, id)
     """
-    query = '''SELECT Heading, LastUpdateTime
+    query = '''SELECT Heading, LastUpdateTime, id
                FROM doc
-               ORDER BY LastUpdateTime DESC
+               WHERE LastUpdateTime IS NOT NULL AND NOT EXISTS (
+                   SELECT 1 FROM doc_cluster c
+                   WHERE c.doc_id = doc.id AND c.canonical_id != doc.id)
+               {}
+               ORDER BY LastUpdateTime DESC, id DESC
+               LIMIT ?
                '''
     cur = conn.cursor()
-    cur.execute(query)
-    rows = cur.fetchall()
-    return rows[:number_of_docs]
+    if after is None:
+        cur.execute(query.format(''), (number_of_docs,))
+    else:
+        cur.execute(
+            query.format('AND (LastUpdateTime, id) < (?, ?)'),
+            tuple(after) + (number_of_docs,))
+    return cur.fetchall()
 
 
-def select_new_topics(conn, number_of_topics):
+@cache.cached(RESULTS)
+def select_new_topics(conn, number_of_topics, after=None):
     """
-    Select a given number of newest topics
+    Select a given number of newest topics, the topics without a date
+    left out
     :param conn: A SQLite database connection
     :param number_of_topics: number of topics to select
+    :param after: (LastUpdateTime, id) of the last row of the previous
+                  page, None for the first page
+    return: list of (name, LastUpdateTime, id)
     """
-    query = '''SELECT name
+    query = '''SELECT name, LastUpdateTime, id
                FROM topic
-               ORDER BY LastUpdateTime DESC
+               WHERE LastUpdateTime IS NOT NULL
+               {}
+               ORDER BY LastUpdateTime DESC, id DESC
+               LIMIT ?
+               '''
+    cur = conn.cursor()
+    if after is None:
+        cur.execute(query.format(''), (number_of_topics,))
+    else:
+        cur.execute(
+            query.format('AND (LastUpdateTime, id) < (?, ?)'),
+            tuple(after) + (number_of_topics,))
+    return cur.fetchall()
+
+
+def render_page(conn, args, select, table, line):
+    """
+    Messages of one page of a keyset-paginated select: at most
+    PAGE_SIZE rows, then the command listing the next ones
+    :param conn: A SQLite database connection
+    :param args: (N,) or (N, id of the last row of the previous page)
+    :param select: select_new_docs or select_new_topics
+    :param table: table of the rows of select
+    :param line: function (index, row) -> line of the reply
+    return: list of messages
+    """
+    number = int(args[0])
+    if number <= 0:
+        raise ValueError(number)
+    after = None
+    if len(args) > 1:
+        cur = conn.cursor()
+        cur.execute('SELECT LastUpdateTime, id FROM {} WHERE id = ?'.format(
+            table), (int(args[1]),))
+        after = cur.fetchone()
+        if after is None:
+            raise ValueError(args[1])
+    rows = select(conn, min(number, PAGE_SIZE), after)
+    lines = [line(index, item) for index, item in enumerate(rows, start=1)]
+    if number > PAGE_SIZE == len(rows):
+        lines.append('Дальше: /{} {} {}\n'.format(
+            'new_' + table + 's', number - PAGE_SIZE, rows[-1][-1]))
+    return list(messages.chunks(lines))
+
+
+@cache.cached(RESULTS)
+def search_docs(conn, text, number_of_docs=SEARCH_RESULTS):
+    """
+    Full-text search of documents in doc_fts, ranked by BM25 with
+    matches in the heading weighted higher. Documents containing all
+    words of the query come first, else the ones containing any.
+    :param conn: A SQLite database connection
+    :param text: query typed by the user
+    :param number_of_docs: number of documents to select
+    return: list of (heading, snippet of the text)
+    """
+
+    query = '''SELECT d.Heading,
+                      snippet(doc_fts, 1, '*', '*', '...', 16)
+               FROM doc_fts
+               JOIN doc d ON d.id = doc_fts.rowid
+               WHERE doc_fts MATCH ?
+               ORDER BY bm25(doc_fts, 10.0, 1.0)
+               LIMIT ?
+               '''
+    cur = conn.cursor()
+    for any_word in (False, True):
+        expression = search.query(text, any_word)
+        if expression is None:
+            return []
+        cur.execute(query, (expression, number_of_docs))
+        rows = cur.fetchall()
+        if rows:
+            return rows
+    return []
+
+
+# name: (table, column, full-text index)
+NAMES = {
+    'doc': ('doc', 'Heading', 'doc_fts'),
+    'topic': ('topic', 'name', 'topic_fts'),
+}
+
+
+@cache.cached(RESULTS)
+def find_name(conn, kind, name):
+    """
+    Find the document heading or topic name the user meant:
+    the exact name, else a name containing words starting like the
+    words of name, else the closest name sharing a word stem with it
+    :param conn: A SQLite database connection
+    :param kind: doc or topic
+    :param name: name typed by the user
+    return: name as stored in the database, raises IndexError
+            if nothing matches
+    """
+
+    table, column, index = NAMES[kind]
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT {1} FROM {0} WHERE {1} = ?'.format(table, column), (name,))
+    if cur.fetchall():
+        return name
+
+    query = '''SELECT t.{1}
+               FROM {2} f
+               JOIN {0} t ON t.id = f.rowid
+               WHERE {2} MATCH ?
+               ORDER BY f.rank
+               LIMIT ?
+               '''.format(table, column, index)
+    for any_word in (False, True):
+        expression = search.query(
+            name, any_word, stems=any_word, column=column)
+        if expression is None:
+            break
+        cur.execute(query, (expression, NAME_CANDIDATES))
+        candidates = [row[0] for row in cur.fetchall()]
+        if candidates and not any_word:
+            return candidates[0]
+        match = search.closest(name, candidates)
+        if match is not None:
+            return match
+    raise IndexError(name)
+
+
+@cache.cached(RESULTS)
+def select_topic_docs(conn, topic_name, number_of_docs=-1):
+    """
+    Select headings and texts of the documents of the topic,
+    in the order of the topic page
+    :param conn: A SQLite database connection
+    :param topic_name: name of topic
+    :param number_of_docs: number of documents to select, -1 for all
+    return: list of (heading, text)
+    """
+
+    query = '''SELECT d.Heading, d.text
+               FROM topic t
+               JOIN topic_doc td ON td.topic_id = t.id
+               JOIN doc d ON d.url = td.doc_url
+               WHERE t.name = ?
+               ORDER BY td.position
+               LIMIT ?
                '''
     cur = conn.cursor()
-    cur.execute(query)
+    cur.execute(query, (topic_name, number_of_docs))
     rows = cur.fetchall()
-    return rows[:number_of_topics]
+    if not rows:
+        raise IndexError(topic_name)
+    return rows
 
 
 def select_new_doc_from_topic(conn, topic_name, number_of_docs):
@@ -75,17 +284,11 @@ def select_new_doc_from_topic(conn, topic_name, number_of_docs):
     :param number_of_docs: number of topics to select
     """
 
-    query = '''SELECT row.articles
-               FROM topic row
-               WHERE row.name = ?
-               '''
-    cur = conn.cursor()
-    cur.execute(query, (topic_name,))
-    docs = cur.fetchall()[0][0]
-    list_of_docs = docs.split('\n')
-    return list_of_docs[:number_of_docs]
+    rows = select_topic_docs(conn, topic_name, number_of_docs)
+    return [heading for heading, _ in rows]
 
 
+@cache.cached(RESULTS)
 def select_doc(conn, doc_title):
     """
     Get a document by the given title
@@ -103,6 +306,7 @@ def select_doc(conn, doc_title):
     return text[0][0]
 
 
+@cache.cached(RESULTS)
 def select_topic(conn, topic_name):
     """
     Get a topic by the given title
@@ -121,106 +325,121 @@ def select_topic(conn, topic_name):
     return text[0][0]
 
 
+@cache.cached(RESULTS)
+def select_topic_id(conn, topic_name):
+    """
+    Get the id of a topic by the given name
+    :param conn: A SQLite database connection
+    :param topic_name: name of topic
+    """
+
+    query = '''SELECT row.id
+               FROM topic row
+               WHERE row.name = ?
+               '''
+    cur = conn.cursor()
+    cur.execute(query, (topic_name,))
+    return cur.fetchall()[0][0]
+
+
+@cache.cached(RESULTS)
 def select_words_best_describe(conn, topic_name, number_of_words):
     """
-    Select words that best describe the topic
+    Select words that best describe the topic, ranked by TF-IDF
+    (see keywords.refresh)
     :param conn: A SQLite database connection
     :param topic_name: name of topic
     :param number_of_words: number of words to select
     return: list of words
     """
 
-    query = '''SELECT row.articles
-           FROM topic row
-           WHERE row.name = ?
-           '''
+    query = '''SELECT word
+               FROM topic_keyword
+               WHERE topic_id = ?
+               ORDER BY rank
+               LIMIT ?
+               '''
     cur = conn.cursor()
-    cur.execute(query, (topic_name,))
-    docs = cur.fetchall()[0][0]
-    list_of_docs = docs.split('\n')
-    dic = defaultdict(int)
-    for item in list_of_docs:
-        text = select_doc(conn, item)
-        text = re.split(r', | ', text)
-        for word in text:
-            word = ''.join(ch for ch in word if ch.isalnum())
-            if len(word) <= 3:
-                continue
-            dic[word] += 1
-    dic = sorted(dic.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
-    key_word = []
-    for index in range(number_of_words):
-        key_word.append(dic[index][0])
-    return key_word
+    cur.execute(query, (select_topic_id(conn, topic_name), number_of_words))
+    return [row[0] for row in cur.fetchall()]
 
 
+@cache.cached(RESULTS)
 def get_distribution_from_doc(conn, doc_title):
     """
     Get frequency and length of words distribution of given document
+    from the token statistics stored at ingest
     :param conn: A SQLite database connection
     :param doc_title: title of document
-    return: frequency distribution, length distribution (type dict)
+    return: frequency distribution, length distribution (type list)
     """
 
-    text = select_doc(conn, doc_title)
-    text = re.split(r', | ', text)
-    freq_dic = defaultdict(int)
-    len_dic = defaultdict(int)
-    for word in text:
-        word = ''.join(ch for ch in word if ch.isalnum())
-        if len(word) == 0:
-            continue
-        len_dic[str(len(word))] += 1
-        freq_dic[word] += 1
-
-    freq_dic = sorted(
-        freq_dic.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
-    len_dic = sorted(
-        len_dic.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+    query = '''SELECT row.id
+               FROM doc row
+               WHERE row.Heading = ?
+               '''
+    cur = conn.cursor()
+    cur.execute(query, (doc_title,))
+    doc_id = cur.fetchall()[0][0]
+
+    query = '''SELECT word, count
+               FROM doc_word
+               WHERE doc_id = ?
+               ORDER BY count DESC, word DESC
+               '''
+    cur.execute(query, (doc_id,))
+    freq_dic = cur.fetchall()
+
+    query = '''SELECT CAST(length AS TEXT), count
+               FROM doc_len
+               WHERE doc_id = ?
+               ORDER BY count DESC, length DESC
+               '''
+    cur.execute(query, (doc_id,))
+    len_dic = cur.fetchall()
 
     return freq_dic, len_dic
 
 
-def get_discribe_from_topic(conn, topic_name):
+@cache.cached(RESULTS)
+def get_discribe_from_topic(conn, topic_name, number_of_words=TOP_WORDS):
     """
-    Get informations from topic
+    Get informations from topic, read from the topic aggregates
     :param conn: A SQLite database connection
     :param topic_name: name of topic
+    :param number_of_words: number of most frequent words to select
     return: number of documents in topic
             average of length of documents
             frequency distribution
             length distribution
     """
 
-    query = '''SELECT row.articles
-               FROM topic row
-               WHERE row.name = ?
+    topic_id = select_topic_id(conn, topic_name)
+    query = '''SELECT docs, text_length
+               FROM topic_stats
+               WHERE topic_id = ? AND docs > 0
                '''
     cur = conn.cursor()
-    cur.execute(query, (topic_name,))
-    articles = cur.fetchall()[0][0]
-
-    articles = re.split(r'\n', articles)
-    number_docs = len(articles)
-    sum_of_len_docs = 0
-    freq_dic = defaultdict(int)
-    len_dic = defaultdict(int)
-    for item in articles:
-        text = select_doc(conn, item)
-        sum_of_len_docs += len(text)
-        doc_freq_dic, doc_len_dic = get_distribution_from_doc(conn, item)
-        for (key, value) in doc_freq_dic:
-            freq_dic[key] += value
-
-        for (key, value) in doc_len_dic:
-            len_dic[key] += value
-
+    cur.execute(query, (topic_id,))
+    number_docs, sum_of_len_docs = cur.fetchall()[0]
     average_of_len = sum_of_len_docs / number_docs
 
-    freq_dic = sorted(
-        freq_dic.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
-    len_dic = sorted(
-        len_dic.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+    query = '''SELECT word, count
+               FROM topic_word
+               WHERE topic_id = ?
+               ORDER BY count DESC, word DESC
+               LIMIT ?
+               '''
+    cur.execute(query, (topic_id, number_of_words))
+    freq_dic = cur.fetchall()
+
+    query = '''SELECT CAST(length AS TEXT), count
+               FROM topic_len
+               WHERE topic_id = ?
+               ORDER BY count DESC, length DESC
+               '''
+    cur.execute(query, (topic_id,))
+    len_dic = cur.fetchall()
 
     return number_docs, average_of_len, freq_dic, len_dic
 
@@ -229,196 +448,508 @@ def get_discribe_from_topic(conn, topic_name):
 # These usually take the two arguments update and
 # context. Error handlers also receive the raised
 # TelegramError object in error
-def start(update, context):
+async def start(update, context):
     """Send a message when the command /start is issued."""
     text = """
 Welcome to NewsBot
 This Bot will give you news from site https://www.rbc.ru/story/
 Check /help for more informations
 """
-    update.message.reply_text(text)
+    await update.message.reply_text(text)
 
 
-def help(update, context):
+async def help(update, context):
     """Send a message when the command /help is issued."""
     text = """
 These are what I can do:
 /new_docs <N> - показать N самых свежих новостей
 /new_topics <N> - показать N самых свежих тем
+(по 50 за ответ, в конце - команда для следующих)
 /topic <topic_name> - показать описание темы и заголовки
 5 самых свежих новостей в этой теме
 /doc <doc_title> - показать текст документа с заданным заголовком
 /words <topic_name> - показать 5 слов, лучше всего характеризующих тему
 /describe_doc <doc_title> - вывести статистику по документу
 /describe_topic <topic_name> - вывести статистику по теме
+/search <query> - найти новости по словам заголовка и текста
+/trending [window] - темы и слова с самым быстрым ростом за окно
+(6h, 2d, по умолчанию 24h)
+/subscribe <topic_name> - присылать новые новости темы,
+без названия - показать подписки
+/unsubscribe [topic_name] - отписаться от темы, без названия - от всех
 """
-    update.message.reply_text(text)
+    await update.message.reply_text(text)
 
 
-def new_docs(update, context):
-    """Show N latest news"""
+def command_name(render):
+    """Name of the command of a render_* function"""
+    return render.__name__.replace('render_', '', 1)
+
+
+def rendered(render, args, *extra):
+    """
+    Messages of a command, rendered by render(conn, args, *extra) on a
+    pooled connection or read from the reply cache, profiled by
+    PROFILER
+    """
+    name = command_name(render)
+    with RENDER_SECONDS.time(name), storage.connection() as conn:
+        if PROFILER is not None:
+            return PROFILER.run(name, render, conn, args, *extra)
+        return render(conn, args, *extra)
+
+
+async def reply(update, context, render, chat=False):
+    """
+    Send the messages of a command, rendered on a worker thread of
+    RUNTIME
+    :param update: the update of the command
+    :param context: the context of the command
+    :param render: function (conn, args) -> list of messages,
+                   raising IndexError or ValueError on bad input, and
+                   sqlite3.OperationalError if the database stays
+                   locked by a refresh
+    :param chat: the command is about the chat itself, render is
+                 called as render(conn, args, chat_id)
+    """
+    name = command_name(render)
+    start = time.perf_counter()
+    extra = (update.effective_chat.id,) if chat else ()
     try:
-        number1 = int(context.args[0])
-        with sqlite3.connect('data.db') as conn:
-            rows = select_new_docs(conn, number1)
-            texts = ''
-            index = 1
-            for item in rows:
-                texts += '{}. [{}] {}\n'.format(index, item[1][:-3], item[0])
-                index += 1
-            update.message.reply_text(texts)
+        texts = await RUNTIME.run(
+            update.effective_chat.id, rendered, render,
+            tuple(context.args), *extra)
     except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+        COMMAND_ERRORS.inc(name, 'input')
+        texts = ['Input Error!']
+    except runtime.Busy:
+        COMMAND_ERRORS.inc(name, 'busy')
+        texts = ['Слишком много запросов, подождите ответа']
+    except sqlite3.OperationalError as err:
+        # e.g. a write waiting longer than notify.TIMEOUT for a refresh
+        logger.warning('Command /%s failed: %r', name, err)
+        COMMAND_ERRORS.inc(name, 'database')
+        texts = ['База данных занята, попробуйте позже']
+    await OUTBOX.send(context.bot, update.effective_chat.id, texts)
+    COMMAND_SECONDS.observe(time.perf_counter() - start, name)
+
+
+@cache.cached(REPLIES)
+def render_new_docs(conn, args):
+    """Messages of /new_docs, one page, see render_page"""
+    return render_page(
+        conn, args, select_new_docs, 'doc',
+        lambda index, item: '{}. [{}] {}\n'.format(
+            index, item[1][:-3], item[0]))
+
+
+@cache.cached(REPLIES)
+def render_new_topics(conn, args):
+    """Messages of /new_topics, one page, see render_page"""
+    return render_page(
+        conn, args, select_new_topics, 'topic',
+        lambda index, item: '{}. {}\n'.format(index, item[0]))
+
+
+@cache.cached(REPLIES)
+def render_topic(conn, args):
+    """Messages of /topic"""
+    topic_name = find_name(conn, 'topic', ' '.join(args))
+    descript = select_topic(conn, topic_name)
+    rows = select_new_doc_from_topic(conn, topic_name, 5)
+    pieces = [descript + '\n',
+              'Заголовки 5 самых свежих новостей в этой теме:\n']
+    pieces.extend('{}. {}\n'.format(index, value)
+                  for index, value in enumerate(rows, start=1))
+    return list(messages.chunks(pieces))
+
+
+@cache.cached(REPLIES)
+def render_doc(conn, args):
+    """Messages of /doc, cut between sentences"""
+    doc_title = find_name(conn, 'doc', ' '.join(args))
+    text = select_doc(conn, doc_title)
+    return get_parts_of_text(text, '.')
+
+
+@cache.cached(REPLIES)
+def render_words(conn, args):
+    """Messages of /words"""
+    text = '5 слов, лучше всего характеризующих тему:\n'
+    topic_name = find_name(conn, 'topic', ' '.join(args))
+    key_words = select_words_best_describe(conn, topic_name, 5)
+    for word in key_words:
+        text += word + ', '
+    return [text[:-2]]
 
 
-def new_topics(update, context):
+def describe(title, freq_dic, len_dic, *lines):
+    """
+    Pieces of the statistics of a document or a topic
+    :param title: heading of the document or name of the topic
+    :param freq_dic: list of (word, count)
+    :param len_dic: list of (length, count)
+    :param lines: lines shown before the distributions
+    yield: pieces, see messages.chunks
+    """
+    yield '{}\n'.format(title)
+    yield from lines
+    yield 'Распределение частот слов:\n'
+    yield from messages.items(freq_dic)
+    yield '\nРаспределение длин слов:\n'
+    yield from messages.items(len_dic)
+    yield '\n'
+
+
+@cache.cached(REPLIES)
+def render_describe_doc(conn, args):
+    """Messages of /describe_doc"""
+    doc_title = find_name(conn, 'doc', ' '.join(args))
+    freq_dic, len_dic = get_distribution_from_doc(conn, doc_title)
+    return list(messages.chunks(describe(doc_title, freq_dic, len_dic)))
+
+
+@cache.cached(REPLIES)
+def render_describe_topic(conn, args):
+    """Messages of /describe_topic"""
+    topic_name = find_name(conn, 'topic', ' '.join(args))
+    discriber = get_discribe_from_topic(conn, topic_name)
+    number_docs, average_of_len, freq_dic, len_dic = discriber
+    return list(messages.chunks(describe(
+        topic_name, freq_dic, len_dic,
+        'Количество документов в теме: {}\n'.format(number_docs),
+        'Cредняя длина документов: {:.1f}\n'.format(average_of_len))))
+
+
+@cache.cached(REPLIES)
+def render_search(conn, args):
+    """Messages of /search"""
+    rows = search_docs(conn, ' '.join(args))
+    if not rows:
+        return ['Ничего не найдено']
+    return list(messages.chunks(
+        '{}. {}\n{}\n'.format(index, heading, snippet)
+        for index, (heading, snippet) in enumerate(rows, start=1)))
+
+
+@cache.cached(REPLIES)
+def render_trending(conn, args):
+    """Messages of /trending, read from the trend buckets"""
+    width, number = trending.parse_window(args[0] if args else None)
+    window = '{} {}'.format(number, 'ч' if width == trending.HOUR else 'д')
+    topics = trending.top_topics(conn, width, number)
+    terms = trending.top_terms(conn, width, number)
+    if not topics and not terms:
+        return ['Ничего не найдено']
+    lines = ['Растущие темы за {} (сейчас / до):\n'.format(window)]
+    lines.extend(
+        '{}. {} — {} / {} (×{:.1f})\n'.format(
+            index, name, current, previous,
+            trending.growth(current, previous))
+        for index, (name, current, previous) in enumerate(topics, start=1))
+    lines.append('Растущие слова:\n')
+    lines.extend(
+        '{}. {} — {} / {} (×{:.1f})\n'.format(
+            index, word, current, previous,
+            trending.growth(current, previous))
+        for index, (word, current, previous) in enumerate(terms, start=1))
+    return list(messages.chunks(lines))
+
+
+def select_topic_url(conn, topic_name):
+    """
+    URL of the topic, which identifies it across full loads
+    :param conn: A SQLite database connection
+    :param topic_name: name of the topic
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT url FROM topic WHERE name = ?', (topic_name,))
+    return cur.fetchone()[0]
+
+
+def render_subscribe(conn, args, chat_id):
+    """Messages of /subscribe, which writes the subscription"""
+    if not args:
+        names = notify.subscriptions(conn, chat_id)
+        if not names:
+            return ['Подписок нет']
+        return list(messages.chunks(
+            ['Подписки:\n'] + ['• {}\n'.format(name) for name in names]))
+    topic_name = find_name(conn, 'topic', ' '.join(args))
+    with closing(notify.connect(storage.pool.path)) as writer:
+        added = notify.subscribe(
+            writer, chat_id, select_topic_url(conn, topic_name))
+    if not added:
+        return ['Вы уже подписаны на тему «{}»'.format(topic_name)]
+    return ['Новые новости темы «{}» будут приходить сюда'.format(
+        topic_name)]
+
+
+def render_unsubscribe(conn, args, chat_id):
+    """Messages of /unsubscribe, which deletes subscriptions"""
+    topic_url = topic_name = None
+    if args:
+        topic_name = find_name(conn, 'topic', ' '.join(args))
+        topic_url = select_topic_url(conn, topic_name)
+    with closing(notify.connect(storage.pool.path)) as writer:
+        removed = notify.unsubscribe(writer, chat_id, topic_url)
+    if not removed:
+        return ['Подписок нет']
+    if topic_name is None:
+        return ['Подписки отменены: {}'.format(removed)]
+    return ['Подписка на тему «{}» отменена'.format(topic_name)]
+
+
+def render_stats(conn, args):
+    """Messages of /stats, never cached"""
+    lines = ['Команды: число, p50 / p99 мс']
+    for (name,) in COMMAND_SECONDS.label_values():
+        summary = COMMAND_SECONDS.summary(name)
+        lines.append('{}: {}, {:.1f} / {:.1f}'.format(
+            name, summary['count'], summary['p50'] * 1000,
+            summary['p99'] * 1000))
+    summary = messages.SEND_SECONDS.summary()
+    if summary is not None:
+        lines.append('Отправка: {}, {:.1f} / {:.1f}'.format(
+            summary['count'], summary['p50'] * 1000,
+            summary['p99'] * 1000))
+    for item in (RESULTS, REPLIES):
+        stats = item.stats()
+        lookups = stats['hits'] + stats['misses']
+        lines.append('Кэш {}: {:.0%} попаданий из {}'.format(
+            item.name, stats['hits'] / lookups if lookups else 0, lookups))
+    lines.append('Очереди: обработка {}, отправка {}'.format(
+        RUNTIME.stats()['jobs'], OUTBOX.stats()['pending']))
+    status = storage.refresh_status(conn)
+    lines.append('Последнее обновление: {}, {} с, ошибок: {}'.format(
+        status['last_refresh'], status['refresh_seconds'],
+        status['refresh_errors']))
+    return list(messages.chunks(line + '\n' for line in lines))
+
+
+async def new_docs(update, context):
+    """Show N latest news"""
+    await reply(update, context, render_new_docs)
+
+
+async def new_topics(update, context):
     """Show N latest topics"""
-    try:
-        number1 = int(context.args[0])
-        with sqlite3.connect('data.db') as conn:
-            rows = select_new_topics(conn, number1)
-            texts = ''
-            index = 1
-            for item in rows:
-                texts += '{}. {}\n'.format(index, item[0])
-                index += 1
-            update.message.reply_text(texts)
-    except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+    await reply(update, context, render_new_topics)
 
 
-def topic(update, context):
+async def topic(update, context):
     """
     Show topic description and headlines
     of the 5 most recent news in this topic
     """
-    try:
-        topic_name = ' '.join(list(context.args))
-        with sqlite3.connect('data.db') as conn:
-            descript = select_topic(conn, topic_name)
-            rows = select_new_doc_from_topic(conn, topic_name, 5)
-            texts = 'Заголовки 5 самых свежих новостей в этой теме:\n'
-            for index, value in enumerate(rows, start=1):
-                texts += '{}. {}\n'.format(index, value)
-            update.message.reply_text(descript + '\n' + texts)
-
-    except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+    await reply(update, context, render_topic)
 
 
-def doc(update, context):
+async def doc(update, context):
     """Show the text of the document with the given title"""
-    try:
-        doc_title = ' '.join(list(context.args))
-        with sqlite3.connect('data.db') as conn:
-            text = select_doc(conn, doc_title)
-            if len(text) > MAX_MESSAGE_LENGTH:
-                parts = get_parts_of_text(text, '.')
-                for part in parts:
-                    update.message.reply_text(part)
-            else:
-                update.message.reply_text(text)
-
-    except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+    await reply(update, context, render_doc)
 
 
-def words(update, context):
+async def words(update, context):
     """Show 5 words that best describe the topic"""
-    try:
-        topic_name = ' '.join(list(context.args))
-        text = '5 слов, лучше всего характеризующих тему:\n'
-        with sqlite3.connect('data.db') as conn:
-            key_words = select_words_best_describe(conn, topic_name, 5)
-            for word in key_words:
-                text += word + ', '
-            text = text[:-2]
-        update.message.reply_text(text)
-    except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+    await reply(update, context, render_words)
 
 
-def describe_doc(update, context):
+async def describe_doc(update, context):
     """Display document statistics"""
-    try:
-        doc_title = ' '.join(list(context.args))
-        with sqlite3.connect('data.db') as conn:
-            freq_dic, len_dic = get_distribution_from_doc(conn, doc_title)
-            freq_distr = 'Распределение частот слов:\n'
-            len_distr = 'Распределение длин слов:\n'
-            for (key, value) in freq_dic:
-                freq_distr += '{}: {}'.format(key, value)
-            for (key, value) in len_dic:
-                len_distr += '{}: {}'.format(key, value)
-            text = '{}\n{}\n{}'.format(
-                                doc_title, freq_distr[:-2], len_distr[:-2])
-            update.message.reply_text(text)
-    except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+    await reply(update, context, render_describe_doc)
 
 
-def describe_topic(update, context):
+async def describe_topic(update, context):
     """Display statistics on a topic"""
-    try:
-        topic_name = ' '.join(list(context.args))
-        with sqlite3.connect('data.db') as conn:
-            discriber = get_discribe_from_topic(conn, topic_name)
-            number_docs, average_of_len, freq_dic, len_dic = discriber
-            freq_distr = 'Распределение частот слов:\n'
-            len_distr = 'Распределение длин слов:\n'
-            for (key, value) in freq_dic:
-                freq_distr += '{}: {}, '.format(key, value)
-            for (key, value) in len_dic:
-                len_distr += '{}: {}, '.format(key, value)
-            number_docs_str = 'Количество документов в теме: '
-            number_docs_str += '{}\n'.format(number_docs)
-            average_of_len_str = 'Cредняя длина документов: '
-            average_of_len_str += '{}\n'.format(average_of_len)
-            text = '{}\n{}{}'.format(
-                                topic_name, number_docs_str, number_docs_str)
-            text += '{}\n{}\n'.format(freq_distr[:-2], len_distr[:-2])
-
-            if len(text) > MAX_MESSAGE_LENGTH:
-                parts = get_parts_of_text(text, ',')
-                for part in parts:
-                    update.message.reply_text(part)
-            else:
-                update.message.reply_text(text)
-    except (IndexError, ValueError):
-        update.message.reply_text('Input Error!')
+    await reply(update, context, render_describe_topic)
+
+
+async def search_command(update, context):
+    """Search documents by words of their heading and text"""
+    await reply(update, context, render_search)
+
+
+async def trending_command(update, context):
+    """Show the topics and terms growing fastest"""
+    await reply(update, context, render_trending)
+
+
+async def subscribe(update, context):
+    """Push the new documents of a topic to the chat"""
+    await reply(update, context, render_subscribe, chat=True)
+
+
+async def unsubscribe(update, context):
+    """Stop pushing the new documents of a topic, or of all topics"""
+    await reply(update, context, render_unsubscribe, chat=True)
 
 
-def error(update, context):
+async def stats(update, context):
+    """Show the metrics of the bot to the users of ADMINS"""
+    if update.effective_user is None or \
+            update.effective_user.id not in ADMINS:
+        logger.warning('/stats refused to user %s', update.effective_user)
+        return
+    await reply(update, context, render_stats)
+
+
+async def error(update, context):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 
+async def start_pushes(application):
+    """Start NOTIFIER with the bot of the application"""
+    NOTIFIER.start(application.bot)
+
+
+async def stop_pushes(application):
+    await NOTIFIER.stop()
+
+
+def build_application(token, base_url=None):
+    """
+    Create the application and register the handlers
+    :param token: token of the bot
+    :param base_url: URL of the Bot API, None for api.telegram.org
+    return: Application
+    """
+    builder = Application.builder().token(token)
+    builder.concurrent_updates(CONCURRENT_UPDATES)
+    if base_url is not None:
+        builder.base_url(base_url)
+    if NOTIFIER is not None:
+        builder.post_init(start_pushes)
+        builder.post_stop(stop_pushes)
+    application = builder.build()
+
+    def collect():
+        runtime_stats = RUNTIME.stats()
+        outbox_stats = OUTBOX.stats()
+        yield ('newsbot_update_queue', 'gauge',
+               'Updates received and not handled yet', {},
+               application.update_queue.qsize())
+        yield ('newsbot_runtime_jobs', 'gauge',
+               'Renders running or waiting for a worker thread', {},
+               runtime_stats['jobs'])
+        yield ('newsbot_outbox_pending', 'gauge',
+               'Messages waiting to be sent', {}, outbox_stats['pending'])
+        yield ('newsbot_outbox_retries_total', 'counter',
+               'Messages sent again after a flood limit', {},
+               outbox_stats['retried'])
+
+    metrics.REGISTRY.register(__name__, collect)
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help))
+    application.add_handler(CommandHandler("new_docs", new_docs))
+    application.add_handler(CommandHandler("new_topics", new_topics))
+    application.add_handler(CommandHandler("topic", topic))
+    application.add_handler(CommandHandler("doc", doc))
+    application.add_handler(CommandHandler("words", words))
+    application.add_handler(CommandHandler("describe_doc", describe_doc))
+    application.add_handler(CommandHandler("describe_topic", describe_topic))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("trending", trending_command))
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    application.add_handler(CommandHandler("stats", stats))
+    # log all errors
+    application.add_error_handler(error)
+    return application
+
+
 def main():
     """Start the bot."""
-    api = '1774694275:AAFlE1pz2_2gCNciPlVT-tidq2YQbUir5CM'
-    updater = Updater(api, use_context=True)
-
-    dp = updater.dispatcher
-
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", help))
-    dp.add_handler(CommandHandler("new_docs", new_docs))
-    dp.add_handler(CommandHandler("new_topics", new_topics))
-    dp.add_handler(CommandHandler("topic", topic))
-    dp.add_handler(CommandHandler("doc", doc))
-    dp.add_handler(CommandHandler("words", words))
-    dp.add_handler(CommandHandler("describe_doc", describe_doc))
-    dp.add_handler(CommandHandler("describe_topic", describe_topic))
-    # log all errors
-    dp.add_error_handler(error)
+    global PROFILER, NOTIFIER
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--db', default=storage.DB_PATH,
+                        help='database path')
+    parser.add_argument(
+        '--mode', choices=('polling', 'webhook'),
+        default=os.environ.get('NEWSBOT_MODE', 'polling'),
+        help='how updates are received')
+    parser.add_argument('--listen', default='127.0.0.1',
+                        help='webhook: address to listen on')
+    parser.add_argument('--port', type=int, default=8443,
+                        help='webhook: port to listen on')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='webhook: number of worker processes')
+    parser.add_argument(
+        '--url', default=os.environ.get('NEWSBOT_WEBHOOK_URL'),
+        help='webhook: public URL registered with the Bot API')
+    parser.add_argument(
+        '--secret', default=os.environ.get('NEWSBOT_WEBHOOK_SECRET'),
+        help='webhook: secret token expected in the requests')
+    parser.add_argument(
+        '--refresh-interval', type=float,
+        default=float(os.environ.get('NEWSBOT_REFRESH_INTERVAL', 0)),
+        help='crawl the site every N seconds in the bot process, '
+             '0 to leave it to db.py or scheduler.py')
+    parser.add_argument('--full-every', type=int, default=0,
+                        help='make every N-th refresh a full one')
+    parser.add_argument(
+        '--snapshots', default=os.environ.get('NEWSBOT_SNAPSHOTS'),
+        help='directory keeping the raw pages of the refreshes')
+    parser.add_argument(
+        '--parse-workers', type=int,
+        default=int(os.environ.get('NEWSBOT_PARSE_WORKERS', 1)),
+        help='processes parsing the pages of the refreshes')
+    parser.add_argument(
+        '--admin', type=int, action='append',
+        default=[int(item) for item in os.environ.get(
+            'NEWSBOT_ADMINS', '').split(',') if item],
+        help='id of a user allowed to run /stats, may be repeated')
+    parser.add_argument(
+        '--metrics-port', type=int,
+        default=int(os.environ.get('NEWSBOT_METRICS_PORT', 0)),
+        help='serve Prometheus metrics on http://<listen>:<port>/metrics, '
+             '0 for none')
+    parser.add_argument(
+        '--profile', default=os.environ.get('NEWSBOT_PROFILE'),
+        help='directory receiving cProfile statistics of the commands')
+    parser.add_argument('--profile-rate', type=float, default=0.01,
+                        help='fraction of the commands profiled')
+    parser.add_argument(
+        '--push-interval', type=float,
+        default=float(os.environ.get('NEWSBOT_PUSH_INTERVAL',
+                                     notify.INTERVAL)),
+        help='seconds between two pushes of new documents to the '
+             'subscribers, 0 for none')
+    args = parser.parse_args()
+    storage.configure(args.db)
+    ADMINS.update(args.admin)
+    if args.profile:
+        PROFILER = metrics.Profiler(args.profile, args.profile_rate)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.listen)
+    if args.push_interval:
+        NOTIFIER = notify.Notifier(args.db, OUTBOX, args.push_interval)
+    refresher = None
+    if args.refresh_interval:
+        refresher = scheduler.Scheduler(
+            args.db, args.refresh_interval, args.full_every,
+            snapshots=args.snapshots, workers=args.parse_workers)
 
-    # Start the Bot
-    updater.start_polling()
+    api = '1774694275:AAFlE1pz2_2gCNciPlVT-tidq2YQbUir5CM'
+    if args.mode == 'webhook':
+        if args.url:
+            webhook.register(api, args.url, args.secret)
+        webhook.run(partial(build_application, api), args.listen,
+                    args.port, args.workers, args.secret,
+                    refresher.start if refresher else None)
+        return
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    # SIGTERM or SIGABRT.
+    application = build_application(api)
+    if refresher is not None:
+        refresher.start()
+    try:
+        application.run_polling()
+    finally:
+        RUNTIME.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+import metrics
+import storage
+
+
+# Seconds between two reads of the ingest generation of the database
+CHECK_INTERVAL = 1.0
+# Named caches, exported by collect
+CACHES = []
+COMPUTE_SECONDS = metrics.histogram(
+    'newsbot_compute_seconds',
+    'Seconds computing the result of a cached function on a miss',
+    ('function',))
+
+
+class Cache:
+    """
+    Bounded LRU cache with a time to live, for results that only
+    change when db.py writes the database. It is emptied as soon as
+    the ingest generation stored by db.py changes, entries are read
+    at most CHECK_INTERVAL seconds after the commit of an ingest.
+    Safe to share between threads. Cached values are shared too and
+    must not be modified by callers.
+    :param maxsize: maximum number of entries
+    :param ttl: seconds an entry is served
+    :param name: name of the cache in the metrics, None to leave it
+                 out
+    """
+
+    def __init__(self, maxsize=1024, ttl=600.0, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = None
+        self._checked = float('-inf')
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if name is not None:
+            CACHES.append(self)
+
+    def validate(self, conn):
+        """
+        Empty the cache if the database was written since the last
+        check, read at most every CHECK_INTERVAL seconds
+        :param conn: A SQLite database connection
+        """
+        now = time.monotonic()
+        if now - self._checked < CHECK_INTERVAL:
+            return
+        generation = storage.generation(conn)
+        with self._lock:
+            self._checked = now
+            if generation != self.generation:
+                self._entries.clear()
+                self.generation = generation
+
+    def get(self, key):
+        """
+        Look a key up
+        return: (True, value) on a hit, (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, generation):
+        """
+        Store a value computed at the given generation, dropped if
+        the cache was emptied meanwhile
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop all entries and force a generation check"""
+        with self._lock:
+            self._entries.clear()
+            self._checked = float('-inf')
+
+    def stats(self):
+        """
+        Counters of the cache
+        return: dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'generation': self.generation,
+            }
+
+
+def cached(cache):
+    """
+    Decorator caching a function whose first argument is a database
+    connection, keyed by the name of the function and the other
+    arguments, which must be hashable. Exceptions are not cached.
+    The undecorated function stays available as __wrapped__.
+    :param cache: a Cache instance
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(conn, *args, **kwargs):
+            cache.validate(conn)
+            key = (function.__name__, args, tuple(sorted(kwargs.items())))
+            hit, value = cache.get(key)
+            if hit:
+                return value
+            generation = cache.generation
+            with COMPUTE_SECONDS.time(function.__name__):
+                value = function(conn, *args, **kwargs)
+            cache.put(key, value, generation)
+            return value
+        return wrapper
+    return decorator
+
+
+def collect():
+    """Counters of the named caches, see metrics.Registry.register"""
+    for item in CACHES:
+        stats = item.stats()
+        labels = {'cache': item.name}
+        yield ('newsbot_cache_hits_total', 'counter',
+               'Lookups answered by the cache', labels, stats['hits'])
+        yield ('newsbot_cache_misses_total', 'counter',
+               'Lookups computed again', labels, stats['misses'])
+        yield ('newsbot_cache_evictions_total', 'counter',
+               'Entries dropped for room', labels, stats['evictions'])
+        yield ('newsbot_cache_entries', 'gauge',
+               'Entries in the cache', labels, stats['size'])
+
+
+metrics.REGISTRY.register(__name__, collect)
@@ -0,0 +1,297 @@
+import asyncio
+import gzip
+import http.client
+import logging
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# headers keys are lower-cased
+Response = namedtuple('Response', ['url', 'status', 'headers', 'body'])
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+USER_AGENT = 'Mozilla/5.0 (compatible; NewsBot/1.0)'
+FETCH_SECONDS = metrics.histogram(
+    'newsbot_fetch_seconds', 'Seconds of one HTTP request of the crawl',
+    ('host',))
+FETCH_RETRIES = metrics.counter(
+    'newsbot_fetch_retries_total', 'Requests of the crawl retried',
+    ('host',))
+FETCH_IN_FLIGHT = metrics.gauge(
+    'newsbot_fetch_in_flight', 'Requests of the crawl waiting or running')
+
+
+class FetchError(Exception):
+    """Raised when a URL cannot be fetched after all retries"""
+
+
+def decode_body(url, body, encoding):
+    """
+    Undo the Content-Encoding of a response body. deflate is meant to
+    be zlib-wrapped, but many servers send raw deflate: both are read.
+    :param url: URL address, for the error message
+    :param body: body as received
+    :param encoding: value of the Content-Encoding header
+    return: decoded body, raises FetchError if it cannot be decoded
+    """
+    try:
+        if encoding == 'gzip':
+            return gzip.decompress(body)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+    except (OSError, EOFError, zlib.error) as err:
+        raise FetchError('{}: cannot decode {} body: {!r}'.format(
+            url, encoding, err))
+    return body
+
+
+class RateLimiter:
+    """
+    Space requests to the same host at least 1 / rate seconds apart
+    :param rate: requests per second per host, 0 disables the limit
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._intervals = {}
+        self._next_slot = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def set_rate(self, host, rate):
+        """
+        Override the rate of one host
+        :param rate: requests per second, 0 disables the limit
+        """
+        self._intervals[host] = 1.0 / rate if rate else 0.0
+
+    async def wait(self, host):
+        """Sleep until the next request slot of the host"""
+        interval = self._intervals.get(host, self.interval)
+        if not interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot[host])
+            self._next_slot[host] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections reused per (scheme, host)
+    :param timeout: socket timeout in seconds
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        """Return an idle connection to the host or open a new one"""
+        with self._lock:
+            if self._idle[scheme, netloc]:
+                return self._idle[scheme, netloc].pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme, netloc, conn):
+        """Return a connection whose response was read completely"""
+        with self._lock:
+            self._idle[scheme, netloc].append(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+class Fetcher:
+    """
+    Concurrent fetch engine: bounded number of requests in flight,
+    per-host rate limit, connection reuse, retries with exponential
+    backoff and socket timeouts.
+    Blocking http.client calls run on a thread pool of max_in_flight
+    workers, so the event loop only schedules and waits.
+    :param max_in_flight: maximum number of simultaneous requests
+    :param per_host_rate: maximum requests per second to one host
+    :param retries: number of retries after the first attempt
+    :param backoff: base delay of the exponential backoff in seconds
+    :param timeout: socket timeout in seconds
+    :param snapshots: snapshots.SnapshotStore keeping every page
+                      fetched with HTTP 200, None to keep nothing
+    """
+
+    def __init__(self, max_in_flight=16, per_host_rate=10.0, retries=3,
+                 backoff=0.5, timeout=15.0, max_redirects=5,
+                 snapshots=None):
+        self.max_in_flight = max_in_flight
+        self.snapshots = snapshots
+        self.retries = retries
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        self.limiter = RateLimiter(per_host_rate)
+        self.pool = ConnectionPool(timeout)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def set_rate(self, host, rate):
+        """Limit the requests to one host, see RateLimiter.set_rate"""
+        self.limiter.set_rate(host, rate)
+
+    def close(self):
+        """Release the thread pool and the idle connections"""
+        self._executor.shutdown(wait=False)
+        self.pool.close()
+
+    def _request(self, url, headers):
+        """
+        Perform one blocking GET request on a pooled connection
+        return Response, raises FetchError if the body cannot be
+        decoded
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        request_headers.update(headers or {})
+        conn = self.pool.acquire(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.release(parts.scheme, parts.netloc, conn)
+
+        body = decode_body(
+            url, body, response.getheader('Content-Encoding', ''))
+        headers = {
+            key.lower(): value for key, value in response.getheaders()}
+        return Response(url, response.status, headers, body)
+
+    async def fetch(self, url, headers=None):
+        """
+        Fetch the URL following redirects and retrying transient errors
+        :param url: URL address
+        :param headers: extra request headers
+        return Response
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        loop = asyncio.get_running_loop()
+        requested = url
+        for _ in range(self.max_redirects + 1):
+            for attempt in range(self.retries + 1):
+                host = urlsplit(url).netloc
+                FETCH_IN_FLIGHT.inc()
+                try:
+                    async with self._semaphore:
+                        await self.limiter.wait(host)
+                        with FETCH_SECONDS.time(host):
+                            response = await loop.run_in_executor(
+                                self._executor, self._request, url,
+                                headers)
+                    if response.status not in RETRY_STATUSES:
+                        break
+                    reason = 'HTTP {}'.format(response.status)
+                except (OSError, http.client.HTTPException) as err:
+                    reason = repr(err)
+                finally:
+                    FETCH_IN_FLIGHT.dec()
+                if attempt == self.retries:
+                    raise FetchError('{}: {}'.format(url, reason))
+                FETCH_RETRIES.inc(host)
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                logger.info('Retry %s in %.2fs (%s)', url, delay, reason)
+                await asyncio.sleep(delay)
+
+            if response.status not in REDIRECT_STATUSES:
+                if response.status == 200 and self.snapshots is not None:
+                    # Kept under the requested URL, as replays ask for it
+                    await loop.run_in_executor(
+                        self._executor, self.snapshots.put, requested,
+                        response.body)
+                return response
+            url = urljoin(url, response.headers.get('location', ''))
+        raise FetchError('{}: too many redirects'.format(url))
+
+    async def fetch_text(self, url, encoding='utf-8'):
+        """
+        Fetch the URL and decode the body
+        return string from url
+        """
+        response = await self.fetch(url)
+        if response.status != 200:
+            raise FetchError('{}: HTTP {}'.format(url, response.status))
+        try:
+            return response.body.decode(encoding)
+        except UnicodeDecodeError as err:
+            raise FetchError('{}: {!r}'.format(url, err))
+
+    async def fetch_many(self, urls, headers_for=None, window=None):
+        """
+        Fetch URLs concurrently and yield (url, Response or FetchError)
+        in completion order. At most window fetches are scheduled at
+        once, so the iterable of URLs may be arbitrarily long.
+        :param headers_for: function url -> extra request headers
+        """
+        window = window or self.max_in_flight * 2
+
+        async def fetch_one(url):
+            headers = headers_for(url) if headers_for else None
+            try:
+                return url, await self.fetch(url, headers)
+            except FetchError as err:
+                return url, err
+
+        pending = set()
+        try:
+            for url in urls:
+                pending.add(asyncio.ensure_future(fetch_one(url)))
+                if len(pending) >= window:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # The consumer stopped early
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
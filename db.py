@@ -1,23 +1,106 @@
+import argparse
+import fcntl
+import logging
+import os
+import pickle
 import sqlite3
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from crawler import Fetcher
+import dedup
+import keywords
+import metrics
 import parse
+import search
+import snapshots
+import storage
+import trending
 
 
-conn = sqlite3.connect('data.db')
+logger = logging.getLogger(__name__)
 
+LOAD_SECONDS = metrics.histogram(
+    'newsbot_load_seconds',
+    'Seconds writing the records of a load, crawl excluded', ('mode',))
+LOADED_ROWS = metrics.counter(
+    'newsbot_loaded_rows_total', 'Topics and documents written',
+    ('mode',))
 
-def create_tables(cur, conn):
+# Applied to every connection that writes: WAL lets the bot keep reading
+# while a refresh is written, NORMAL sync is safe in WAL mode, and the
+# larger page cache / memory map cut I/O of bulk loads.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+)
+
+# Unique indexes are constraints and exist during loads,
+# the others are created after bulk loads
+# name: (table, indexed column, unique)
+INDEXES = {
+    'topic_url': ('topic', 'url', True),
+    'topic_name': ('topic', 'name', True),
+    'topic_time': ('topic', 'LastUpdateTime DESC, id DESC', False),
+    'doc_url': ('doc', 'url', True),
+    'doc_heading': ('doc', 'Heading', True),
+    'doc_time': ('doc', 'LastUpdateTime DESC, id DESC', False),
+    'topic_doc_url': ('topic_doc', 'doc_url', False),
+    'topic_word_count': (
+        'topic_word', 'topic_id, count DESC, word DESC', False),
+    'doc_cluster_canonical': ('doc_cluster', 'canonical_id', False),
+    'trend_topic_topic': ('trend_topic', 'topic_id', False),
+    'subscription_chat': ('subscription', 'chat_id', False),
+}
+
+
+def tune(conn):
     """
-    Create a new tables topic and doc in an SQLite database
+    Apply PRAGMAS to the connection, outside of any transaction
     :param conn: A SQLite database connection
+    """
+    for name, value in PRAGMAS:
+        conn.execute('PRAGMA {} = {}'.format(name, value))
+
+
+def create_tables(cur, drop=False):
+    """
+    Create the tables in an SQLite database if they do not exist yet.
+    Runs in the caller's transaction.
     :param cur: A Cursor instance
+    :param drop: delete old tables first (full rebuild)
     """
-    # Delete old tables, if there are.
-    cur.execute('DROP TABLE IF EXISTS topic')
-    cur.execute('DROP TABLE IF EXISTS doc')
+    if drop:
+        cur.execute('DROP TABLE IF EXISTS topic')
+        cur.execute('DROP TABLE IF EXISTS doc')
+        cur.execute('DROP TABLE IF EXISTS topic_doc')
+        cur.execute('DROP TABLE IF EXISTS doc_stats')
+        cur.execute('DROP TABLE IF EXISTS doc_word')
+        cur.execute('DROP TABLE IF EXISTS doc_len')
+        cur.execute('DROP TABLE IF EXISTS topic_stats')
+        cur.execute('DROP TABLE IF EXISTS topic_word')
+        cur.execute('DROP TABLE IF EXISTS topic_len')
+        cur.execute('DROP TABLE IF EXISTS word_df')
+        cur.execute('DROP TABLE IF EXISTS topic_keyword')
+        cur.execute('DROP TABLE IF EXISTS doc_minhash')
+        cur.execute('DROP TABLE IF EXISTS doc_band')
+        cur.execute('DROP TABLE IF EXISTS doc_cluster')
+        cur.execute('DROP TABLE IF EXISTS trend_topic')
+        cur.execute('DROP TABLE IF EXISTS trend_term')
+        cur.execute('DROP TABLE IF EXISTS doc_fts')
+        cur.execute('DROP TABLE IF EXISTS topic_fts')
+        cur.execute('DROP TABLE IF EXISTS fetch_state')
 
     # SQL query to create tables
     cur.execute('''
-        CREATE TABLE topic (
+        CREATE TABLE IF NOT EXISTS topic (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name VARCHAR(255),
             url VARCHAR(255),
@@ -26,7 +109,7 @@ def create_tables(cur, conn):
             LastUpdateTime DATE
         )''')
     cur.execute('''
-        CREATE TABLE doc (
+        CREATE TABLE IF NOT EXISTS doc (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             url VARCHAR(255),
             Heading VARCHAR(255),
@@ -34,54 +117,1041 @@ def create_tables(cur, conn):
             text TEXT,
             tags VARCHAR(255)
         )''')
+    # Documents of a topic in the order of the topic page
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS topic_doc (
+            topic_id INTEGER,
+            position INTEGER,
+            doc_url VARCHAR(255),
+            PRIMARY KEY (topic_id, position)
+        ) WITHOUT ROWID''')
+    # Token statistics of documents, computed once at ingest, and the
+    # hour bucket they are counted in by trend_term
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS doc_stats (
+            doc_id INTEGER PRIMARY KEY,
+            text_length INTEGER,
+            words INTEGER,
+            hour INTEGER
+        )''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS doc_word (
+            doc_id INTEGER,
+            word VARCHAR(255),
+            count INTEGER,
+            PRIMARY KEY (doc_id, word)
+        ) WITHOUT ROWID''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS doc_len (
+            doc_id INTEGER,
+            length INTEGER,
+            count INTEGER,
+            PRIMARY KEY (doc_id, length)
+        ) WITHOUT ROWID''')
+    # Sums of the token statistics of the stories of each topic, a
+    # cluster of near-duplicates counting once (update_topic_stats)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS topic_stats (
+            topic_id INTEGER PRIMARY KEY,
+            docs INTEGER,
+            text_length INTEGER
+        )''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS topic_word (
+            topic_id INTEGER,
+            word VARCHAR(255),
+            count INTEGER,
+            PRIMARY KEY (topic_id, word)
+        ) WITHOUT ROWID''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS topic_len (
+            topic_id INTEGER,
+            length INTEGER,
+            count INTEGER,
+            PRIMARY KEY (topic_id, length)
+        ) WITHOUT ROWID''')
+    # Document frequencies of normalized terms, maintained by
+    # set_docs_stats, and top keywords of topics (keywords.refresh)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS word_df (
+            word VARCHAR(255) PRIMARY KEY,
+            docs INTEGER
+        ) WITHOUT ROWID''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS topic_keyword (
+            topic_id INTEGER,
+            rank INTEGER,
+            word VARCHAR(255),
+            score REAL,
+            PRIMARY KEY (topic_id, rank)
+        ) WITHOUT ROWID''')
+    # Near-duplicate clusters (dedup.assign_docs): MinHash signature and LSH
+    # buckets of every document with words, and the canonical document
+    # of the cluster of every document, itself if it has no copies
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS doc_minhash (
+            doc_id INTEGER PRIMARY KEY,
+            signature BLOB
+        )''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS doc_band (
+            band INTEGER,
+            bucket INTEGER,
+            doc_id INTEGER,
+            PRIMARY KEY (band, bucket, doc_id)
+        ) WITHOUT ROWID''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS doc_cluster (
+            doc_id INTEGER PRIMARY KEY,
+            canonical_id INTEGER
+        )''')
+    # Trends (trending.py): stories of topics per hour, and documents
+    # per hour and per day of the top terms of documents
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS trend_topic (
+            hour INTEGER,
+            topic_id INTEGER,
+            docs INTEGER,
+            PRIMARY KEY (hour, topic_id)
+        ) WITHOUT ROWID''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS trend_term (
+            width INTEGER,
+            bucket INTEGER,
+            word VARCHAR(255),
+            docs INTEGER,
+            PRIMARY KEY (width, bucket, word)
+        ) WITHOUT ROWID''')
+    # Full-text indexes of documents and topic names, rowid is the id
+    # of the row in doc / topic, text is stored folded (search.fold)
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS doc_fts USING fts5 (
+            Heading,
+            text,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )''')
+    cur.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS topic_fts USING fts5 (
+            name,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )''')
+    # Topics chats subscribed to (notify.py), by topic URL since ids
+    # change with full loads, and the new documents of these topics
+    # waiting to be pushed. Kept by full loads, see swap.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS subscription (
+            topic_url VARCHAR(255),
+            chat_id INTEGER,
+            PRIMARY KEY (topic_url, chat_id)
+        ) WITHOUT ROWID''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS notification (
+            id INTEGER PRIMARY KEY,
+            topic_url VARCHAR(255),
+            doc_url VARCHAR(255)
+        )''')
+    cur.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS touched_topic (
+            topic_id INTEGER PRIMARY KEY
+        )''')
+    # Values describing the database itself, like the ingest
+    # generation, kept by full rebuilds
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key VARCHAR(255) PRIMARY KEY,
+            value
+        )''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS fetch_state (
+            url VARCHAR(255) PRIMARY KEY,
+            etag VARCHAR(255),
+            last_modified VARCHAR(255),
+            content_hash VARCHAR(40),
+            last_seen DATE
+        )''')
 
-    # Send the current transaction.
-    conn.commit()
+
+def create_indexes(cur, unique_only=False):
+    """
+    Create the missing indexes of INDEXES
+    :param cur: A Cursor instance
+    :param unique_only: create only the unique indexes, which upserts
+                        and id lookups need during a load; the others
+                        are deferred until the load is done
+    """
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    existing = {row[0] for row in cur.fetchall()}
+    for name, (table, column, unique) in INDEXES.items():
+        if name in existing or (unique_only and not unique):
+            continue
+        if unique:
+            # Databases built before the index existed may hold
+            # duplicates, keep the newest row of each value.
+            cur.execute('''
+                DELETE FROM {0} WHERE id NOT IN (
+                    SELECT MAX(id) FROM {0} GROUP BY {1})'''.format(
+                table, column))
+        cur.execute('CREATE {}INDEX {} ON {} ({})'.format(
+            'UNIQUE ' if unique else '', name, table, column))
 
 
-def add_topics(cur):
+def migrate(cur):
     """
-    Insert data into table topic
+    Fill the tables added after a database was created:
+    topic_doc from the newline-joined headings in topic.articles,
+    the token statistics and the near-duplicate clusters of documents
+    that have none, the topic aggregates, the document frequencies,
+    the keywords, the trends
+    and the full-text indexes
     :param cur: A Cursor instance
     """
-    for item in parse.topics:
-        cur.execute('''
-            INSERT INTO topic
-            (name, url, description, articles, LastUpdateTime)
-            VALUES (?, ?, ?, ?, ?);''', (
-                item[0], item[1], item[2], item[3], item[4]))
+    cur.execute('PRAGMA table_info(doc_stats)')
+    if 'hour' not in {row[1] for row in cur.fetchall()}:
+        cur.execute('ALTER TABLE doc_stats ADD COLUMN hour INTEGER')
+
+    cur.execute('SELECT EXISTS (SELECT 1 FROM topic_doc)')
+    if not cur.fetchone()[0]:
+        cur.execute('SELECT id, articles FROM topic')
+        for topic_id, articles in cur.fetchall():
+            headings = (articles or '').split('\n')
+            for position, heading in enumerate(headings):
+                cur.execute('''
+                    INSERT INTO topic_doc (topic_id, position, doc_url)
+                    SELECT ?, ?, url FROM doc WHERE Heading = ?''', (
+                        topic_id, position, heading))
+
+    cur.execute('''
+        SELECT id, text, LastUpdateTime FROM doc
+        WHERE id NOT IN (SELECT doc_id FROM doc_stats)''')
+    for batch in parse.batched(cur.fetchall(), 500):
+        set_docs_stats(cur, [
+            (doc_id, text, parse.word_counts(text), updated)
+            for doc_id, text, updated in batch])
+
+    cur.execute('''
+        SELECT id, text FROM doc
+        WHERE id NOT IN (SELECT doc_id FROM doc_cluster)
+        ORDER BY id''')
+    unclustered = cur.fetchall()
+    for batch in parse.batched(unclustered, 500):
+        dedup.assign_docs(cur, batch)
+
+    cur.execute('SELECT EXISTS (SELECT 1 FROM topic_stats)')
+    if unclustered or not cur.fetchone()[0]:
+        rebuild_topic_stats(cur)
+
+    cur.execute('SELECT EXISTS (SELECT 1 FROM word_df)')
+    if not cur.fetchone()[0]:
+        rebuild_word_df(cur)
+
+    cur.execute('SELECT EXISTS (SELECT 1 FROM topic_keyword)')
+    if not cur.fetchone()[0]:
+        keywords.refresh(cur)
+
+    cur.execute('''
+        SELECT EXISTS (
+            SELECT 1 FROM doc_stats s JOIN doc d ON d.id = s.doc_id
+            WHERE s.hour IS NULL AND d.LastUpdateTime IS NOT NULL)''')
+    if cur.fetchone()[0]:
+        trending.rebuild(cur)
+
+    cur.execute('SELECT EXISTS (SELECT 1 FROM doc_fts)')
+    if not cur.fetchone()[0]:
+        cur.execute('SELECT id, Heading, text FROM doc')
+        index_docs(cur, cur.fetchall())
+    cur.execute('SELECT EXISTS (SELECT 1 FROM topic_fts)')
+    if not cur.fetchone()[0]:
+        cur.execute('SELECT id, name FROM topic')
+        index_topics(cur, cur.fetchall())
+
+
+def load_state(cur):
+    """
+    Read the URL state of the previous crawl
+    :param cur: A Cursor instance
+    return: dict url -> parse.UrlState
+    """
+    cur.execute('''
+        SELECT url, etag, last_modified, content_hash, last_seen
+        FROM fetch_state''')
+    return {row[0]: parse.UrlState(*row[1:]) for row in cur.fetchall()}
+
+
+def load_listings(cur):
+    """
+    Read the article listings of the topics as of the previous crawl,
+    for parse.crawl
+    :param cur: A Cursor instance
+    return: dict topic url -> list of (article url, heading, update
+            time), heading and time None for articles not stored
+    """
+    cur.execute('''
+        SELECT t.url, td.doc_url, d.Heading, d.LastUpdateTime
+        FROM topic t
+        JOIN topic_doc td ON td.topic_id = t.id
+        LEFT JOIN doc d ON d.url = td.doc_url
+        ORDER BY t.id, td.position''')
+    listings = defaultdict(list)
+    for topic_url, doc_url, heading, updated in cur.fetchall():
+        if isinstance(updated, str):
+            updated = datetime.fromisoformat(updated)
+        listings[topic_url].append((doc_url, heading, updated))
+    return dict(listings)
+
+
+def save_state(cur, state):
+    """
+    Store the URL state of the crawl
+    :param cur: A Cursor instance
+    :param state: dict url -> parse.UrlState
+    """
+    rows = ((url,) + tuple(item) for url, item in state.items())
+    cur.executemany('''
+        INSERT INTO fetch_state
+        (url, etag, last_modified, content_hash, last_seen)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (url) DO UPDATE SET
+            etag = excluded.etag,
+            last_modified = excluded.last_modified,
+            content_hash = excluded.content_hash,
+            last_seen = excluded.last_seen''', rows)
+
+
+# Conflict clauses of add_topics and add_docs
+UPSERT_TOPIC = '''
+    ON CONFLICT (url) DO UPDATE SET
+        name = excluded.name,
+        description = excluded.description,
+        articles = excluded.articles,
+        LastUpdateTime = excluded.LastUpdateTime'''
+UPSERT_DOC = '''
+    ON CONFLICT (url) DO UPDATE SET
+        Heading = excluded.Heading,
+        LastUpdateTime = excluded.LastUpdateTime,
+        text = excluded.text,
+        tags = excluded.tags'''
+
+# Tables keyed by topic id and by document id
+TOPIC_TABLES = ('topic_doc', 'topic_stats', 'topic_word', 'topic_len',
+                'topic_keyword')
+DOC_TABLES = ('doc_stats', 'doc_word', 'doc_len')
+
+
+def replaced_rows(cur, table, key, items):
+    """
+    Find the rows that items are about to replace: rows with the url
+    of an item, updated in place, and rows holding the unique key of
+    an item under another url, which are deleted.
+    Items are deduplicated by url and key, the last one wins.
+    :param cur: A Cursor instance
+    :param table: topic or doc
+    :param key: name or Heading
+    :param items: list of parse.Topic or parse.Doc
+    return: deduplicated items, ids of all replaced rows,
+            ids of the rows to delete
+    """
+    items = list({item.url: item for item in items}.values())
+    items = list({getattr(item, key): item for item in items}.values())
+    urls = {getattr(item, key): item.url for item in items}
+    cur.execute(
+        'SELECT id, url, {1} FROM {0} WHERE url IN ({2}) OR {1} IN ({2})'
+        .format(table, key, ', '.join('?' * len(items))),
+        list(urls.values()) + list(urls))
+    rows = cur.fetchall()
+    deleted = tuple(
+        row[0] for row in rows if urls.get(row[2], row[1]) != row[1])
+    return items, tuple(row[0] for row in rows), deleted
+
+
+def add_topics(cur, topics, incremental=True):
+    """
+    Insert new topics into table topic and update the changed ones,
+    together with their documents in table topic_doc.
+    A topic taking the name of a known topic replaces it.
+    Incremental loads queue the documents new to subscribed topics in
+    table notification.
+    :param cur: A Cursor instance
+    :param topics: list of parse.Topic
+    :param incremental: keep the topic aggregates up to date
+    """
+    if not topics:
+        return
+    topics, old_ids, deleted = replaced_rows(cur, 'topic', 'name', topics)
+    # Documents subscribers were already told about
+    listed = subscribed_docs(cur, old_ids) if incremental else set()
+    # Membership and aggregates of replaced topics are rebuilt below
+    for table in TOPIC_TABLES:
+        cur.executemany('DELETE FROM {} WHERE topic_id = ?'.format(table),
+                        ((topic_id,) for topic_id in old_ids))
+    cur.executemany('DELETE FROM topic_fts WHERE rowid = ?',
+                    ((topic_id,) for topic_id in old_ids))
+    cur.executemany('DELETE FROM topic WHERE id = ?',
+                    ((topic_id,) for topic_id in deleted))
+
+    rows = (item[:5] for item in topics)
+    cur.executemany('''
+        INSERT INTO topic
+        (name, url, description, articles, LastUpdateTime)
+        VALUES (?, ?, ?, ?, ?)''' + UPSERT_TOPIC, rows)
+
+    cur.execute(
+        'SELECT url, id FROM topic WHERE url IN ({})'.format(
+            ', '.join('?' * len(topics))),
+        [item.url for item in topics])
+    topic_ids = dict(cur.fetchall())
+    cur.executemany('''
+        INSERT INTO topic_doc (topic_id, position, doc_url)
+        VALUES (?, ?, ?)''', (
+            (topic_ids[item.url], position, url)
+            for item in topics
+            for position, url in enumerate(item.article_urls)))
+    index_topics(cur, ((topic_ids[item.url], item.name) for item in topics))
+    if incremental:
+        queue_notifications(
+            cur, subscribed_docs(cur, tuple(topic_ids.values())) - listed)
+        cur.executemany(
+            'INSERT OR IGNORE INTO temp.touched_topic (topic_id) VALUES (?)',
+            ((topic_id,) for topic_id in topic_ids.values()))
+
+
+def subscribed_docs(cur, topic_ids=None):
+    """
+    Documents listed by the topics chats subscribed to
+    :param cur: A Cursor instance
+    :param topic_ids: ids of the topics to look at, None for all
+    return: set of (topic url, document url)
+    """
+    if topic_ids is not None and not topic_ids:
+        return set()
+    query = '''
+        SELECT t.url, td.doc_url
+        FROM topic t
+        JOIN topic_doc td ON td.topic_id = t.id
+        WHERE t.url IN (SELECT topic_url FROM subscription)'''
+    if topic_ids is None:
+        cur.execute(query)
+    else:
+        cur.execute(query + ' AND t.id IN ({})'.format(
+            ', '.join('?' * len(topic_ids))), tuple(topic_ids))
+    return set(cur.fetchall())
+
+
+def queue_notifications(cur, pairs):
+    """
+    Queue new documents of subscribed topics for notify.Notifier
+    :param cur: A Cursor instance
+    :param pairs: iterable of (topic url, document url)
+    """
+    cur.executemany(
+        'INSERT INTO notification (topic_url, doc_url) VALUES (?, ?)',
+        sorted(pairs))
+
+
+def add_docs(cur, articles, incremental=True):
+    """
+    Insert new documents into table doc and update the changed ones,
+    together with their token statistics and near-duplicate clusters.
+    A document taking the heading of a known document replaces it.
+    :param cur: A Cursor instance
+    :param articles: list of parse.Doc
+    :param incremental: keep the topic aggregates up to date
+    """
+    if not articles:
+        return
+    articles, old_ids, deleted = replaced_rows(
+        cur, 'doc', 'Heading', articles)
+    if incremental and old_ids:
+        touch_cluster_topics(cur, old_ids)
+    for doc_id in old_ids:
+        dedup.remove(cur, doc_id)
+    clear_docs_stats(cur, deleted)
+    cur.executemany('DELETE FROM doc WHERE id = ?',
+                    ((doc_id,) for doc_id in deleted))
+    cur.executemany('DELETE FROM doc_fts WHERE rowid = ?',
+                    ((doc_id,) for doc_id in old_ids))
+
+    rows = (item[:5] for item in articles)
+    cur.executemany('''
+        INSERT INTO doc
+        (url, Heading, LastUpdateTime, text, tags)
+        VALUES (?, ?, ?, ?, ?)''' + UPSERT_DOC, rows)
+
+    marks = ', '.join('?' * len(articles))
+    cur.execute(
+        'SELECT url, id FROM doc WHERE url IN ({})'.format(marks),
+        [item.url for item in articles])
+    doc_ids = dict(cur.fetchall())
+    set_docs_stats(cur, [
+        (doc_ids[item.url], item.text, item.words, item.LastUpdateTime)
+        for item in articles])
+    dedup.assign_docs(
+        cur, [(doc_ids[item.url], item.text) for item in articles])
+    index_docs(cur, (
+        (doc_ids[item.url], item.Heading, item.text) for item in articles))
+    if incremental:
+        touch_cluster_topics(cur, tuple(doc_ids.values()))
+
+
+def index_docs(cur, rows):
+    """
+    Add documents to the full-text index doc_fts
+    :param cur: A Cursor instance
+    :param rows: iterable of (id, Heading, text)
+    """
+    cur.executemany(
+        'INSERT INTO doc_fts (rowid, Heading, text) VALUES (?, ?, ?)',
+        ((doc_id, search.fold(heading), search.fold(text))
+         for doc_id, heading, text in rows))
+
+
+def index_topics(cur, rows):
+    """
+    Add topic names to the full-text index topic_fts
+    :param cur: A Cursor instance
+    :param rows: iterable of (id, name)
+    """
+    cur.executemany(
+        'INSERT INTO topic_fts (rowid, name) VALUES (?, ?)',
+        ((topic_id, search.fold(name)) for topic_id, name in rows))
 
 
-def add_docs(cur):
+def touch_cluster_topics(cur, doc_ids):
     """
-    Insert data to table doc
+    Remember in temp.touched_topic the topics listing the documents or
+    any near-duplicate of them, whose stories change with them
     :param cur: A Cursor instance
+    :param doc_ids: ids of clustered documents
+    """
+    query = '''
+        INSERT OR IGNORE INTO temp.touched_topic (topic_id)
+        SELECT td.topic_id
+        FROM doc_cluster c
+        JOIN doc_cluster m ON m.canonical_id = c.canonical_id
+        JOIN doc d ON d.id = m.doc_id
+        JOIN topic_doc td ON td.doc_url = d.url
+        WHERE c.doc_id IN ({})'''
+    cur.execute(query.format(', '.join('?' * len(doc_ids))), tuple(doc_ids))
+
+
+def update_topic_stats(cur, touched_only=True):
     """
-    for item in parse.articles:
+    Recompute the aggregates of topics from their stories: a cluster of
+    near-duplicates listed by a topic counts once, with the statistics
+    of its canonical document
+    :param cur: A Cursor instance
+    :param touched_only: only the topics in temp.touched_topic
+    """
+    # Condition on the topic id column {}
+    scope = 'true'
+    if touched_only:
+        scope = '{} IN (SELECT topic_id FROM temp.touched_topic)'
+    for table in ('topic_stats', 'topic_word', 'topic_len'):
+        cur.execute('DELETE FROM {} WHERE {}'.format(
+            table, scope.format('topic_id')))
+    stories = '''(SELECT DISTINCT td.topic_id, c.canonical_id AS doc_id
+                   FROM topic_doc td
+                   JOIN doc d ON d.url = td.doc_url
+                   JOIN doc_cluster c ON c.doc_id = d.id
+                   WHERE {}) t'''.format(scope.format('td.topic_id'))
+    cur.execute('''
+        INSERT INTO topic_stats (topic_id, docs, text_length)
+        SELECT t.topic_id, COUNT(*), SUM(s.text_length)
+        FROM {}
+        JOIN doc_stats s ON s.doc_id = t.doc_id
+        GROUP BY t.topic_id'''.format(stories))
+    for table, source, column in (('topic_word', 'doc_word', 'word'),
+                                  ('topic_len', 'doc_len', 'length')):
         cur.execute('''
-            INSERT INTO doc
-            (url, Heading, LastUpdateTime, text, tags)
-            VALUES (?, ?, ?, ?, ?);''', (
-                item[0], item[1], item[2], item[3], item[4]))
-
-
-with sqlite3.connect('data.db') as conn:
-    query_for_doc = '''SELECT Heading
-               FROM doc
-               ORDER BY LastUpdateTime DESC
-               '''
-    query_for_topic = '''SELECT name
-               FROM topic
-               ORDER BY LastUpdateTime DESC
-               '''
+            INSERT INTO {0} (topic_id, {2}, count)
+            SELECT t.topic_id, s.{2}, SUM(s.count)
+            FROM {3}
+            JOIN {1} s ON s.doc_id = t.doc_id
+            GROUP BY t.topic_id, s.{2}'''.format(
+                table, source, column, stories))
+
+
+def rebuild_topic_stats(cur):
+    """
+    Compute all topic aggregates from scratch
+    :param cur: A Cursor instance
+    """
+    update_topic_stats(cur, touched_only=False)
+
+
+def clear_docs_stats(cur, doc_ids):
+    """
+    Delete the token statistics of documents and remove their terms
+    from the document frequencies of table word_df and from the trends
+    :param cur: A Cursor instance
+    :param doc_ids: ids of the documents, as many as a batch of records
+    """
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return
+    marks = ', '.join('?' * len(doc_ids))
+    cur.execute('SELECT doc_id, hour FROM doc_stats WHERE doc_id IN ({})'
+                .format(marks), doc_ids)
+    hours = dict(cur.fetchall())
+    cur.execute('''
+        SELECT doc_id, word, count FROM doc_word
+        WHERE doc_id IN ({}) ORDER BY doc_id'''.format(marks), doc_ids)
+    words = {doc_id: {row[1]: row[2] for row in rows}
+             for doc_id, rows in groupby(cur.fetchall(), key=itemgetter(0))}
+    trending.count_docs(cur, (
+        (hours[doc_id], items) for doc_id, items in words.items()
+        if doc_id in hours), sign=-1)
+    df = Counter(term for items in words.values()
+                 for term in keywords.terms(items))
+    cur.executemany('UPDATE word_df SET docs = docs - ? WHERE word = ?',
+                    ((docs, term) for term, docs in df.items()))
+    cur.executemany('DELETE FROM word_df WHERE word = ? AND docs <= 0',
+                    ((term,) for term in df))
+    for table in DOC_TABLES:
+        cur.execute('DELETE FROM {} WHERE doc_id IN ({})'.format(
+            table, marks), doc_ids)
+
+
+def set_docs_stats(cur, docs):
+    """
+    Replace the token statistics of documents, with one executemany per
+    table for all of them
+    :param cur: A Cursor instance
+    :param docs: list of (id, text, word frequencies of the text, see
+                 parse.word_counts, LastUpdateTime: its bucket in the
+                 trends, None to leave it out), as many as a batch of
+                 records
+    """
+    clear_docs_stats(cur, (item[0] for item in docs))
+    stats, doc_words, doc_lens, trends = [], [], [], []
+    df = Counter()
+    for doc_id, text, words, updated in docs:
+        lengths = defaultdict(int)
+        for word, count in words.items():
+            lengths[len(word)] += count
+            doc_words.append((doc_id, word, count))
+        doc_lens.extend((doc_id, length, count)
+                        for length, count in lengths.items())
+        hour = trending.hour_of(updated)
+        stats.append((doc_id, len(text), sum(words.values()), hour))
+        trends.append((hour, words))
+        df.update(keywords.terms(words))
+    cur.executemany('''
+        INSERT INTO doc_stats (doc_id, text_length, words, hour)
+        VALUES (?, ?, ?, ?)''', stats)
+    cur.executemany(
+        'INSERT INTO doc_word (doc_id, word, count) VALUES (?, ?, ?)',
+        doc_words)
+    cur.executemany(
+        'INSERT INTO doc_len (doc_id, length, count) VALUES (?, ?, ?)',
+        doc_lens)
+    cur.executemany('''
+        INSERT INTO word_df (word, docs) VALUES (?, ?)
+        ON CONFLICT (word) DO UPDATE SET docs = docs + excluded.docs''',
+                    df.items())
+    trending.count_docs(cur, trends)
+
+
+def rebuild_word_df(cur):
+    """
+    Compute the document frequencies of table word_df from scratch
+    :param cur: A Cursor instance
+    """
+    df = defaultdict(int)
+    cur.execute('SELECT doc_id, word FROM doc_word ORDER BY doc_id')
+    for _, rows in groupby(cur.fetchall(), key=itemgetter(0)):
+        for term in keywords.terms(row[1] for row in rows):
+            df[term] += 1
+    cur.execute('DELETE FROM word_df')
+    cur.executemany(
+        'INSERT INTO word_df (word, docs) VALUES (?, ?)', df.items())
+
+
+def bump_generation(cur):
+    """
+    Increment the ingest generation, which tells readers that their
+    cached results are outdated (see storage.generation)
+    :param cur: A Cursor instance
+    """
+    cur.execute('''
+        INSERT INTO meta (key, value) VALUES ('generation', 1)
+        ON CONFLICT (key) DO UPDATE SET value = value + 1''')
+
+
+def touched_topics(cur):
+    """
+    Return and forget the ids of the topics whose aggregates changed
+    since the last call
+    :param cur: A Cursor instance
+    """
+    cur.execute('SELECT topic_id FROM temp.touched_topic')
+    topic_ids = [row[0] for row in cur.fetchall()]
+    cur.execute('DELETE FROM temp.touched_topic')
+    return topic_ids
+
+
+def ingest(cur, records, batch_size=500, incremental=True):
+    """
+    Insert records chunk by chunk with executemany
+    :param cur: A Cursor instance, inside a transaction
+    :param records: iterable of parse.Topic and parse.Doc
+    :param batch_size: number of records inserted at once
+    :param incremental: keep the topic aggregates up to date
+    return: number of topics, number of documents,
+            seconds spent writing
+    """
+    number_topics = number_docs = 0
+    seconds = 0.0
+    for batch in parse.batched(records, batch_size):
+        start = time.perf_counter()
+        topics = [item for item in batch if isinstance(item, parse.Topic)]
+        articles = [item for item in batch if isinstance(item, parse.Doc)]
+        add_topics(cur, topics, incremental)
+        add_docs(cur, articles, incremental)
+        number_topics += len(topics)
+        number_docs += len(articles)
+        seconds += time.perf_counter() - start
+    return number_topics, number_docs, seconds
+
+
+def spool(records, batch_size=500):
+    """
+    Consume records into a temporary file, batch by batch, so that an
+    incremental load crawls before its write transaction rather than
+    inside it: the write lock is held for the writes only
+    :param records: iterable of parse.Topic and parse.Doc
+    :param batch_size: number of records pickled at once
+    return: iterator over the records read back
+    """
+    file = tempfile.TemporaryFile()
+    try:
+        for batch in parse.batched(records, batch_size):
+            pickle.dump(batch, file, pickle.HIGHEST_PROTOCOL)
+        file.seek(0)
+    except BaseException:
+        file.close()
+        raise
+    return unspool(file)
+
+
+def unspool(file):
+    """Records of a file written by spool, which is closed at the end"""
+    with file:
+        while True:
+            try:
+                batch = pickle.load(file)
+            except EOFError:
+                return
+            yield from batch
+
+
+def load(conn, records, full=False, batch_size=500, state=None):
+    """
+    Write records into the database in one explicit transaction.
+    An incremental load consumes the records (e.g. the crawl) before
+    the transaction starts, see spool; a full load builds a shadow
+    database no one else writes (see rebuild) and consumes them in it.
+    A full load drops the tables and builds the non-unique indexes and
+    the topic aggregates only at the end. An incremental load
+    recomputes the aggregates of the topics whose documents changed,
+    then the keywords of these topics.
+    Readers keep seeing the old rows until the commit, which bumps
+    the ingest generation so that their caches are emptied.
+    :param conn: A SQLite database connection
+    :param records: iterable of parse.Topic and parse.Doc
+    :param full: drop the tables and rebuild everything
+    :param batch_size: number of records inserted at once
+    :param state: dict url -> parse.UrlState to store, filled by
+                  records while they are consumed
+    return: number of rows written
+    """
+    tune(conn)
+    if not full:
+        records = spool(records, batch_size)
     cur = conn.cursor()
+    cur.execute('BEGIN')
+    try:
+        create_tables(cur, drop=full)
+        create_indexes(cur, unique_only=full)
+        if not full:
+            migrate(cur)
+        number_topics, number_docs, seconds = ingest(
+            cur, records, batch_size, incremental=not full)
+        start = time.perf_counter()
+        if full:
+            rebuild_topic_stats(cur)
+            create_indexes(cur)
+        else:
+            update_topic_stats(cur)
+        trending.update_topics(cur, touched_only=not full)
+        trending.prune(cur)
+        # Untouched topics keep the scores of their last refresh: the
+        # document frequencies drift slowly, a full load recomputes all
+        touched = touched_topics(cur)
+        if full:
+            keywords.refresh(cur)
+        elif touched:
+            keywords.refresh(cur, touched)
+        if state is not None:
+            save_state(cur, state)
+        bump_generation(cur)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    seconds += time.perf_counter() - start
+    rows = number_topics + number_docs
+    mode = 'full' if full else 'incremental'
+    LOAD_SECONDS.observe(seconds, mode)
+    LOADED_ROWS.inc(mode, amount=rows)
+    logger.info(
+        'Wrote %d topics and %d documents in %.3fs (%.0f rows/sec)',
+        number_topics, number_docs, seconds, rows / seconds if seconds else 0)
+    return rows
 
-    create_tables(cur, conn)
 
-    add_topics(cur)
-    add_docs(cur)
+# Write a value of table meta
+SET_META = '''
+    INSERT INTO meta (key, value) VALUES (?, ?)
+    ON CONFLICT (key) DO UPDATE SET value = excluded.value'''
 
-    cur.execute(query_for_doc)
-    cur.execute(query_for_topic)
 
+def database_path(conn):
+    """
+    File of the main database of the connection
+    :param conn: A SQLite database connection
+    return: path, '' for an in-memory database
+    """
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+
+@contextmanager
+def swap_lock(conn, exclusive=False):
+    """
+    Lock file next to the database: the writes of the subscriptions
+    and notifications (see notify.py) hold it shared, swap holds it
+    exclusive from reading these rows to the end of the copy, which
+    the backup API cannot run inside a transaction of conn
+    :param conn: A SQLite database connection
+    :param exclusive: lock of swap
+    """
+    path = database_path(conn)
+    if not path:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def swap(shadow, conn):
+    """
+    Replace the whole content of the database of conn by the one of
+    shadow with the SQLite backup API. The copy is one write
+    transaction: readers see the old database until it commits, then
+    the new one. Table meta of conn is kept, with the ingest
+    generation bumped, and so are the subscriptions and their pending
+    notifications, none of them written meanwhile (see swap_lock); the
+    documents new to subscribed topics are queued.
+    :param shadow: connection to the new database
+    :param conn: connection to the database read by the bot
+    """
+    conn.commit()
+    with swap_lock(conn, exclusive=True):
+        meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+        meta['generation'] = meta.get('generation', 0) + 1
+        subscriptions = conn.execute(
+            'SELECT topic_url, chat_id FROM subscription').fetchall()
+        pending = conn.execute(
+            'SELECT id, topic_url, doc_url FROM notification').fetchall()
+        listed = subscribed_docs(conn.cursor())
+        shadow.executemany(SET_META, meta.items())
+        shadow.executemany(
+            'INSERT INTO subscription (topic_url, chat_id) VALUES (?, ?)',
+            subscriptions)
+        shadow.executemany('''
+            INSERT INTO notification (id, topic_url, doc_url)
+            VALUES (?, ?, ?)''', pending)
+        queue_notifications(shadow.cursor(),
+                            subscribed_docs(shadow.cursor()) - listed)
+        shadow.commit()
+        shadow.backup(conn)
+
+
+def rebuild(conn, records, batch_size=500, state=None):
+    """
+    Full load into a shadow database, a new file next to the database
+    of conn, swapped into place when complete (see swap), so that readers never
+    see a partly built corpus and are not slowed down by the load.
+    In-memory databases are loaded in place.
+    :param conn: A SQLite database connection
+    :param records: iterable of parse.Topic and parse.Doc
+    :param batch_size: number of records inserted at once
+    :param state: see load
+    return: number of rows written
+    """
+    path = database_path(conn)
+    if not path:
+        return load(conn, records, True, batch_size, state)
+    cur = conn.cursor()
+    cur.execute('BEGIN')
+    create_tables(cur)
     conn.commit()
+
+    # A file of its own, so that concurrent rebuilds do not remove the
+    # shadow of each other
+    fd, shadow_path = tempfile.mkstemp(
+        '.shadow', os.path.basename(path) + '.', os.path.dirname(path))
+    os.close(fd)
+    shadow = sqlite3.connect(shadow_path)
+    try:
+        rows = load(shadow, records, True, batch_size, state)
+        start = time.perf_counter()
+        swap(shadow, conn)
+        logger.info('Swapped the new database in %.3fs',
+                    time.perf_counter() - start)
+    finally:
+        shadow.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(shadow_path + suffix):
+                os.remove(shadow_path + suffix)
+    return rows
+
+
+def record_refresh(conn, seconds, error=None):
+    """
+    Store the outcome of a refresh in table meta, for
+    storage.refresh_status
+    :param conn: A SQLite database connection
+    :param seconds: duration of the refresh
+    :param error: exception that made the refresh fail, None if it
+                  succeeded
+    """
+    if error is None:
+        rows = [
+            ('last_refresh', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+            ('refresh_seconds', seconds),
+        ]
+    else:
+        rows = [('last_error', repr(error))]
+    cur = conn.cursor()
+    cur.execute('BEGIN')
+    create_tables(cur)
+    cur.executemany(SET_META, rows)
+    if error is not None:
+        cur.execute('''
+            INSERT INTO meta (key, value) VALUES ('refresh_errors', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1''')
+    conn.commit()
+
+
+def sync(conn, url=parse.url1, full=False, batch_size=500, fetcher=None,
+         workers=1):
+    """
+    Crawl the site and write the result into the database.
+    Incremental by default: conditional requests against the stored
+    URL state, for the articles of the stored listings too, and only
+    new or changed rows are written.
+    Records are consumed from parse.records in batches, spooled to a
+    temporary file while the site is crawled (see spool), so memory is
+    bounded by batch_size rather than by the size of the site.
+    :param conn: A SQLite database connection
+    :param url: URL of the story index or list of them, see
+                parse.crawl
+    :param full: rebuild everything in a shadow database, see rebuild
+    :param batch_size: number of records inserted at once
+    :param fetcher: crawler.Fetcher, e.g. one keeping snapshots, a
+                    default one if None
+    :param workers: number of processes parsing the pages, see
+                    parse.records
+    return: number of rows written
+    """
+    state = {}
+    if full:
+        # A source failing aborts, the rebuild would drop its rows
+        records = parse.records(url, fetcher, state, workers, strict=True)
+        return rebuild(conn, records, batch_size, state)
+    cur = conn.cursor()
+    cur.execute('BEGIN')
+    create_tables(cur)
+    state = load_state(cur)
+    listings = load_listings(cur)
+    conn.commit()
+    records = parse.records(url, fetcher, state, workers, listings)
+    return load(conn, records, full, batch_size, state)
+
+
+def replay(conn, store, url=parse.url1, at=None, batch_size=500,
+           workers=1):
+    """
+    Rebuild the database from the pages of a snapshot store, without
+    network: the crawl runs as usual but every page is the last
+    snapshot of its URL, see snapshots.ReplayFetcher
+    :param conn: A SQLite database connection
+    :param store: snapshots.SnapshotStore
+    :param url: URL of the story index or list of them, see
+                parse.crawl
+    :param at: datetime, rebuild the site as it was fetched until then
+    :param batch_size: number of records inserted at once
+    :param workers: see sync
+    return: number of rows written
+    """
+    fetcher = snapshots.ReplayFetcher(store, at)
+    rows = sync(conn, url, True, batch_size, fetcher, workers)
+    if fetcher.missing:
+        logger.warning('%d pages had no snapshot', fetcher.missing)
+    return rows
+
+
+def main():
+    """Parse site into data.db"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        '--full', action='store_true',
+        help='re-crawl everything into a new database, then swap it in')
+    parser.add_argument('--db', default=storage.DB_PATH,
+                        help='database path')
+    parser.add_argument(
+        '--url', action='append',
+        help='story index, repeat to crawl several sources at once, '
+             'name=URL for a copy of a known source (default: rbc.ru)')
+    parser.add_argument(
+        '--snapshots', default=os.environ.get('NEWSBOT_SNAPSHOTS'),
+        help='directory keeping the raw pages fetched')
+    parser.add_argument(
+        '--replay', action='store_true',
+        help='rebuild from the pages in --snapshots, without network')
+    parser.add_argument(
+        '--at', type=datetime.fromisoformat,
+        help='with --replay, use the pages fetched until this time')
+    parser.add_argument(
+        '--parse-workers', type=int,
+        default=int(os.environ.get('NEWSBOT_PARSE_WORKERS', 1)),
+        help='processes parsing the pages')
+    args = parser.parse_args()
+    args.url = args.url or [parse.url1]
+    if args.replay and not args.snapshots:
+        parser.error('--replay needs --snapshots')
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    store = None
+    if args.snapshots:
+        store = snapshots.SnapshotStore(args.snapshots)
+    with sqlite3.connect(args.db) as conn:
+        if args.replay:
+            replay(conn, store, args.url, args.at,
+                   workers=args.parse_workers)
+        else:
+            fetcher = Fetcher(snapshots=store)
+            try:
+                sync(conn, args.url, args.full, fetcher=fetcher,
+                     workers=args.parse_workers)
+            finally:
+                fetcher.close()
+    if store is not None:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import logging
+import zlib
+from collections import defaultdict
+import numpy as np
+import search
+
+
+logger = logging.getLogger(__name__)
+
+# Words per shingle, documents are sets of shingles
+SHINGLE = 3
+# MinHash permutations = BANDS * ROWS: two documents become candidates
+# when all ROWS values of one band agree, likely from a Jaccard
+# similarity of about (1 / BANDS) ** (1 / ROWS) = 0.5 on
+BANDS = 16
+ROWS = 4
+# Estimated Jaccard similarity of the shingles of near-duplicates
+THRESHOLD = 0.8
+# Prime above 2 ** 32: shingle hashes are 32-bit
+PRIME = 4294967311
+# Universal hash functions (a * x + b) % PRIME, fixed so that
+# signatures stay comparable between runs
+_rng = np.random.RandomState(20210516)
+A = _rng.randint(1, 1 << 31, BANDS * ROWS).astype(np.uint64)
+B = _rng.randint(0, 1 << 31, BANDS * ROWS).astype(np.uint64)
+
+
+def signature(text):
+    """
+    MinHash signature of the word shingles of a text
+    :param text: text of a document
+    return: numpy array of BANDS * ROWS uint64, None if text has no
+            words
+    """
+    words = search.words(text)
+    if not words:
+        return None
+    shingles = {' '.join(words[i:i + SHINGLE])
+                for i in range(max(1, len(words) - SHINGLE + 1))}
+    hashes = np.fromiter(
+        (zlib.crc32(item.encode('utf-8')) for item in shingles),
+        np.uint64, len(shingles))
+    return ((np.outer(A, hashes) + B[:, None]) % PRIME).min(axis=1)
+
+
+def similarity(first, second):
+    """
+    Estimated Jaccard similarity of the documents of two signatures
+    """
+    return float(np.mean(first == second))
+
+
+def buckets(sig):
+    """
+    LSH buckets of a signature, one per band
+    return: list of (band, bucket)
+    """
+    return [(band, zlib.crc32(sig[band * ROWS:(band + 1) * ROWS].tobytes()))
+            for band in range(BANDS)]
+
+
+def assign_docs(cur, docs):
+    """
+    Cluster new documents: the candidates sharing a bucket with one
+    are the documents of table doc_band, looked up once for all of
+    them, and the documents before it in docs. It joins the cluster of
+    the most similar one above THRESHOLD, or starts its own. The
+    canonical document of a cluster is its first document.
+    :param cur: A Cursor instance
+    :param docs: list of (id, text) of documents not clustered yet,
+                 as many as a batch of records
+    return: list of the ids of the canonical documents of their
+            clusters
+    """
+    signatures = [(doc_id, signature(text)) for doc_id, text in docs]
+    pairs = {doc_id: buckets(sig) for doc_id, sig in signatures
+             if sig is not None}
+    # (band, bucket) -> list of (doc id, signature, canonical id)
+    candidates = defaultdict(list)
+    if pairs:
+        cur.execute('DROP TABLE IF EXISTS temp.new_band')
+        cur.execute('''
+            CREATE TEMP TABLE new_band (band INTEGER, bucket INTEGER,
+                                        PRIMARY KEY (band, bucket))''')
+        cur.executemany(
+            'INSERT OR IGNORE INTO temp.new_band (band, bucket) VALUES (?, ?)',
+            (pair for items in pairs.values() for pair in items))
+        cur.execute('''
+            SELECT b.band, b.bucket, b.doc_id, m.signature, c.canonical_id
+            FROM temp.new_band n
+            JOIN doc_band b ON b.band = n.band AND b.bucket = n.bucket
+            JOIN doc_minhash m ON m.doc_id = b.doc_id
+            JOIN doc_cluster c ON c.doc_id = b.doc_id''')
+        for band, bucket, doc_id, other, canonical_id in cur.fetchall():
+            candidates[band, bucket].append(
+                (doc_id, np.frombuffer(other, np.uint64), canonical_id))
+        cur.execute('DROP TABLE temp.new_band')
+
+    canonical_ids = []
+    for doc_id, sig in signatures:
+        canonical_id = doc_id
+        if sig is not None:
+            # Most similar first, then the oldest cluster
+            best = None
+            seen = set()
+            for pair in pairs[doc_id]:
+                for other_id, other, other_canonical in candidates[pair]:
+                    if other_id in seen:
+                        continue
+                    seen.add(other_id)
+                    score = similarity(sig, other)
+                    if score >= THRESHOLD and (
+                            best is None or (-score, other_canonical) < best):
+                        best = (-score, other_canonical)
+            if best is not None:
+                canonical_id = best[1]
+            for pair in pairs[doc_id]:
+                candidates[pair].append((doc_id, sig, canonical_id))
+        canonical_ids.append(canonical_id)
+
+    cur.executemany(
+        'INSERT INTO doc_minhash (doc_id, signature) VALUES (?, ?)',
+        ((doc_id, sig.tobytes()) for doc_id, sig in signatures
+         if sig is not None))
+    cur.executemany(
+        'INSERT INTO doc_band (band, bucket, doc_id) VALUES (?, ?, ?)',
+        ((band, bucket, doc_id) for doc_id, items in pairs.items()
+         for band, bucket in items))
+    cur.executemany(
+        'INSERT INTO doc_cluster (doc_id, canonical_id) VALUES (?, ?)',
+        zip((doc_id for doc_id, _ in docs), canonical_ids))
+    return canonical_ids
+
+
+def remove(cur, doc_id):
+    """
+    Take a document out of its cluster before it is deleted or its
+    text changes. When it was the canonical document, the next
+    document of the cluster becomes canonical.
+    :param cur: A Cursor instance
+    :param doc_id: id of the document
+    """
+    cur.execute('SELECT signature FROM doc_minhash WHERE doc_id = ?',
+                (doc_id,))
+    row = cur.fetchone()
+    if row is not None:
+        cur.executemany(
+            'DELETE FROM doc_band WHERE band = ? AND bucket = ? '
+            'AND doc_id = ?',
+            ((band, bucket, doc_id) for band, bucket in
+             buckets(np.frombuffer(row[0], np.uint64))))
+        cur.execute('DELETE FROM doc_minhash WHERE doc_id = ?', (doc_id,))
+    cur.execute('DELETE FROM doc_cluster WHERE doc_id = ?', (doc_id,))
+    cur.execute('''
+        UPDATE doc_cluster SET canonical_id = (
+            SELECT MIN(doc_id) FROM doc_cluster WHERE canonical_id = ?)
+        WHERE canonical_id = ?''', (doc_id, doc_id))
@@ -0,0 +1,142 @@
+import logging
+import time
+from functools import lru_cache
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Keywords kept per topic in table topic_keyword
+TOP_K = 20
+
+# Function words and words common to all news, never keywords
+STOPWORDS = frozenset('''
+    а без более больше будет будто бы был была были было быть в вам вас
+    ведь весь во вот впрочем все всего всех всю вы где говорит года году
+    да даже два для до другой его ее ей ему если есть еще же за заявил
+    здесь и из или им иногда их к как какая какой когда конечно которая
+    которые который которых кто куда ли лучше между мне много может можно
+    мой моя мы на над надо наконец нас не него нее ней нельзя нет ни
+    нибудь никогда ним них ничего но ну о об один он она они опять от
+    очень перед по под после потом потому почти при про раз разве ранее
+    с сам свою себе себя сегодня сейчас сказал со совсем сообщает сообщил
+    так также такой там тебя тем теперь то тогда того тоже только том
+    тот три тут ты у уж уже хоть хорошо чем через что чтоб чтобы чуть
+    эти этого этой этом этот эту это я
+'''.split())
+
+
+@lru_cache(maxsize=1 << 18)
+def normalize(word):
+    """
+    Light normalization of a word for keyword scoring
+    :param word: word as counted by parse.word_counts
+    return: lower-cased word with ё replaced by е, or None for
+            stopwords, numbers and words of 3 letters or less
+    """
+    word = word.lower().replace('ё', 'е')
+    if len(word) <= 3 or word.isdigit() or word in STOPWORDS:
+        return None
+    return word
+
+
+def terms(words):
+    """
+    Distinct normalized terms of words
+    :param words: iterable of words
+    return: set of terms
+    """
+    return {term for term in map(normalize, words) if term is not None}
+
+
+def refresh(cur, topic_ids=None, number_of_words=TOP_K):
+    """
+    Recompute the TF-IDF top keywords of topics in table topic_keyword.
+    Term frequencies come from the topic_word aggregates, document
+    frequencies from table word_df. Scores are computed on the sparse
+    topic x term matrix held as NumPy coordinate arrays:
+        (1 + log tf) * (1 + log((N + 1) / (df + 1)))
+    :param cur: A Cursor instance, inside a transaction
+    :param topic_ids: ids of the topics to refresh, None for all
+    :param number_of_words: keywords kept per topic
+    """
+    start = time.perf_counter()
+    if topic_ids is None:
+        cur.execute('DELETE FROM topic_keyword')
+        cur.execute('''
+            SELECT topic_id, word, count
+            FROM topic_word
+            WHERE length(word) > 3''')
+    else:
+        cur.execute('DROP TABLE IF EXISTS temp.refresh_topic')
+        cur.execute(
+            'CREATE TEMP TABLE refresh_topic (topic_id INTEGER PRIMARY KEY)')
+        cur.executemany(
+            'INSERT OR IGNORE INTO temp.refresh_topic (topic_id) VALUES (?)',
+            ((topic_id,) for topic_id in topic_ids))
+        cur.execute('''
+            DELETE FROM topic_keyword
+            WHERE topic_id IN (SELECT topic_id FROM temp.refresh_topic)''')
+        cur.execute('''
+            SELECT topic_id, word, count
+            FROM topic_word
+            WHERE topic_id IN (SELECT topic_id FROM temp.refresh_topic)
+                AND length(word) > 3''')
+
+    data = cur.fetchall()
+    if not data:
+        return
+    topic_ids, words, counts = zip(*data)
+    # Map words to columns of normalized terms, normalizing every
+    # distinct word once, -1 for words that are no terms
+    columns = {}
+    col_of = {}
+    for word in dict.fromkeys(words):
+        term = normalize(word)
+        col_of[word] = -1 if term is None else columns.setdefault(
+            term, len(columns))
+    cols = np.fromiter(map(col_of.__getitem__, words), np.int64, len(words))
+    keep = cols >= 0
+    if not keep.any():
+        return
+    rows = np.array(topic_ids, dtype=np.int64)[keep]
+    cols = cols[keep]
+    counts = np.array(counts, dtype=np.float64)[keep]
+    terms_of_cols = list(columns)
+
+    cur.execute('SELECT COUNT(*) FROM doc_stats')
+    number_docs = cur.fetchone()[0]
+    df = np.zeros(len(columns))
+    for index in range(0, len(terms_of_cols), 500):
+        chunk = terms_of_cols[index:index + 500]
+        cur.execute(
+            'SELECT word, docs FROM word_df WHERE word IN ({})'.format(
+                ', '.join('?' * len(chunk))), chunk)
+        for term, docs in cur.fetchall():
+            df[columns[term]] = docs
+
+    # Merge words with the same normalized form
+    keys, inverse = np.unique(
+        rows * len(columns) + cols, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts)
+    rows = keys // len(columns)
+    cols = keys % len(columns)
+
+    idf = 1 + np.log((number_docs + 1) / (df + 1))
+    scores = (1 + np.log(counts)) * idf[cols]
+
+    # Top number_of_words per topic: sort by topic, then score
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+    keep = rank < number_of_words
+
+    cur.executemany('''
+        INSERT INTO topic_keyword (topic_id, rank, word, score)
+        VALUES (?, ?, ?, ?)''', zip(
+            rows[keep].tolist(), rank[keep].tolist(),
+            (terms_of_cols[col] for col in cols[keep].tolist()),
+            scores[keep].tolist()))
+    logger.info(
+        'Keywords of %d topics over %d terms in %.3fs',
+        len(np.unique(rows)), len(columns), time.perf_counter() - start)
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram.error import RetryAfter
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Longest text of a Telegram message
+MAX_MESSAGE_LENGTH = 4096
+# Flood limits of the Bot API: about 30 messages per second overall
+# and 1 per second in a chat, short bursts being tolerated
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+# Sends of a message retried after a RetryAfter at most
+RETRIES = 3
+SEND_SECONDS = metrics.histogram(
+    'newsbot_send_seconds', 'Seconds of one request sending a message')
+
+
+def split_after(text, separator):
+    """
+    Pieces of a text, each ending after a separator
+    :param text: text to be handled
+    :param separator: e.g. '.' to split into sentences
+    yield: pieces, the last one without separator
+    """
+    start = 0
+    while start < len(text):
+        end = text.find(separator, start)
+        if end < 0:
+            yield text[start:]
+            return
+        end += len(separator)
+        yield text[start:end]
+        start = end
+
+
+def items(rows, template='{}: {}', separator=', '):
+    """
+    Pieces listing rows such as (word, count) of a histogram,
+    separated by separator
+    yield: pieces, one per row
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    while row is not None:
+        following = next(rows, None)
+        piece = template.format(*row)
+        yield piece if following is None else piece + separator
+        row = following
+
+
+def chunks(pieces, limit=MAX_MESSAGE_LENGTH):
+    """
+    Messages made of consecutive pieces, at most limit characters each:
+    every piece is copied once, so the work is linear in the length of
+    the text. A message is cut between pieces, pieces longer than limit
+    after their last space within limit, or at limit if there is none.
+    :param pieces: iterable of texts, e.g. rows or sentences
+    :param limit: length of a message at most
+    yield: messages
+    """
+    parts = []
+    size = 0
+    for piece in pieces:
+        if size + len(piece) > limit and parts:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+        start = 0
+        while len(piece) - start > limit:
+            cut = piece.rfind(' ', start, start + limit) + 1
+            if cut <= start:
+                cut = start + limit
+            yield piece[start:cut]
+            start = cut
+        if start < len(piece):
+            parts.append(piece[start:] if start else piece)
+            size += len(piece) - start
+    if parts:
+        yield ''.join(parts)
+
+
+class TokenBucket:
+    """
+    Allows rate acquisitions per second on average and burst at once
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate == float('inf'):
+            self.tokens = self.burst
+        else:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+    async def acquire(self):
+        """Wait for a token and take it"""
+        self.refill()
+        # Taken in advance, so that concurrent callers queue up behind
+        self.tokens -= 1
+        if self.tokens < 0 and self.rate != float('inf'):
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Outbox:
+    """
+    Sends the messages of the bot within the flood limits of the Bot
+    API, instead of awaiting every message of a reply before the next
+    one and getting RetryAfter errors under load. The messages of a
+    chat go out in order, one request at a time, but the rate limits
+    are counted from the start of the previous request, so a chunked
+    reply never waits for its round trips on top of the limits.
+    Chats are served concurrently, within a global limit.
+    The limits hold for one process, see webhook.run.
+    :param global_rate: messages per second to all chats, None for no
+                        limit
+    :param chat_rate: messages per second to one chat, None for no
+                      limit
+    :param chat_burst: messages sent to a chat at once at most
+    :param retries: sends of a message retried after RetryAfter
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, retries=RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._global = None
+        self._chats = {}
+        self._buckets = {}
+        self._pending = 0
+        self.sent = 0
+        self.retried = 0
+
+    def _chat(self, chat_id):
+        """Lock and token bucket of a chat, dropping idle chats"""
+        if chat_id not in self._chats:
+            if len(self._chats) >= 1024:
+                for other in list(self._chats):
+                    if (not self._chats[other].locked()
+                            and self._buckets[other].full()):
+                        del self._chats[other]
+                        del self._buckets[other]
+            self._chats[chat_id] = asyncio.Lock()
+            self._buckets[chat_id] = TokenBucket(
+                self.chat_rate or float('inf'), self.chat_burst)
+        return self._chats[chat_id], self._buckets[chat_id]
+
+    async def _send(self, bot, chat_id, text, bucket):
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                with SEND_SECONDS.time():
+                    return await bot.send_message(chat_id, text)
+            except RetryAfter as exc:
+                if attempt == self.retries:
+                    raise
+                delay = exc.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                logger.warning('Flood limit in chat %s, retry in %ss',
+                               chat_id, delay)
+                self.retried += 1
+                await asyncio.sleep(delay)
+
+    async def send(self, bot, chat_id, texts):
+        """
+        Send messages to a chat, after the messages already queued for
+        it
+        :param bot: telegram.Bot
+        :param chat_id: id of the chat
+        :param texts: iterable of messages
+        """
+        if self._global is None:
+            self._global = TokenBucket(
+                self.global_rate or float('inf'), self.global_rate or 1)
+        texts = list(texts)
+        self._pending += len(texts)
+        lock, bucket = self._chat(chat_id)
+        unsent = len(texts)
+        try:
+            async with lock:
+                for text in texts:
+                    await self._send(bot, chat_id, text, bucket)
+                    unsent -= 1
+                    self._pending -= 1
+                    self.sent += 1
+        finally:
+            self._pending -= unsent
+
+    def stats(self):
+        """
+        Load of the outbox
+        return: dict
+        """
+        return {
+            'chats': len(self._chats),
+            'pending': self._pending,
+            'sent': self.sent,
+            'retried': self.retried,
+        }
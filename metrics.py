@@ -0,0 +1,332 @@
+import bisect
+import cProfile
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+# Path of the metrics served by serve
+PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra=()):
+    """Labels of a sample in the Prometheus text format"""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base of the metrics: values by tuple of label values, safe to
+    update from several threads
+    :param name: name of the metric
+    :param help: description of the metric
+    :param labels: names of the labels
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.help),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """Count of events, only ever increased"""
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            '{}{} {}'.format(self.name, format_labels(self.labels, key),
+                             format_value(value))
+            for key, value in values]
+
+
+class Gauge(Counter):
+    """Value going up and down, such as the length of a queue"""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """
+    Distribution of durations in BUCKETS, with their sum and count
+    :param buckets: upper bounds of the buckets, ending with inf
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        Count one value
+        :param value: e.g. seconds
+        :param labels: values of the labels
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds spent in a with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def summary(self, *labels):
+        """
+        Count, sum and estimated median and 99th percentile
+        return: dict, None if nothing was observed
+        """
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                return None
+            buckets, total, count = list(counts[0]), counts[1], counts[2]
+        return {'count': count, 'sum': total,
+                'p50': self.quantile(buckets, count, 0.5),
+                'p99': self.quantile(buckets, count, 0.99)}
+
+    def quantile(self, buckets, count, q):
+        """
+        Quantile interpolated within its bucket, as histogram_quantile
+        of Prometheus does
+        """
+        rank = q * count
+        seen = 0
+        for index, number in enumerate(buckets):
+            if number and seen + number >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / number
+            seen += number
+        return 0.0
+
+    def label_values(self):
+        with self._lock:
+            return sorted(self._values)
+
+    def lines(self):
+        with self._lock:
+            values = sorted((key, (list(counts[0]), counts[1], counts[2]))
+                            for key, counts in self._values.items())
+        lines = self.header()
+        for key, (buckets, total, count) in values:
+            for bound, number in zip(self.buckets,
+                                     itertools.accumulate(buckets)):
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(
+                        self.labels, key, [('le', format_value(bound))]),
+                    number))
+            labels = format_labels(self.labels, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process, and collectors reading the state of other
+    objects (caches, queues) when the metrics are rendered
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        """
+        Register a metric, or return the one of the same name
+        """
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def register(self, key, collector):
+        """
+        Register a collector, replacing the one of the same key
+        :param key: e.g. the name of the module
+        :param collector: function returning an iterable of
+                          (name, kind, help, labels dict, value)
+        """
+        with self._lock:
+            self.collectors[key] = collector
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        return: str
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.lines())
+        # Samples of a name must follow each other
+        families = {}
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                logger.exception('Collector failed')
+                continue
+            for name, kind, help, labels, value in samples:
+                if name not in families:
+                    families[name] = [
+                        '# HELP {} {}'.format(name, help),
+                        '# TYPE {} {}'.format(name, kind)]
+                families[name].append('{}{} {}'.format(
+                    name, format_labels(labels, labels.values()),
+                    format_value(value)))
+        for family in families.values():
+            lines.extend(family)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.add(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return REGISTRY.add(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    return REGISTRY.add(Histogram(name, help, labels, buckets))
+
+
+def serve(port, address='127.0.0.1', registry=REGISTRY):
+    """
+    Serve the metrics at PATH on a background thread, for Prometheus
+    :param port: port to listen on
+    :param address: address to listen on
+    return: ThreadingHTTPServer, stopped by its shutdown()
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != PATH:
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    logger.info('Metrics on http://%s:%d%s', address,
+                server.server_address[1], PATH)
+    return server
+
+
+class Profiler:
+    """
+    Opt-in profiling of handlers: a sample of the calls runs under
+    cProfile, and the statistics of each are written to
+    <directory>/<name>-<pid>-<n>.prof for pstats or snakeviz.
+    One call is profiled at a time, calls made meanwhile are not.
+    :param directory: directory of the profiles, created if needed
+    :param rate: fraction of the calls profiled
+    """
+
+    def __init__(self, directory, rate=1.0):
+        self.directory = directory
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._numbers = itertools.count(1)
+        os.makedirs(directory, exist_ok=True)
+
+    def run(self, name, function, *args):
+        """
+        Call function(*args), profiled if sampled
+        :param name: name of the handler, in the file name
+        return: result of the function
+        """
+        if random.random() >= self.rate or not self._lock.acquire(False):
+            return function(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                profile.dump_stats(os.path.join(
+                    self.directory, '{}-{}-{}.prof'.format(
+                        name, os.getpid(), next(self._numbers))))
+        finally:
+            self._lock.release()
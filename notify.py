@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import defaultdict
+from telegram.error import Forbidden, TelegramError
+import db
+import messages
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Notifications taken from table notification at once
+BATCH_SIZE = 1000
+# Seconds between two polls of table notification
+INTERVAL = 60.0
+# Chats pushed to at once: bounds the messages queued in the outbox
+# ahead of the replies to commands
+CONCURRENCY = 32
+# New documents of a topic listed in a push at most
+DOCS_PER_TOPIC = 10
+# Seconds a write waits for the transaction of a refresh
+TIMEOUT = 30.0
+PUSH_SECONDS = metrics.histogram(
+    'newsbot_push_seconds',
+    'Seconds from notifications taken to their push delivered to a chat')
+PUSHES = metrics.counter(
+    'newsbot_pushes_total', 'Pushes to chats by outcome', ('outcome',))
+
+
+def connect(path):
+    """
+    Connection writing the subscriptions, next to the read-only ones
+    of storage.py
+    :param path: database path
+    return: A SQLite database connection
+    """
+    return sqlite3.connect(path, timeout=TIMEOUT)
+
+
+def subscribe(conn, chat_id, topic_url):
+    """
+    Subscribe a chat to the new documents of a topic
+    :param conn: A SQLite database connection, see connect
+    :param chat_id: id of the chat
+    :param topic_url: url of the topic
+    return: False if the chat was already subscribed
+    """
+    with db.swap_lock(conn):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        db.create_tables(cur)
+        cur.execute('''
+            INSERT OR IGNORE INTO subscription (topic_url, chat_id)
+            VALUES (?, ?)''', (topic_url, chat_id))
+        added = cur.rowcount > 0
+        conn.commit()
+    return added
+
+
+def unsubscribe(conn, chat_id, topic_url=None):
+    """
+    Cancel subscriptions of a chat
+    :param conn: A SQLite database connection, see connect
+    :param chat_id: id of the chat
+    :param topic_url: url of the topic, None for all topics
+    return: number of subscriptions cancelled
+    """
+    with db.swap_lock(conn):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        db.create_tables(cur)
+        if topic_url is None:
+            cur.execute('DELETE FROM subscription WHERE chat_id = ?',
+                        (chat_id,))
+        else:
+            cur.execute('''
+                DELETE FROM subscription
+                WHERE topic_url = ? AND chat_id = ?''', (topic_url, chat_id))
+        removed = cur.rowcount
+        conn.commit()
+    return removed
+
+
+def subscriptions(conn, chat_id):
+    """
+    Names of the topics a chat subscribed to
+    :param conn: A SQLite database connection
+    :param chat_id: id of the chat
+    return: sorted list of names
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+            SELECT t.name
+            FROM subscription s
+            JOIN topic t ON t.url = s.topic_url
+            WHERE s.chat_id = ?
+            ORDER BY t.name''', (chat_id,))
+    except sqlite3.OperationalError:
+        # Database older than the subscriptions
+        return []
+    return [row[0] for row in cur.fetchall()]
+
+
+def take(conn, limit=BATCH_SIZE):
+    """
+    Remove the oldest notifications from the queue: a notification is
+    pushed at most once, even if several processes poll
+    :param conn: A SQLite database connection, see connect
+    :param limit: number of notifications taken at most
+    return: list of (topic url, document url)
+    """
+    with db.swap_lock(conn):
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        db.create_tables(cur)
+        cur.execute('''
+            DELETE FROM notification WHERE id IN (
+                SELECT id FROM notification ORDER BY id LIMIT ?)
+            RETURNING id, topic_url, doc_url''', (limit,))
+        rows = sorted(cur.fetchall())
+        conn.commit()
+    return [row[1:] for row in rows]
+
+
+def render(conn, notifications):
+    """
+    Pushes of notifications: every chat gets one reply listing the new
+    documents of all its topics
+    :param conn: A SQLite database connection
+    :param notifications: list of (topic url, document url), see take
+    return: dict chat id -> list of messages
+    """
+    docs = defaultdict(dict)
+    for topic_url, doc_url in notifications:
+        docs[topic_url][doc_url] = None
+    if not docs:
+        return {}
+    urls = list(docs)
+    marks = ', '.join('?' * len(urls))
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT url, name FROM topic WHERE url IN ({})'.format(marks), urls)
+    names = dict(cur.fetchall())
+    doc_urls = list({url for items in docs.values() for url in items})
+    cur.execute('SELECT url, Heading FROM doc WHERE url IN ({})'.format(
+        ', '.join('?' * len(doc_urls))), doc_urls)
+    headings = dict(cur.fetchall())
+
+    # Every section is rendered once, whatever the number of chats
+    sections = {}
+    for topic_url, items in docs.items():
+        if topic_url not in names:
+            continue
+        listed = [headings.get(url, url) for url in items]
+        lines = ['Новое в теме «{}»:\n'.format(names[topic_url])]
+        lines.extend('• {}\n'.format(heading)
+                     for heading in listed[:DOCS_PER_TOPIC])
+        if len(listed) > DOCS_PER_TOPIC:
+            lines.append('и ещё {}\n'.format(len(listed) - DOCS_PER_TOPIC))
+        sections[topic_url] = ''.join(lines)
+
+    topics = defaultdict(list)
+    cur.execute('''
+        SELECT chat_id, topic_url FROM subscription
+        WHERE topic_url IN ({})
+        ORDER BY chat_id, topic_url'''.format(marks), urls)
+    for chat_id, topic_url in cur.fetchall():
+        if topic_url in sections:
+            topics[chat_id].append(sections[topic_url])
+    return {chat_id: list(messages.chunks(items))
+            for chat_id, items in topics.items()}
+
+
+class Notifier:
+    """
+    Pushes the documents new to subscribed topics, queued in table
+    notification by the loads of db.py, to the chats: takes a batch of
+    notifications, renders one reply per chat and sends the replies
+    through the outbox, concurrency chats at a time, within its flood
+    limits. Chats that blocked the bot lose their subscriptions.
+    Several processes may poll the same database, each notification
+    is taken by one of them.
+    :param path: database path
+    :param outbox: messages.Outbox, shared with the replies to commands
+    :param interval: seconds between two polls
+    :param concurrency: chats pushed to at once
+    :param batch_size: notifications taken at once
+    """
+
+    def __init__(self, path, outbox, interval=INTERVAL,
+                 concurrency=CONCURRENCY, batch_size=BATCH_SIZE):
+        self.path = path
+        self.outbox = outbox
+        self.interval = interval
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._task = None
+
+    def collect(self):
+        """
+        Take a batch of notifications and render their pushes, blocking
+        return: dict chat id -> list of messages
+        """
+        conn = connect(self.path)
+        try:
+            return render(conn, take(conn, self.batch_size))
+        finally:
+            conn.close()
+
+    def forget(self, chat_ids):
+        """Cancel the subscriptions of chats, blocking"""
+        conn = connect(self.path)
+        try:
+            for chat_id in chat_ids:
+                unsubscribe(conn, chat_id)
+        finally:
+            conn.close()
+
+    async def push(self, bot, replies):
+        """
+        Send the pushes to their chats
+        :param bot: telegram.Bot
+        :param replies: dict chat id -> list of messages, see render
+        return: dict with the number of chats, messages sent, blocked
+                and failed chats, and seconds
+        """
+        start = time.perf_counter()
+        outcomes = defaultdict(int)
+        blocked = []
+        pending = iter(replies.items())
+
+        async def worker():
+            for chat_id, texts in pending:
+                try:
+                    await self.outbox.send(bot, chat_id, texts)
+                    outcome = 'sent'
+                except Forbidden:
+                    outcome = 'blocked'
+                    blocked.append(chat_id)
+                except TelegramError as err:
+                    outcome = 'failed'
+                    logger.warning('Push to chat %s failed: %r',
+                                   chat_id, err)
+                outcomes[outcome] += 1
+                PUSHES.inc(outcome)
+                PUSH_SECONDS.observe(time.perf_counter() - start)
+
+        await asyncio.gather(*(
+            worker() for _ in range(min(self.concurrency, len(replies)))))
+        if blocked:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.forget, blocked)
+        return {
+            'chats': len(replies),
+            'messages': sum(len(texts) for texts in replies.values()),
+            'blocked': outcomes['blocked'],
+            'failed': outcomes['failed'],
+            'seconds': time.perf_counter() - start,
+        }
+
+    async def run_once(self, bot):
+        """
+        Push batches until the queue is empty
+        return: number of chats pushed to
+        """
+        loop = asyncio.get_running_loop()
+        chats = 0
+        while True:
+            replies = await loop.run_in_executor(None, self.collect)
+            if not replies:
+                return chats
+            result = await self.push(bot, replies)
+            chats += result['chats']
+            logger.info('Pushed %d messages to %d chats in %.1fs',
+                        result['messages'], result['chats'],
+                        result['seconds'])
+
+    async def run(self, bot):
+        """Poll every interval seconds until cancelled"""
+        while True:
+            try:
+                await self.run_once(bot)
+            except Exception:
+                logger.exception('Push failed')
+            await asyncio.sleep(self.interval)
+
+    def start(self, bot):
+        """Poll on a task of the running event loop"""
+        self._task = asyncio.get_running_loop().create_task(self.run(bot))
+
+    async def stop(self):
+        """
+        Cancel the polling task; the rest of a push cut short is lost,
+        its notifications being taken already
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
@@ -1,9 +1,62 @@
+import asyncio
 import urllib.request
 import re
 import html
+import hashlib
 import json
-from bs4 import BeautifulSoup
+import logging
+import multiprocessing
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
 from datetime import datetime
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+import metrics
+from crawler import Fetcher, FetchError
+
+
+logger = logging.getLogger(__name__)
+
+# Stored per URL between crawls to send conditional requests
+UrlState = namedtuple(
+    'UrlState', ['etag', 'last_modified', 'content_hash', 'last_seen'])
+
+# Records written to tables topic and doc
+Topic = namedtuple(
+    'Topic', ['name', 'url', 'description', 'articles', 'LastUpdateTime',
+              'article_urls'])
+Doc = namedtuple(
+    'Doc', ['url', 'Heading', 'LastUpdateTime', 'text', 'tags', 'words'])
+
+# Pages sent to a worker process at once by parse_parallel
+CHUNK_SIZE = 16
+PARSE_SECONDS = metrics.histogram(
+    'newsbot_parse_seconds', 'Seconds extracting one article page',
+    ('source',))
+
+# Runs of letters and digits, the words counted by word_counts
+WORD = re.compile(r'[^\W_]+')
+
+# Tags whose start or end closes an open paragraph: </p> is optional
+# in HTML and paragraphs do not nest
+PARAGRAPH_ENDS = frozenset('''
+    address article aside blockquote body dd details div dl dt fieldset
+    figcaption figure footer form h1 h2 h3 h4 h5 h6 header hgroup hr
+    html li main menu nav ol p pre section table td th tr ul
+'''.split())
+
+# A fetched page flowing through the pipeline
+Page = namedtuple('Page', ['kind', 'url', 'meta', 'content', 'source'])
+
+# A link of a page, with the last <time datetime> seen before it
+Link = namedtuple('Link', ['url', 'text', 'time'])
+
+# Everything extract_page finds in a page
+Extracted = namedtuple(
+    'Extracted', ['text', 'headline', 'published', 'tags', 'links',
+                  'description', 'item_urls', 'item_names', 'item_times'])
 
 
 def get_site_from_url(url):
@@ -37,7 +90,8 @@ def convert_to_time(time_str):
 
     if len(time) != 2:
         # case 1 or case 2
-        month = int(months[time[1]])
+        # Short or full month name
+        month = int(months[time[1][:3]])
         day = int(time[0])
     else:
         # case 3
@@ -55,7 +109,8 @@ def convert_to_time(time_str):
 
 def get_text(HTML):
     """
-    Get text from HTML
+    Get text from HTML, superseded by extract_page and kept for
+    benchmarks/bench_extract.py
     :param HTML: unicode url
     return: string
     """
@@ -68,69 +123,526 @@ def get_text(HTML):
     return _text
 
 
+class PageParser(HTMLParser):
+    """
+    Streaming HTML parser collecting in one pass what the crawl needs
+    from index, topic and article pages, see extract_page
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self.headline = None
+        self.published = None
+        self.tags = set()
+        self.links = []
+        self.description = None
+        self.item_urls = []
+        self.item_names = []
+        self.item_times = []
+        self._paragraph = None
+        self._skip = 0
+        self._h1 = None
+        self._category = None
+        self._anchor = None
+        self._time = None
+
+    def handle_starttag(self, tag, attrs):
+        self.tags.add(tag)
+        if tag in PARAGRAPH_ENDS:
+            self._end_paragraph()
+        if tag == 'p':
+            self._paragraph = []
+        elif tag in ('script', 'style'):
+            self._skip += 1
+        elif tag == 'meta':
+            self._meta(dict(attrs))
+        elif tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self._anchor = (href, [])
+        elif tag == 'h1' and self.headline is None:
+            self._h1 = []
+        elif tag == 'span':
+            if 'item__category' in (dict(attrs).get('class') or '').split():
+                self._category = []
+        elif tag == 'time':
+            self._time = dict(attrs).get('datetime') or self._time
+            if self.published is None:
+                self.published = self._time
+
+    def _meta(self, attrs):
+        content = attrs.get('content')
+        if content is None:
+            return
+        itemprop = attrs.get('itemprop')
+        if itemprop == 'url':
+            self.item_urls.append(content)
+        elif itemprop == 'name':
+            self.item_names.append(content)
+        elif itemprop == 'datePublished' or attrs.get(
+                'property') == 'article:published_time':
+            self.published = content
+        elif (attrs.get('name') or '').lower() == 'description':
+            if self.description is None:
+                self.description = content
+
+    def _end_paragraph(self):
+        if self._paragraph is not None:
+            self.paragraphs.append(''.join(self._paragraph))
+            self._paragraph = None
+
+    def handle_endtag(self, tag):
+        if tag in PARAGRAPH_ENDS:
+            self._end_paragraph()
+        if tag in ('script', 'style') and self._skip:
+            self._skip -= 1
+        elif tag == 'h1' and self._h1 is not None:
+            self.headline = ' '.join(''.join(self._h1).split())
+            self._h1 = None
+        elif tag == 'span' and self._category is not None:
+            self.item_times.append(''.join(self._category).strip())
+            self._category = None
+        elif tag == 'a' and self._anchor is not None:
+            href, text = self._anchor
+            self.links.append(
+                Link(href, ' '.join(''.join(text).split()), self._time))
+            self._anchor = None
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._paragraph is not None:
+            self._paragraph.append(data)
+        if self._h1 is not None:
+            self._h1.append(data)
+        if self._category is not None:
+            self._category.append(data)
+        if self._anchor is not None:
+            self._anchor[1].append(data)
+
+    def close(self):
+        super().close()
+        self._end_paragraph()
+
+
+def parse_timestamp(value):
+    """
+    Convert an ISO 8601 timestamp of a page to datetime
+    :param value: string, e.g. 2021-05-16T16:22:00+03:00
+    return: datetime in the time zone of the site, None if value
+            is empty or malformed
+    """
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def extract_page(HTML):
+    """
+    Parse a page once and extract, for articles, the body text (the
+    paragraphs, as get_text), the headline (first h1), the publication
+    time, the tag names (as get_tags) and the Links, and for index and
+    topic pages the description and the listed items
+    :param HTML: page text
+    return: Extracted
+    """
+    parser = PageParser()
+    parser.feed(HTML)
+    parser.close()
+    return Extracted(
+        ''.join(' ' + item for item in parser.paragraphs),
+        parser.headline,
+        parse_timestamp(parser.published),
+        json.dumps(sorted(parser.tags)),
+        parser.links,
+        parser.description,
+        parser.item_urls,
+        parser.item_names,
+        parser.item_times)
+
+
+def word_counts(text):
+    """
+    Count words of the text in one pass of the compiled WORD regex
+    :param text: text of a document
+    return: dict word -> frequency
+    """
+    return Counter(WORD.findall(text))
+
+
 def get_tags(HTML):
     """
-    Find all tags on HTML
+    Find all tags on HTML, superseded by extract_page and kept for
+    benchmarks/bench_extract.py
     """
+    # Imported here so that importing parse stays cheap
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(HTML, "html.parser")
     tags = set([tag.name for tag in soup.find_all()])
     return json.dumps(list(tags))
 
 
-url1 = 'https://www.rbc.ru/story/'
-url2 = 'http://www.interfax.ru/story/'
+def parse_topic_page(site):
+    """
+    Extract description and article listing from a topic page
+    :param site: HTML of the topic page
+    return: description, articles urls, articles names,
+            articles update times (type datetime)
+    """
+    page = extract_page(site)
+    articles_update_time = [
+        convert_to_time(item) for item in page.item_times]
+    return (page.description or '', page.item_urls, page.item_names,
+            articles_update_time)
 
-site = get_site_from_url(url1)
 
-with open('data1.txt', 'w', encoding='utf-8') as f:
-    f.write(site)
+def conditional_headers(state, url):
+    """
+    Build conditional request headers from the stored URL state
+    :param state: dict url -> UrlState
+    :param url: URL address
+    """
+    headers = {}
+    entry = state.get(url)
+    if entry is not None:
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    return headers
 
-months = {
-    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4,
-    'мая': 5, 'июн': 6, 'июл': 7, 'авг': 8,
-    'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12}
 
-name_of_topics = re.findall(r'<meta itemprop="name" content="(.*)">', site)
+def failed(state, url):
+    """
+    Whether the last fetch of a URL failed or it was never fetched
+    :param state: dict url -> UrlState
+    :param url: URL address
+    """
+    entry = state.get(url)
+    return entry is None or entry.content_hash is None
+
+
+def changed_page(url, response, state, encoding='utf-8', force=False):
+    """
+    Decode a fetched page and record its URL state. A failure is
+    recorded as a state without content hash, see failed.
+    :param url: URL address
+    :param response: crawler.Response or crawler.FetchError
+    :param state: dict url -> UrlState, updated in place
+    :param encoding: encoding of the page
+    :param force: return the page even if it did not change
+    return: page text, or None if the page is unchanged or failed
+    """
+    now = datetime.now()
+    if isinstance(response, FetchError):
+        logger.warning('Skip %s: %s', url, response)
+        state[url] = UrlState(None, None, None, now)
+        return None
+    old = state.get(url)
+    if response.status == 304 and old is not None:
+        state[url] = old._replace(last_seen=now)
+        return None
+    if response.status != 200:
+        logger.warning('Skip %s: HTTP %s', url, response.status)
+        state[url] = UrlState(None, None, None, now)
+        return None
+    content_hash = hashlib.sha1(response.body).hexdigest()
+    new = UrlState(
+        response.headers.get('etag'), response.headers.get('last-modified'),
+        content_hash, now)
+    if old is not None and old.content_hash == content_hash and not force:
+        state[url] = new
+        return None
+    try:
+        page = response.body.decode(encoding)
+    except UnicodeDecodeError as err:
+        logger.warning('Skip %s: %r', url, err)
+        state[url] = UrlState(None, None, None, now)
+        return None
+    state[url] = new
+    return page
+
+
+async def crawl(url, fetcher=None, state=None, listings=None):
+    """
+    Crawl the story index, every topic page and every article
+    concurrently through crawler.Fetcher and yield pages as they arrive.
+    With a URL state, requests are conditional and pages that did not
+    change since the last crawl are not yielded. The articles of an
+    unchanged topic page are requested too, from its known listing; a
+    topic page listing an article that failed or was never fetched is
+    requested unconditionally and yielded, so that all its articles
+    are requested again.
+    :param url: URL of the story index, see sources.resolve
+    :param fetcher: crawler.Fetcher instance, a default one if None
+    :param state: dict url -> UrlState, updated in place
+    :param listings: dict topic url -> list of (article url, name,
+                     update time) of the last crawl, name None for
+                     articles that were never stored
+    yield: Page, topic pages carry their parsed listing in meta
+    """
+    # Imported here as the sources are built on this module
+    import sources
+    source, url = sources.resolve(url)
+    state = {} if state is None else state
+    listings = listings or {}
+    incomplete = {
+        topic_url for topic_url, items in listings.items()
+        if any(failed(state, item[0]) for item in items)}
+
+    def headers_for(page_url):
+        if page_url in incomplete:
+            return {}
+        return conditional_headers(state, page_url)
+
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = Fetcher()
+    fetcher.set_rate(urlsplit(url).netloc, source.rate)
+    try:
+        name_of_topics = dict(source.topics(
+            url, await fetcher.fetch_text(url, source.encoding)))
+
+        # article url -> (name, update time) of its first listing
+        listed = {}
+        async with aclosing(fetcher.fetch_many(
+                name_of_topics, headers_for)) as responses:
+            async for topic_url, response in responses:
+                page = changed_page(
+                    topic_url, response, state, source.encoding,
+                    force=topic_url in incomplete)
+                if page is None:
+                    for article_url, *meta in listings.get(topic_url, ()):
+                        if meta[0] is not None:
+                            listed.setdefault(article_url, tuple(meta))
+                    continue
+                listing = source.listing(topic_url, page)
+                for item in zip(*listing[1:]):
+                    listed.setdefault(item[0], item[1:])
+                yield Page('topic', topic_url, name_of_topics[topic_url],
+                           listing, source.name)
+
+        async with aclosing(fetcher.fetch_many(
+                listed, headers_for)) as responses:
+            async for article_url, response in responses:
+                page = changed_page(
+                    article_url, response, state, source.encoding)
+                if page is not None:
+                    yield Page('doc', article_url, listed[article_url],
+                               page, source.name)
+    finally:
+        if own_fetcher:
+            fetcher.close()
+
+
+async def crawl_all(urls, fetcher=None, state=None, listings=None,
+                    strict=False):
+    """
+    Crawl several sources at once through one crawler.Fetcher, each
+    with its own rate limit, so that the crawl takes about as long as
+    the one of the largest source. A source failing is logged and the
+    others go on.
+    :param urls: URLs of the story indexes, see crawl
+    :param strict: fail with the first source failing instead, e.g.
+                   for a full load which would drop the failed source
+    Other arguments are the same as crawl.
+    yield: Page of any source, as they arrive
+    """
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = Fetcher()
+    queue = asyncio.Queue(fetcher.max_in_flight * 2)
+
+    async def produce(url):
+        try:
+            async with aclosing(
+                    crawl(url, fetcher, state, listings)) as pages:
+                async for page in pages:
+                    await queue.put(page)
+            await queue.put(None)
+        except Exception as err:
+            if strict:
+                await queue.put(err)
+            else:
+                logger.exception('Crawl of %s failed', url)
+                await queue.put(None)
+
+    tasks = [asyncio.ensure_future(produce(url)) for url in urls]
+    try:
+        running = len(tasks)
+        while running:
+            item = await queue.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if own_fetcher:
+            fetcher.close()
+
+
+def fetch(url, fetcher=None, state=None, listings=None, strict=False):
+    """
+    Fetch stage: run crawl_all on a private event loop and yield its
+    pages. While the consumer works no page is awaited, so at most
+    fetcher.max_in_flight * 4 pages are held in memory.
+    :param url: URL of a story index or list of them
+    Other arguments are the same as crawl_all.
+    """
+    loop = asyncio.new_event_loop()
+    urls = [url] if isinstance(url, str) else list(url)
+    pages = crawl_all(urls, fetcher, state, listings, strict)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(pages.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(pages.aclose())
+        loop.close()
+
+
+def extract(pages, observe=PARSE_SECONDS.observe):
+    """
+    Extract stage: parse article pages once with the article extraction
+    of their source
+    :param pages: iterable of Page
+    :param observe: function (seconds, source) called for every article
+    yield: Page with Extracted as content of articles
+    """
+    import sources
+    for page in pages:
+        if page.kind == 'doc':
+            start = time.perf_counter()
+            page = page._replace(
+                content=sources.SOURCES[page.source].article(page.content))
+            observe(time.perf_counter() - start, page.source)
+        yield page
+
 
-url_of_topics = re.findall(r'<meta itemprop="url" content="(.*)">', site)
+def normalize(pages):
+    """
+    Normalize stage: turn extracted pages into database records
+    :param pages: iterable of Page from extract
+    yield: Topic or Doc
+    """
+    for page in pages:
+        if page.kind == 'topic':
+            descript, articles_url, articles_name, articles_update_time = \
+                page.content
+            yield Topic(
+                page.meta, page.url, descript, '\n'.join(articles_name),
+                max(filter(None, articles_update_time), default=None),
+                tuple(articles_url))
+        else:
+            # The topic listing names and dates the article, the
+            # article page itself is the fallback
+            content = page.content
+            yield Doc(page.url, page.meta[0] or content.headline,
+                      page.meta[1] or content.published, content.text,
+                      content.tags, word_counts(content.text))
+
+
+def parse_chunk(pages):
+    """
+    Extract and normalize a chunk of pages, in a worker process
+    :param pages: list of Page from fetch
+    return: list of Topic and Doc, list of (seconds, source) of the
+            articles for PARSE_SECONDS of the parent process
+    """
+    timings = []
+    records = list(normalize(extract(
+        pages, lambda seconds, source: timings.append((seconds, source)))))
+    return records, timings
+
+
+def parse_parallel(pages, workers, chunk_size=CHUNK_SIZE):
+    """
+    Extract and normalize stages on a pool of worker processes: pages
+    go to the workers in chunks and records come back in page order as
+    soon as their chunk is done. At most workers * 2 chunks are in
+    flight, so the fetch stage is throttled by the parsing.
+    :param pages: iterable of Page from fetch
+    :param workers: number of worker processes
+    :param chunk_size: number of pages sent to a worker at once
+    yield: Topic and Doc records
+    """
+    # Spawned rather than forked: the fetch stage runs threads
+    context = multiprocessing.get_context('spawn')
+
+    def done(future):
+        records, timings = future.result()
+        for seconds, source in timings:
+            PARSE_SECONDS.observe(seconds, source)
+        return records
+
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        in_flight = deque()
+        for chunk in batched(pages, chunk_size):
+            in_flight.append(executor.submit(parse_chunk, chunk))
+            if len(in_flight) >= workers * 2:
+                yield from done(in_flight.popleft())
+        while in_flight:
+            yield from done(in_flight.popleft())
 
-description_of_topics = []
-articles = []
-topics_time = []
-arcticles_in_topics = []
-for url in url_of_topics:
-    site = get_site_from_url(url)
-    descript = re.findall(
-        r'<meta name="Description" content="(.*)" />', site)
 
-    description_of_topics.append(descript[0])
+def records(url, fetcher=None, state=None, workers=1, listings=None,
+            strict=False):
+    """
+    Crawl pipeline fetch -> extract -> normalize
+    :param workers: number of processes extracting and normalizing
+                    pages, 1 to do it in this process
+    Other arguments are the same as fetch.
+    yield: Topic and Doc records as they are produced
+    """
+    pages = fetch(url, fetcher, state, listings, strict)
+    if workers > 1:
+        return parse_parallel(pages, workers)
+    return normalize(extract(pages))
+
+
+def batched(iterable, size):
+    """
+    Group an iterable into lists of at most size items
+    :param iterable: e.g. records()
+    :param size: batch size
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    articles_url = re.findall(
-        r'<meta itemprop="url" content="(.*)">', site)
 
-    articles_name = re.findall(
-        r'<meta itemprop="name" content="(.*)">', site)
+url1 = 'https://www.rbc.ru/story/'
+url2 = 'http://www.interfax.ru/story/'
 
-    articles_update_time_str = re.findall(
-        r'<span class="item__category">(.*)</span>', site)
+months = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4,
+    'мая': 5, 'июн': 6, 'июл': 7, 'авг': 8,
+    'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12}
 
-    arcticles_in_topics.append('\n'.join(articles_name))
-    articles_update_time = []
-    articles_texts = []
-    articles_tags = []
 
-    for item in articles_update_time_str:
-        articles_update_time.append(convert_to_time(item))
-    topics_time.append(sorted(articles_update_time)[-1])
-    for item in articles_url:
-        HTML = get_site_from_url(item)
-        articles_texts.append(get_text(HTML))
-        articles_tags.append(get_tags(HTML))
-    articles.extend(zip(
-        articles_url, articles_name, articles_update_time,
-        articles_texts, articles_tags))
+def main():
+    """Dump the index page of url1 to data1.txt and count records"""
+    with open('data1.txt', 'w', encoding='utf-8') as f:
+        f.write(get_site_from_url(url1))
+    counts = {Topic: 0, Doc: 0}
+    for record in records(url1):
+        counts[type(record)] += 1
+    print('{} topics, {} documents'.format(counts[Topic], counts[Doc]))
 
 
-topics = zip(
-    name_of_topics, url_of_topics, description_of_topics,
-    arcticles_in_topics, topics_time)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Busy(Exception):
+    """Raised when a chat already has too many requests waiting"""
+
+
+class Runtime:
+    """
+    Runs the blocking work of handlers (SQLite queries, rendering) off
+    the event loop, on a bounded pool of worker threads, so a slow
+    request of one user never stalls the others.
+    Each chat runs at most per_chat jobs at a time; when backlog more
+    are already waiting, new ones fail with Busy instead of queuing.
+    At most max_pending jobs are queued for the workers overall,
+    further callers wait for a free place.
+    :param workers: number of worker threads
+    :param per_chat: jobs of one chat running at a time
+    :param backlog: jobs of one chat waiting at most
+    :param max_pending: jobs queued or running at most
+    """
+
+    def __init__(self, workers=4, per_chat=1, backlog=4, max_pending=None):
+        self.workers = workers
+        self.per_chat = per_chat
+        self.backlog = backlog
+        self.max_pending = max_pending or workers * 8
+        self._executor = None
+        self._pending = None
+        self._chats = {}
+        self._waiting = defaultdict(int)
+        # Total of _waiting, kept on the loop: stats is read from other
+        # threads, which cannot iterate _waiting while the loop changes it
+        self._jobs = 0
+
+    def _start(self):
+        """Create the executor and the semaphores in the running loop"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='runtime')
+            self._pending = asyncio.Semaphore(self.max_pending)
+
+    async def run(self, chat_id, function, *args):
+        """
+        Run function(*args) on a worker thread for the chat
+        :param chat_id: id of the chat the job answers, None for jobs
+                        of no chat
+        return: result of the function, raises Busy if the chat has
+                too many jobs waiting
+        """
+        self._start()
+        if self._waiting[chat_id] >= self.per_chat + self.backlog:
+            raise Busy(chat_id)
+        if chat_id not in self._chats:
+            self._chats[chat_id] = asyncio.Semaphore(self.per_chat)
+        chat = self._chats[chat_id]
+        self._waiting[chat_id] += 1
+        self._jobs += 1
+        try:
+            async with chat, self._pending:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, function, *args)
+        finally:
+            self._waiting[chat_id] -= 1
+            self._jobs -= 1
+            if not self._waiting[chat_id]:
+                del self._waiting[chat_id]
+                del self._chats[chat_id]
+
+    def stats(self):
+        """
+        Load of the runtime, safe to call from any thread
+        return: dict
+        """
+        return {
+            'chats': len(self._chats),
+            'jobs': self._jobs,
+        }
+
+    def shutdown(self):
+        """Stop the worker threads once their jobs are done"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pending = None
@@ -0,0 +1,172 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+import db
+import metrics
+import parse
+import snapshots
+import storage
+from crawler import Fetcher
+
+
+logger = logging.getLogger(__name__)
+
+REFRESH_SECONDS = metrics.histogram(
+    'newsbot_refresh_seconds', 'Seconds of a crawl and ingest',
+    ('mode',))
+REFRESH_ERRORS = metrics.counter(
+    'newsbot_refresh_errors_total', 'Refreshes failed', ('mode',))
+
+
+class Scheduler:
+    """
+    Periodic crawl and ingest of the site into the database of the
+    bot, in the bot process (start) or as a sidecar (run_forever).
+    Incremental refreshes commit in one transaction, full ones are
+    built in a shadow database and swapped in (db.rebuild), so readers
+    always see a complete corpus. The outcome of every refresh is kept
+    in stats() and in table meta (storage.refresh_status).
+    :param path: database path
+    :param interval: seconds between the starts of two refreshes
+    :param full_every: every full_every-th refresh is a full one,
+                       0 for never
+    :param url: URL of the story index or list of them, see
+                parse.crawl
+    :param snapshots: directory of a snapshots.SnapshotStore keeping
+                      the pages fetched, None to keep nothing
+    :param workers: number of processes parsing the pages
+    """
+
+    def __init__(self, path=storage.DB_PATH, interval=900.0, full_every=0,
+                 url=parse.url1, snapshots=None, workers=1):
+        self.path = path
+        self.interval = interval
+        self.full_every = full_every
+        self.url = url
+        self.snapshots = snapshots
+        self.workers = workers
+        self.refreshes = 0
+        self.errors = 0
+        self.last_refresh = None
+        self.last_seconds = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """
+        Run one refresh, logging and counting its errors
+        return: True if it succeeded
+        """
+        self.refreshes += 1
+        # The first refreshes are incremental: a restart does not
+        # rebuild the database
+        full = bool(self.full_every) and self.refreshes % self.full_every == 0
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.path)
+        store = None
+        if self.snapshots:
+            store = snapshots.SnapshotStore(self.snapshots)
+        fetcher = Fetcher(snapshots=store)
+        try:
+            rows = db.sync(conn, self.url, full, fetcher=fetcher,
+                           workers=self.workers)
+            error = None
+        except Exception as err:
+            error = err
+        finally:
+            fetcher.close()
+            if store is not None:
+                store.close()
+        seconds = time.perf_counter() - start
+        mode = 'full' if full else 'incremental'
+        REFRESH_SECONDS.observe(seconds, mode)
+        if error is None:
+            self.last_refresh = time.time()
+            self.last_seconds = seconds
+            logger.info('%s refresh: %d rows in %.1fs',
+                        'Full' if full else 'Incremental', rows, seconds)
+        else:
+            self.errors += 1
+            self.last_error = error
+            REFRESH_ERRORS.inc(mode)
+            logger.error('Refresh failed after %.1fs: %r', seconds, error)
+        try:
+            db.record_refresh(conn, seconds, error)
+        except sqlite3.Error:
+            logger.exception('Cannot record the refresh')
+        finally:
+            conn.close()
+        return error is None
+
+    def run_forever(self):
+        """Refresh every interval seconds until stop() is called"""
+        while not self._stop.is_set():
+            start = time.monotonic()
+            self.refresh()
+            self._stop.wait(max(0.0, self.interval -
+                                (time.monotonic() - start)))
+
+    def start(self):
+        """Refresh on a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run_forever, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the running refresh, if any"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        Outcome of the refreshes of this scheduler
+        return: dict
+        """
+        return {
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+            'last_refresh': self.last_refresh,
+            'last_seconds': self.last_seconds,
+            'last_error': repr(self.last_error) if self.last_error else None,
+        }
+
+
+def main():
+    """Refresh data.db periodically"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--db', default=storage.DB_PATH,
+                        help='database path')
+    parser.add_argument(
+        '--url', action='append',
+        help='story index, repeat to crawl several sources at once, '
+             'name=URL for a copy of a known source (default: rbc.ru)')
+    parser.add_argument('--interval', type=float, default=900.0,
+                        help='seconds between two refreshes')
+    parser.add_argument('--full-every', type=int, default=0,
+                        help='make every N-th refresh a full one')
+    parser.add_argument(
+        '--snapshots', default=os.environ.get('NEWSBOT_SNAPSHOTS'),
+        help='directory keeping the raw pages fetched')
+    parser.add_argument(
+        '--parse-workers', type=int,
+        default=int(os.environ.get('NEWSBOT_PARSE_WORKERS', 1)),
+        help='processes parsing the pages')
+    args = parser.parse_args()
+    args.url = args.url or [parse.url1]
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    Scheduler(args.db, args.interval, args.full_every, args.url,
+              args.snapshots, args.parse_workers).run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import difflib
+import parse
+
+
+# Letters dropped by stem(), most Russian inflectional endings are
+# one or two letters long, and letters always kept
+ENDING_LENGTH = 2
+MIN_STEM_LENGTH = 3
+# Minimal difflib similarity of a name that is not a prefix match
+CUTOFF = 0.5
+
+
+def fold(text):
+    """
+    Fold ё to е: the FTS5 tokenizer keeps them apart, while news sites
+    and users mix both spellings. Applied to indexed text and queries.
+    :param text: string
+    """
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def words(text):
+    """
+    Words of text, folded and lower-cased
+    :param text: string
+    return: list of words
+    """
+    return parse.WORD.findall(fold(text).lower())
+
+
+def stem(word):
+    """
+    Crude stem of a word: the word without its last ENDING_LENGTH
+    letters, at least MIN_STEM_LENGTH letters long
+    :param word: lower-cased word
+    """
+    return word[:max(MIN_STEM_LENGTH, len(word) - ENDING_LENGTH)]
+
+
+def query(text, any_word=False, stems=False, column=None):
+    """
+    Build an FTS5 query from user input. Every word is quoted, so the
+    FTS5 syntax of the input is never interpreted, and matched as a
+    prefix.
+    :param text: user input
+    :param any_word: match rows with any of the words instead of all
+    :param stems: match words by their stems, see stem()
+    :param column: restrict the match to this column
+    return: FTS5 query, None if text has no words
+    """
+    terms = words(text)
+    if not terms:
+        return None
+    if stems:
+        terms = [stem(term) for term in terms]
+    expression = (' OR ' if any_word else ' ').join(
+        '"{}"*'.format(term) for term in terms)
+    if column is not None:
+        expression = '{} : ({})'.format(column, expression)
+    return expression
+
+
+def closest(text, candidates):
+    """
+    Pick the candidate closest to text: the first one starting with
+    text, else the most similar one by difflib
+    :param text: name typed by a user
+    :param candidates: names, best full-text matches first
+    return: a candidate, None if none is similar enough
+    """
+    folded = {}
+    for candidate in candidates:
+        folded.setdefault(' '.join(words(candidate)), candidate)
+    text = ' '.join(words(text))
+    for key, candidate in folded.items():
+        if key.startswith(text):
+            return candidate
+    match = difflib.get_close_matches(text, folded, n=1, cutoff=CUTOFF)
+    return folded[match[0]] if match else None
@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from crawler import FetchError, Response
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+# Compression of the page files, by file extension
+CODECS = {
+    'gz': (lambda data: gzip.compress(data, 6), gzip.decompress),
+}
+if zstandard is not None:
+    CODECS['zst'] = (zstandard.ZstdCompressor(level=10).compress,
+                     zstandard.ZstdDecompressor().decompress)
+DEFAULT_CODEC = 'zst' if zstandard is not None else 'gz'
+
+
+class SnapshotStore:
+    """
+    Raw pages as fetched, so that the database can be rebuilt from them
+    after a change of the extraction without crawling again.
+    Bodies are stored once per content (objects/<sha256>.<codec>,
+    compressed), index.db maps every fetch (URL, fetch time) to its
+    body. Safe to use from several threads.
+    :param root: directory of the store, created if needed
+    :param codec: 'gz', or 'zst' if zstandard is installed
+    """
+
+    def __init__(self, root, codec=DEFAULT_CODEC):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec {}'.format(codec))
+        self.root = root
+        self.codec = codec
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(root, 'index.db'), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS snapshot (
+                url TEXT NOT NULL,
+                fetched_at TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (url, fetched_at)
+            ) WITHOUT ROWID''')
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _object_path(self, digest, codec):
+        return os.path.join(self.root, 'objects', digest[:2],
+                            '{}.{}'.format(digest, codec))
+
+    def put(self, url, body, fetched_at=None):
+        """
+        Store a fetched page
+        :param url: URL requested
+        :param body: bytes of the page
+        :param fetched_at: datetime of the fetch, now if None
+        return: content hash of the body
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        if not any(os.path.exists(self._object_path(digest, codec))
+                   for codec in CODECS):
+            path = self._object_path(digest, self.codec)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed, so that a file is always whole
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as file:
+                file.write(CODECS[self.codec][0](body))
+            os.replace(tmp, path)
+        fetched_at = (fetched_at or datetime.now()).isoformat(
+            timespec='microseconds')
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?)',
+                (url, fetched_at, digest))
+            self._conn.commit()
+        return digest
+
+    def get(self, digest):
+        """
+        Body of a stored page
+        :param digest: content hash returned by put
+        return: bytes
+        """
+        for codec, (_, decompress) in CODECS.items():
+            try:
+                with open(self._object_path(digest, codec), 'rb') as file:
+                    return decompress(file.read())
+            except FileNotFoundError:
+                continue
+        raise KeyError(digest)
+
+    def latest(self, url, at=None):
+        """
+        Body of the last snapshot of the URL
+        :param url: URL requested
+        :param at: datetime, only snapshots fetched until then count
+        return: bytes, None if there is no snapshot
+        """
+        at = (at or datetime.max).isoformat(timespec='microseconds')
+        with self._lock:
+            row = self._conn.execute('''
+                SELECT hash FROM snapshot
+                WHERE url = ? AND fetched_at <= ?
+                ORDER BY fetched_at DESC LIMIT 1''', (url, at)).fetchone()
+        return None if row is None else self.get(row[0])
+
+    def urls(self):
+        """
+        URLs with at least one snapshot
+        return: sorted list
+        """
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT DISTINCT url FROM snapshot ORDER BY url')]
+
+    def stats(self):
+        """
+        Size of the store
+        return: dict
+        """
+        with self._lock:
+            fetches, urls, bodies = self._conn.execute('''
+                SELECT count(*), count(DISTINCT url), count(DISTINCT hash)
+                FROM snapshot''').fetchone()
+        size = 0
+        for directory, _, names in os.walk(
+                os.path.join(self.root, 'objects')):
+            size += sum(os.path.getsize(os.path.join(directory, name))
+                        for name in names)
+        return {'fetches': fetches, 'urls': urls, 'bodies': bodies,
+                'bytes': size}
+
+
+class ReplayFetcher:
+    """
+    Stand-in for crawler.Fetcher answering from a SnapshotStore, with
+    no network: every URL gets its last snapshot, or HTTP 404.
+    Pages are returned in request order, so replays are deterministic.
+    :param store: SnapshotStore
+    :param at: datetime, replay the site as it was fetched until then
+    """
+
+    max_in_flight = 1
+
+    def __init__(self, store, at=None):
+        self.store = store
+        self.at = at
+        self.missing = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def set_rate(self, host, rate):
+        pass
+
+    def close(self):
+        pass
+
+    async def fetch(self, url, headers=None):
+        """
+        Response of the last snapshot of the URL
+        :param headers: ignored, replayed pages are never unchanged
+        return: crawler.Response
+        """
+        body = self.store.latest(url, self.at)
+        if body is None:
+            self.missing += 1
+            logger.warning('No snapshot of %s', url)
+            return Response(url, 404, {}, b'')
+        return Response(url, 200, {}, body)
+
+    async def fetch_text(self, url, encoding='utf-8'):
+        response = await self.fetch(url)
+        if response.status != 200:
+            raise FetchError('{}: no snapshot'.format(url))
+        return response.body.decode(encoding)
+
+    async def fetch_many(self, urls, headers_for=None, window=None):
+        for url in list(urls):
+            yield url, await self.fetch(url)
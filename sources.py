@@ -0,0 +1,143 @@
+import logging
+import re
+from urllib.parse import urljoin, urlsplit
+import parse
+
+
+logger = logging.getLogger(__name__)
+
+
+class Source:
+    """
+    Adapter of a news site to the crawl pipeline of parse.py: how to
+    discover the topics on the story index, list the articles of a
+    topic, extract an article and parse the dates of the site.
+    Every source is crawled by the same crawler.Fetcher and gives the
+    same parse.Topic and parse.Doc records.
+    """
+
+    # Key of the source in SOURCES
+    name = None
+    # URL of the story index
+    url = None
+    # Hosts of the site, see resolve
+    hosts = ()
+    # Requests per second to the site
+    rate = 10.0
+    # Encoding of the pages
+    encoding = 'utf-8'
+
+    def topics(self, url, HTML):
+        """
+        Find the topics on the story index
+        :param url: URL of the index page
+        :param HTML: index page
+        return: list of (topic url, topic name)
+        """
+        raise NotImplementedError
+
+    def listing(self, url, HTML):
+        """
+        Extract description and article listing from a topic page
+        :param url: URL of the topic page
+        :param HTML: topic page
+        return: description, articles urls, articles names,
+                articles update times (datetime or None if unknown)
+        """
+        raise NotImplementedError
+
+    def article(self, HTML):
+        """
+        Extract an article page
+        :param HTML: article page
+        return: parse.Extracted
+        """
+        return parse.extract_page(HTML)
+
+    def parse_time(self, text):
+        """
+        Convert a date shown by the site to datetime
+        :param text: e.g. 16 мая, 16:22
+        return: datetime, None if text is empty
+        """
+        if not text:
+            return None
+        return parse.parse_timestamp(text) or parse.convert_to_time(text)
+
+
+class Rbc(Source):
+    """rbc.ru: listings are itemprop meta tags and item__category dates"""
+
+    name = 'rbc'
+    url = parse.url1
+    hosts = ('www.rbc.ru', 'rbc.ru')
+
+    def topics(self, url, HTML):
+        page = parse.extract_page(HTML)
+        return list(zip(page.item_urls, page.item_names))
+
+    def listing(self, url, HTML):
+        return parse.parse_topic_page(HTML)
+
+
+class Interfax(Source):
+    """
+    interfax.ru: stories and articles are plain links, /story/<id> on
+    the index and /<rubric>/<id> on story pages, each article after the
+    <time> of its publication
+    """
+
+    name = 'interfax'
+    url = parse.url2
+    hosts = ('www.interfax.ru', 'interfax.ru')
+    rate = 5.0
+    encoding = 'windows-1251'
+    STORY = re.compile(r'^/story/\d+/?$')
+    # Any rubric but story: story pages link to other stories too
+    ARTICLE = re.compile(r'^/(?!story/)[a-z]+/\d+/?$')
+
+    def links(self, url, page, pattern):
+        """
+        Links of the page with a path matching pattern, once each
+        :param page: parse.Extracted
+        return: dict absolute url -> parse.Link
+        """
+        found = {}
+        for link in page.links:
+            absolute = urljoin(url, link.url)
+            if link.text and pattern.match(urlsplit(absolute).path):
+                found.setdefault(absolute, link)
+        return found
+
+    def topics(self, url, HTML):
+        page = parse.extract_page(HTML)
+        return [(link_url, link.text) for link_url, link in
+                self.links(url, page, self.STORY).items()]
+
+    def listing(self, url, HTML):
+        page = parse.extract_page(HTML)
+        articles = self.links(url, page, self.ARTICLE)
+        return (page.description or '', list(articles),
+                [link.text for link in articles.values()],
+                [self.parse_time(link.time) for link in articles.values()])
+
+
+SOURCES = {source.name: source for source in (Rbc(), Interfax())}
+
+
+def resolve(spec):
+    """
+    Source of a story index
+    :param spec: URL of the index, found by host, or name=URL to crawl
+                 a mirror or a local copy of a known source
+    return: (Source, URL)
+    """
+    name, sep, url = spec.partition('=')
+    if sep and name in SOURCES:
+        return SOURCES[name], url
+    host = urlsplit(spec).hostname
+    for source in SOURCES.values():
+        if host in source.hosts:
+            return source, spec
+    raise ValueError('No source for {}, use <name>=<url> with one of {}'
+                     .format(spec, ', '.join(SOURCES)))
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+
+# Database of the bot, the NEWSBOT_DB environment variable overrides it
+DB_PATH = os.environ.get('NEWSBOT_DB', 'data.db')
+# Prepared statements kept per connection, keyed by SQL text
+CACHED_STATEMENTS = 256
+# Applied to every read connection
+READ_PRAGMAS = (
+    ('query_only', 1),
+    ('mmap_size', 268435456),
+)
+
+
+class ReadPool:
+    """
+    Long-lived read-only connections to the database, shared by the
+    worker threads of the dispatcher. A thread takes an idle connection
+    or opens a new one and gives it back when done, so a connection is
+    used by one thread at a time. Connections keep their prepared
+    statements, every query is parsed once per connection.
+    Reads outside a transaction see the last commit of db.py.
+    :param path: database path
+    :param size: maximum number of idle connections kept
+    """
+
+    def __init__(self, path=DB_PATH, size=8):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Open a read-only connection"""
+        uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(
+            self.path)))
+        conn = sqlite3.connect(
+            uri, uri=True, check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS)
+        for name, value in READ_PRAGMAS:
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return conn
+
+    def acquire(self):
+        """Return an idle connection or open a new one"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def release(self, conn):
+        """Give a connection back, close it if enough are idle"""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Context manager lending a connection"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle.clear()
+
+
+def generation(conn):
+    """
+    Ingest generation of the database, bumped by every load of db.py
+    :param conn: A SQLite database connection
+    return: generation, 0 for a database never loaded since
+            generations exist
+    """
+    try:
+        cur = conn.execute(
+            "SELECT value FROM meta WHERE key = 'generation'")
+    except sqlite3.OperationalError:
+        return 0
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def refresh_status(conn):
+    """
+    Outcome of the refreshes of the database, see db.record_refresh
+    :param conn: A SQLite database connection
+    return: dict with last_refresh (time of the last successful
+            refresh), refresh_seconds (its duration), refresh_errors
+            (number of failed refreshes) and last_error
+    """
+    status = dict.fromkeys(
+        ('last_refresh', 'refresh_seconds', 'refresh_errors', 'last_error'))
+    status['refresh_errors'] = 0
+    try:
+        cur = conn.execute('SELECT key, value FROM meta')
+    except sqlite3.OperationalError:
+        return status
+    status.update(
+        (key, value) for key, value in cur.fetchall() if key in status)
+    return status
+
+
+pool = ReadPool()
+
+
+def configure(path, size=8):
+    """
+    Read another database from now on
+    :param path: database path
+    :param size: maximum number of idle connections kept
+    """
+    global pool
+    pool.close()
+    pool = ReadPool(path, size)
+
+
+def connection():
+    """
+    Lend a read-only connection of the pool:
+        with storage.connection() as conn:
+            rows = select_new_docs(conn, 10)
+    """
+    return pool.connection()
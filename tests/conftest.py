@@ -0,0 +1,20 @@
+import pytest
+from crawler import Fetcher
+from site_stub import SiteStub
+
+
+@pytest.fixture
+def site():
+    """Local news site, see site_stub"""
+    with SiteStub() as stub:
+        yield stub
+
+
+@pytest.fixture
+def fetcher():
+    """Factory of crawler.Fetcher without waits between requests"""
+    def make(**kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        kwargs.setdefault('per_host_rate', 0)
+        return Fetcher(**kwargs)
+    return make
@@ -0,0 +1,89 @@
+"""
+Local news site for the tests of crawler.Fetcher and of the crawl:
+serves pages from a dict with ETag / If-None-Match, answers scripted
+responses (errors, redirects, encoded bodies) first, and records every
+request.
+"""
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SiteStub:
+    """
+    HTTP server on a background thread
+    :param pages: dict path -> body (str, encoded as utf-8, or bytes),
+                  may be changed while the server runs
+    :param port: port to listen on, 0 for any free port
+    """
+
+    def __init__(self, pages=None, port=0):
+        self.pages = dict(pages or {})
+        # path -> list of (status, headers, body) answered before the
+        # page, one per request
+        self.scripts = defaultdict(list)
+        # (path, request headers, time.monotonic())
+        self.requests = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, headers, body = stub.answer(
+                    self.path, dict(self.headers))
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+    def answer(self, path, headers):
+        """
+        Response to a GET request
+        return: (status, headers, body)
+        """
+        with self._lock:
+            self.requests.append((path, headers, time.monotonic()))
+            if self.scripts[path]:
+                status, extra, body = self.scripts[path].pop(0)
+                return status, extra, body
+            body = self.pages.get(path)
+        if body is None:
+            return 404, {}, b'Not Found'
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag,
+                     'Content-Type': 'text/html; charset=utf-8'}, body
+
+    def requested(self, path):
+        """Number of requests of a path so far"""
+        with self._lock:
+            return sum(item[0] == path for item in self.requests)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
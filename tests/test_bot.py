@@ -0,0 +1,35 @@
+"""
+Tests of the rendering of the commands of bot.py
+"""
+import sqlite3
+from datetime import datetime, timedelta
+import bot
+import db
+import parse
+
+
+def test_new_docs_continues_by_page():
+    conn = sqlite3.connect(':memory:')
+    start = datetime(2024, 5, 16)
+    docs = []
+    for number in range(120):
+        # Distinct words, near-duplicates are listed once
+        text = ' '.join('слово{}'.format(number * 10 + index)
+                        for index in range(10))
+        docs.append(parse.Doc(
+            'https://example.org/{}'.format(number),
+            'Новость {}'.format(number), start + timedelta(minutes=number),
+            text, '["p"]', parse.word_counts(text)))
+    db.load(conn, docs, full=True)
+    headings = []
+    args = ('110',)
+    while args:
+        text = ''.join(bot.render_new_docs.__wrapped__(conn, args))
+        lines = text.splitlines()
+        args = ()
+        if lines[-1].startswith('Дальше: /new_docs '):
+            args = tuple(lines.pop().split()[2:])
+        assert len(lines) <= bot.PAGE_SIZE
+        headings.extend(line.split('] ', 1)[1] for line in lines)
+    assert headings == ['Новость {}'.format(number)
+                        for number in range(119, 9, -1)]
@@ -0,0 +1,75 @@
+"""
+Tests of the incremental crawl of a small rbc-like site into a
+database (db.sync)
+"""
+import sqlite3
+import pytest
+import db
+from crawler import FetchError
+
+
+def rbc_site(site, articles):
+    """
+    Fill the stub with an rbc-like story index, one topic listing
+    articles, and the article pages
+    :param articles: dict path -> body text
+    """
+    site.pages['/story/'] = (
+        '<meta itemprop="url" content="{}">'
+        '<meta itemprop="name" content="Тема">'.format(site.url('/t/1')))
+    site.pages['/t/1'] = '<meta name="description" content="Тема">' + ''.join(
+        '<meta itemprop="url" content="{}">'
+        '<meta itemprop="name" content="Статья {}">'
+        '<span class="item__category">16 мая, 16:{:02d}</span>'.format(
+            site.url(path), path, index)
+        for index, path in enumerate(articles))
+    for path, text in articles.items():
+        site.pages[path] = '<h1>Статья {}</h1><p>{}</p>'.format(path, text)
+
+
+def sync(path, url, fetcher, full=False):
+    """
+    Crawl into the database
+    return: dict url -> text of the documents stored
+    """
+    client = fetcher()
+    try:
+        with sqlite3.connect(path) as conn:
+            db.sync(conn, url, full, fetcher=client)
+            return dict(conn.execute('SELECT url, text FROM doc'))
+    finally:
+        client.close()
+
+
+def test_failed_article_refetched(site, fetcher, tmp_path):
+    rbc_site(site, {'/a/1': 'Первая статья.', '/a/2': 'Вторая статья.'})
+    site.scripts['/a/2'] = [(404, {}, b'Not Found')]
+    url = 'rbc=' + site.url('/story/')
+    path = str(tmp_path / 'test.db')
+    assert site.url('/a/2') not in sync(path, url, fetcher)
+    # The topic is unchanged but lists an article that failed
+    assert site.url('/a/2') in sync(path, url, fetcher)
+
+
+def test_changed_article_of_unchanged_topic(site, fetcher, tmp_path):
+    rbc_site(site, {'/a/1': 'Первая статья.', '/a/3': 'Третья статья.'})
+    url = 'rbc=' + site.url('/story/')
+    path = str(tmp_path / 'test.db')
+    sync(path, url, fetcher)
+    site.pages['/a/3'] = '<h1>Статья /a/3</h1><p>Исправлено.</p>'
+    start = len(site.requests)
+    docs = sync(path, url, fetcher)
+    assert 'Исправлено' in docs[site.url('/a/3')]
+    requests = {item[0]: item[1] for item in site.requests[start:]}
+    assert 'If-None-Match' in requests['/t/1']
+    assert 'If-None-Match' in requests['/a/1']
+
+
+def test_failing_source(site, fetcher, tmp_path):
+    rbc_site(site, {'/a/1': 'Первая статья.'})
+    urls = ['rbc=' + site.url('/story/'), 'interfax=' + site.url('/gone/')]
+    path = str(tmp_path / 'test.db')
+    assert list(sync(path, urls, fetcher)) == [site.url('/a/1')]
+    # A full load would drop the rows of the failed source
+    with pytest.raises(FetchError):
+        sync(path, urls, fetcher, full=True)
@@ -0,0 +1,58 @@
+"""
+Tests of the loads of db.py
+"""
+import sqlite3
+from datetime import datetime
+import db
+import notify
+import parse
+
+
+def doc(number, text='Текст новости.'):
+    return parse.Doc(
+        'https://example.org/{}'.format(number),
+        'Новость {}'.format(number), datetime(2024, 5, 16, 16, number),
+        text, '["p"]', parse.word_counts(text))
+
+
+def test_incremental_load_writes_after_the_crawl(tmp_path):
+    path = str(tmp_path / 'test.db')
+    with sqlite3.connect(path) as conn:
+        db.load(conn, [doc(1)], full=True)
+    subscribed = []
+
+    def crawl():
+        yield doc(2)
+        # Other writers are not locked out while the site is crawled
+        other = sqlite3.connect(path, timeout=0)
+        try:
+            subscribed.append(notify.subscribe(other, 1, 'https://t/1'))
+        finally:
+            other.close()
+        yield doc(3)
+
+    with sqlite3.connect(path) as conn:
+        db.load(conn, crawl(), batch_size=1)
+        count = conn.execute('SELECT COUNT(*) FROM doc').fetchone()[0]
+    assert subscribed == [True]
+    assert count == 3
+
+
+def test_batch_clusters_near_duplicates():
+    conn = sqlite3.connect(':memory:')
+    first = ' '.join('слово{}'.format(index) for index in range(60))
+    second = ' '.join('термин{}'.format(index) for index in range(60))
+    db.load(conn, [doc(1, first)], full=True)
+    # Copies of a stored document and of one earlier in the same batch
+    db.load(conn, [doc(2, first + ' конец'), doc(3, second),
+                   doc(4, second + ' конец')])
+    clusters = dict(conn.execute('''
+        SELECT d.url, c.canonical_id FROM doc d
+        JOIN doc_cluster c ON c.doc_id = d.id'''))
+    ids = dict(conn.execute('SELECT url, id FROM doc'))
+    url = 'https://example.org/{}'.format
+    assert clusters[url(2)] == ids[url(1)]
+    assert clusters[url(4)] == ids[url(3)] == clusters[url(3)]
+    assert clusters[url(1)] != clusters[url(3)]
+    words = dict(conn.execute('SELECT word, docs FROM word_df'))
+    assert words['слово1'] == 2 and words['термин1'] == 2
@@ -0,0 +1,135 @@
+"""
+Tests of crawler.Fetcher against a local HTTP server: conditional
+requests, retries, redirects, the per-host rate limit and the decoding
+of compressed or broken bodies
+"""
+import asyncio
+import gzip
+import zlib
+import pytest
+from crawler import FetchError
+
+
+def test_conditional(site, fetcher):
+    site.pages['/page'] = 'текст'
+
+    async def run():
+        async with fetcher() as client:
+            first = await client.fetch(site.url('/page'))
+            again = await client.fetch(
+                site.url('/page'), {'If-None-Match': first.headers['etag']})
+        return first, again
+
+    first, again = asyncio.run(run())
+    assert first.status == 200
+    assert first.body.decode('utf-8') == 'текст'
+    assert again.status == 304
+
+
+def test_retries(site, fetcher):
+    site.pages['/flaky'] = 'ok'
+    site.scripts['/flaky'] = [(503, {}, b''), (500, {}, b'')]
+
+    async def run():
+        async with fetcher(retries=3) as client:
+            return await client.fetch(site.url('/flaky'))
+
+    assert asyncio.run(run()).status == 200
+    assert site.requested('/flaky') == 3
+
+
+def test_retries_exhausted(site, fetcher):
+    site.scripts['/down'] = [(503, {}, b'')] * 3
+
+    async def run():
+        async with fetcher(retries=2) as client:
+            await client.fetch(site.url('/down'))
+
+    with pytest.raises(FetchError):
+        asyncio.run(run())
+    assert site.requested('/down') == 3
+
+
+def test_redirects(site, fetcher):
+    site.pages['/new'] = 'moved'
+    site.scripts['/old'] = [(301, {'Location': '/new'}, b'')]
+    site.scripts['/loop'] = [(302, {'Location': '/loop'}, b'')] * 10
+
+    async def run():
+        async with fetcher() as client:
+            response = await client.fetch(site.url('/old'))
+            with pytest.raises(FetchError):
+                await client.fetch(site.url('/loop'))
+        return response
+
+    response = asyncio.run(run())
+    assert response.status == 200
+    assert response.url == site.url('/new')
+
+
+def test_rate_limit(site, fetcher):
+    site.pages['/rated'] = 'ok'
+    rate = 20.0
+
+    async def run():
+        async with fetcher(per_host_rate=rate) as client:
+            await asyncio.gather(*(
+                client.fetch(site.url('/rated')) for _ in range(5)))
+
+    asyncio.run(run())
+    times = sorted(item[2] for item in site.requests)
+    # 5 requests are 4 intervals apart, with some slack for the clock
+    assert times[-1] - times[0] >= 4 / rate * 0.9
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'raw deflate'])
+def test_encodings(site, fetcher, encoding):
+    text = 'сжатая страница ' * 50
+    if encoding == 'gzip':
+        body = gzip.compress(text.encode('utf-8'))
+    elif encoding == 'deflate':
+        body = zlib.compress(text.encode('utf-8'))
+    else:
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        body = raw.compress(text.encode('utf-8')) + raw.flush()
+    site.scripts['/encoded'] = [
+        (200, {'Content-Encoding': encoding.split()[-1]}, body)]
+
+    async def run():
+        async with fetcher() as client:
+            return await client.fetch(site.url('/encoded'))
+
+    assert asyncio.run(run()).body.decode('utf-8') == text
+
+
+def test_broken_bodies(site, fetcher):
+    # A broken body fails its URL, not the crawl
+    site.pages['/fine'] = 'ok'
+    site.scripts['/broken'] = [
+        (200, {'Content-Encoding': 'deflate'}, b'not deflate')]
+    site.scripts['/badgzip'] = [
+        (200, {'Content-Encoding': 'gzip'}, b'not gzip')]
+    urls = [site.url('/broken'), site.url('/badgzip'), site.url('/fine')]
+
+    async def run():
+        results = {}
+        async with fetcher() as client:
+            async for url, response in client.fetch_many(urls):
+                results[url] = response
+        return results
+
+    results = asyncio.run(run())
+    assert isinstance(results[site.url('/broken')], FetchError)
+    assert isinstance(results[site.url('/badgzip')], FetchError)
+    assert results[site.url('/fine')].status == 200
+
+
+def test_undecodable_text(site, fetcher):
+    site.scripts['/latin'] = [(200, {}, b'\xff\xfe bad utf-8')]
+
+    async def run():
+        async with fetcher() as client:
+            await client.fetch_text(site.url('/latin'))
+
+    with pytest.raises(FetchError):
+        asyncio.run(run())
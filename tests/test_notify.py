@@ -0,0 +1,27 @@
+"""
+Tests of the subscriptions of notify.py
+"""
+import sqlite3
+import threading
+import db
+import notify
+
+
+def test_subscribe_waits_for_a_writer(tmp_path):
+    path = str(tmp_path / 'test.db')
+    with sqlite3.connect(path) as conn:
+        db.load(conn, [], full=True)
+    writer = sqlite3.connect(path, check_same_thread=False)
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute("INSERT INTO meta (key, value) VALUES ('refresh', 1)")
+    # The write transaction of a load commits while subscribe waits
+    timer = threading.Timer(0.3, writer.commit)
+    timer.start()
+    conn = notify.connect(path)
+    try:
+        assert notify.subscribe(conn, 1, 'https://example.org/t')
+        assert notify.unsubscribe(conn, 1) == 1
+    finally:
+        timer.join()
+        conn.close()
+        writer.close()
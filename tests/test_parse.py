@@ -0,0 +1,21 @@
+"""
+Tests of the page extraction of parse.py
+"""
+import parse
+
+
+def test_paragraphs():
+    page = parse.extract_page(
+        '<h1>Заголовок</h1><p>Первый <b>абзац</b>.</p>'
+        '<script>var p = "<p>";</script><p>Второй абзац.</p>')
+    assert page.headline == 'Заголовок'
+    assert page.text == ' Первый абзац. Второй абзац.'
+
+
+def test_unclosed_paragraphs():
+    # </p> is optional: a paragraph ends at the next one or its block
+    page = parse.extract_page(
+        '<div><p>Первый абзац.<p>Второй абзац.</p><p>Третий</div>'
+        '<p>Четвёртый</p><p>Пятый')
+    assert page.text == (' Первый абзац. Второй абзац. Третий Четвёртый'
+                         ' Пятый')
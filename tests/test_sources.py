@@ -0,0 +1,18 @@
+"""
+Tests of the source adapters of sources.py
+"""
+import sources
+
+
+def test_interfax_listing_skips_stories():
+    page = (
+        '<meta name="description" content="Тема">'
+        '<a href="/story/101">Другая тема</a>'
+        '<time datetime="2024-05-16T16:22:00+03:00"></time>'
+        '<a href="/russia/765432">Статья</a>'
+        '<a href="/story/202/">Ещё тема</a>')
+    description, urls, names, times = sources.Interfax().listing(
+        'https://www.interfax.ru/story/100', page)
+    assert urls == ['https://www.interfax.ru/russia/765432']
+    assert names == ['Статья']
+    assert times[0].hour == 16
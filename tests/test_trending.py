@@ -0,0 +1,30 @@
+"""
+Tests of the trends of trending.py
+"""
+import sqlite3
+from datetime import datetime, timedelta
+import db
+import parse
+import trending
+
+
+def test_recent_stories_are_trending():
+    conn = sqlite3.connect(':memory:')
+    now = datetime.now().replace(second=0, microsecond=0)
+    docs = []
+    for number in range(6):
+        # Distinct texts, near-duplicates count once
+        text = 'выборы ' + ' '.join(
+            'слово{}'.format(number * 20 + index) for index in range(20))
+        docs.append(parse.Doc(
+            'https://example.org/{}'.format(number),
+            'Новость {}'.format(number),
+            now - timedelta(minutes=20 * number), text, '["p"]',
+            parse.word_counts(text)))
+    topic = parse.Topic(
+        'Выборы', 'https://example.org/t', 'Тема', '\n'.join(
+            item.Heading for item in docs), now,
+        tuple(item.url for item in docs))
+    db.load(conn, docs + [topic], full=True)
+    assert trending.top_topics(conn, trending.HOUR, 6) == [('Выборы', 6, 0)]
+    assert ('выборы', 6, 0) in trending.top_terms(conn, trending.HOUR, 6)
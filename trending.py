@@ -0,0 +1,246 @@
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+import keywords
+
+
+logger = logging.getLogger(__name__)
+
+# Bucket widths in seconds, a bucket is time // width since the epoch
+HOUR = 3600
+DAY = 86400
+# Most frequent terms of a document counted in table trend_term
+TERMS_PER_DOC = 20
+# Buckets kept in trend_term before the newest one, windows can be up
+# to half as long since their growth is compared to the window before
+HOURS_KEPT = 72
+DAYS_KEPT = 90
+# Stories or documents a topic or term needs in a window to be ranked
+MIN_COUNT = 2
+# Window of /trending without argument, in hours
+DEFAULT_HOURS = 24
+WINDOW = re.compile(r'^(\d+)\s*([hdчд]?)$')
+
+
+def hour_of(value):
+    """
+    Hour bucket of a time
+    :param value: datetime or ISO string as stored in table doc
+    return: hours since the epoch, None if value is empty
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp() if value.tzinfo else
+               (value - datetime(1970, 1, 1)).total_seconds()) // HOUR
+
+
+def current_bucket(width):
+    """
+    Bucket of the current time, on the clock of the stored times: the
+    naive wall-clock time of the site, as parse.convert_to_time
+    """
+    return hour_of(datetime.now()) * HOUR // width
+
+
+def doc_terms(words):
+    """
+    Terms of a document counted in trend_term: its TERMS_PER_DOC most
+    frequent normalized terms
+    :param words: word frequencies, see parse.word_counts
+    return: list of terms
+    """
+    counts = defaultdict(int)
+    for word, count in words.items():
+        term = keywords.normalize(word)
+        if term is not None:
+            counts[term] += count
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return [term for term, _ in ranked[:TERMS_PER_DOC]]
+
+
+def count_docs(cur, docs, sign=1):
+    """
+    Add documents to the hour and day buckets of their terms in table
+    trend_term, or take them out with sign=-1, with one upsert per
+    bucket and term
+    :param cur: A Cursor instance
+    :param docs: iterable of (hour bucket, see hour_of, word
+                 frequencies) of the documents
+    """
+    counts = defaultdict(int)
+    for hour, words in docs:
+        if hour is None:
+            continue
+        for term in doc_terms(words):
+            for width in (HOUR, DAY):
+                counts[width, hour * HOUR // width, term] += sign
+    cur.executemany('''
+        INSERT INTO trend_term (width, bucket, word, docs)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (width, bucket, word) DO UPDATE SET
+            docs = docs + excluded.docs''',
+                    (key + (docs,) for key, docs in counts.items()))
+    if sign < 0:
+        cur.executemany('''
+            DELETE FROM trend_term
+            WHERE width = ? AND bucket = ? AND word = ? AND docs <= 0''',
+                        counts)
+
+
+def update_topics(cur, touched_only=True):
+    """
+    Recompute the stories per hour of topics in table trend_topic, a
+    cluster of near-duplicates counting once
+    :param cur: A Cursor instance
+    :param touched_only: only the topics in temp.touched_topic
+    """
+    scope = 'true'
+    if touched_only:
+        scope = '{} IN (SELECT topic_id FROM temp.touched_topic)'
+    cur.execute('DELETE FROM trend_topic WHERE {}'.format(
+        scope.format('topic_id')))
+    cur.execute('''
+        INSERT INTO trend_topic (hour, topic_id, docs)
+        SELECT CAST(strftime('%s', d.LastUpdateTime) AS INTEGER) / {},
+               td.topic_id, COUNT(DISTINCT c.canonical_id)
+        FROM topic_doc td
+        JOIN doc d ON d.url = td.doc_url
+        JOIN doc_cluster c ON c.doc_id = d.id
+        WHERE d.LastUpdateTime IS NOT NULL AND {}
+        GROUP BY 1, 2'''.format(HOUR, scope.format('td.topic_id')))
+
+
+def rebuild(cur):
+    """
+    Compute the trend tables from scratch, from the documents and
+    their token statistics
+    :param cur: A Cursor instance
+    """
+    cur.execute('DELETE FROM trend_term')
+    cur.execute('SELECT id, LastUpdateTime FROM doc')
+    hours = {doc_id: hour_of(updated) for doc_id, updated in cur.fetchall()}
+    cur.executemany('UPDATE doc_stats SET hour = ? WHERE doc_id = ?',
+                    ((hour, doc_id) for doc_id, hour in hours.items()))
+    cur.execute('SELECT doc_id, word, count FROM doc_word ORDER BY doc_id')
+    count_docs(cur, (
+        (hours.get(doc_id), {row[1]: row[2] for row in rows})
+        for doc_id, rows in groupby(cur, key=itemgetter(0))))
+    update_topics(cur, touched_only=False)
+    prune(cur)
+
+
+def prune(cur):
+    """
+    Drop the term buckets older than HOURS_KEPT hours or DAYS_KEPT
+    days before the newest one that is not in the future: a document
+    dated ahead does not drop the others
+    :param cur: A Cursor instance
+    """
+    for width, kept in ((HOUR, HOURS_KEPT), (DAY, DAYS_KEPT)):
+        cur.execute('''
+            DELETE FROM trend_term
+            WHERE width = :width AND bucket <= (
+                SELECT MAX(bucket) FROM trend_term
+                WHERE width = :width AND bucket <= :now) - :kept''',
+                    {'width': width, 'now': current_bucket(width),
+                     'kept': kept})
+
+
+def parse_window(text=None):
+    """
+    Window of /trending
+    :param text: e.g. 6h, 2d (or 6ч, 2д), a number of hours, None for
+                 DEFAULT_HOURS
+    return: (width of the buckets, number of buckets), raises
+            ValueError if the window is too long for the kept buckets
+    """
+    if text is None:
+        return HOUR, DEFAULT_HOURS
+    match = WINDOW.match(text.strip().lower())
+    if match is None:
+        raise ValueError(text)
+    number, unit = int(match.group(1)), match.group(2)
+    width, kept = (DAY, DAYS_KEPT) if unit in ('d', 'д') else (HOUR,
+                                                               HOURS_KEPT)
+    if not 0 < number <= kept // 2:
+        raise ValueError(text)
+    return width, number
+
+
+def growth(current, previous):
+    """Growth rate of a count, smoothed so that new items rank finite"""
+    return (current + 1) / (previous + 1)
+
+
+def top_topics(conn, width, number, limit=10):
+    """
+    Topics with the fastest growing number of stories: stories of the
+    last window against the window before, ending at the newest hour
+    that is not in the future
+    :param conn: A SQLite database connection
+    :param width: HOUR or DAY, see parse_window
+    :param number: number of buckets of the window
+    :param limit: number of topics
+    return: list of (name, stories in the window, stories in the
+            previous window)
+    """
+    hours = number * width // HOUR
+    cur = conn.cursor()
+    cur.execute('SELECT MAX(hour) FROM trend_topic WHERE hour <= ?',
+                (current_bucket(HOUR),))
+    newest = cur.fetchone()[0]
+    if newest is None:
+        return []
+    cur.execute('''
+        SELECT t.name, s.current, s.previous
+        FROM (SELECT topic_id,
+                     SUM(CASE WHEN hour > :start THEN docs ELSE 0 END)
+                         AS current,
+                     SUM(CASE WHEN hour <= :start THEN docs ELSE 0 END)
+                         AS previous
+              FROM trend_topic
+              WHERE hour > :start - :hours AND hour <= :start + :hours
+              GROUP BY topic_id) s
+        JOIN topic t ON t.id = s.topic_id
+        WHERE s.current >= :min
+        ORDER BY (s.current + 1.0) / (s.previous + 1) DESC,
+                 s.current DESC, t.name
+        LIMIT :limit''', {'start': newest - hours, 'hours': hours,
+                          'min': MIN_COUNT, 'limit': limit})
+    return cur.fetchall()
+
+
+def top_terms(conn, width, number, limit=10):
+    """
+    Terms with the fastest growing number of documents, see top_topics
+    return: list of (term, documents in the window, documents in the
+            previous window)
+    """
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT MAX(bucket) FROM trend_term WHERE width = ? AND bucket <= ?''',
+                (width, current_bucket(width)))
+    newest = cur.fetchone()[0]
+    if newest is None:
+        return []
+    cur.execute('''
+        SELECT word,
+               SUM(CASE WHEN bucket > :start THEN docs ELSE 0 END)
+                   AS current,
+               SUM(CASE WHEN bucket <= :start THEN docs ELSE 0 END)
+                   AS previous
+        FROM trend_term
+        WHERE width = :width AND bucket > :start - :number
+              AND bucket <= :start + :number
+        GROUP BY word
+        HAVING current >= :min
+        ORDER BY (current + 1.0) / (previous + 1) DESC, current DESC, word
+        LIMIT :limit''', {'width': width, 'start': newest - number,
+                          'number': number, 'min': MIN_COUNT,
+                          'limit': limit})
+    return cur.fetchall()
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+from telegram import Bot, Update
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Path the Bot API posts updates to
+PATH = '/webhook'
+# Largest update accepted, in bytes
+MAX_BODY = 1 << 20
+STATUS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden',
+          404: 'Not Found', 413: 'Payload Too Large'}
+
+
+def respond(writer, status, keep_alive=True, body=b'',
+            content_type=None):
+    """Write an HTTP response, with an empty body by default"""
+    writer.write(
+        'HTTP/1.1 {} {}\r\nContent-Length: {}\r\n{}Connection: {}\r\n\r\n'
+        .format(status, STATUS[status], len(body),
+                'Content-Type: {}\r\n'.format(content_type)
+                if content_type else '',
+                'keep-alive' if keep_alive else 'close').encode('ascii')
+        + body)
+
+
+async def handle(application, secret, reader, writer):
+    """
+    Serve one HTTP/1.1 connection of the Bot API: every POST to PATH
+    carries one update, put on the update queue of the application and
+    acknowledged at once. Handlers answer through the Bot API as in
+    polling mode. GET metrics.PATH returns the metrics of the worker
+    process serving the connection.
+    :param application: telegram.ext.Application, started
+    :param secret: expected X-Telegram-Bot-Api-Secret-Token, None to
+                   accept any request
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            if length > MAX_BODY:
+                respond(writer, 413, keep_alive=False)
+                break
+            body = await reader.readexactly(length)
+
+            if method == 'GET' and path.split('?', 1)[0] == metrics.PATH:
+                respond(writer, 200, keep_alive,
+                        metrics.REGISTRY.render().encode('utf-8'),
+                        metrics.CONTENT_TYPE)
+                await writer.drain()
+                if not keep_alive:
+                    break
+                continue
+            if method != 'POST' or path.split('?', 1)[0] != PATH:
+                status = 404
+            elif secret is not None and headers.get(
+                    'x-telegram-bot-api-secret-token') != secret:
+                status = 403
+            else:
+                try:
+                    update = Update.de_json(
+                        json.loads(body), application.bot)
+                except (ValueError, KeyError, TypeError):
+                    status = 400
+                else:
+                    await application.update_queue.put(update)
+                    status = 200
+            respond(writer, status, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(application, sock, secret):
+    """
+    Process updates posted to the listening socket until SIGINT or
+    SIGTERM
+    :param application: telegram.ext.Application, not initialized
+    :param sock: listening socket, shared by the worker processes
+    :param secret: see handle
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    async with application:
+        # Called by run_polling, which is not used here
+        if application.post_init is not None:
+            await application.post_init(application)
+        await application.start()
+        server = await asyncio.start_server(
+            lambda reader, writer: handle(
+                application, secret, reader, writer),
+            sock=sock)
+        async with server:
+            await stop.wait()
+        await application.stop()
+        if application.post_stop is not None:
+            await application.post_stop(application)
+
+
+def register(token, url, secret=None):
+    """
+    Ask the Bot API to post the updates of the bot to url, which must
+    reach PATH of the server started by run
+    :param token: token of the bot
+    :param url: public HTTPS URL of the webhook
+    :param secret: see handle
+    """
+    async def set_webhook():
+        async with Bot(token) as bot:
+            await bot.set_webhook(url, secret_token=secret)
+
+    asyncio.run(set_webhook())
+
+
+def worker(build, sock, secret):
+    """
+    Entry point of a worker process
+    :param build: function returning a new telegram.ext.Application
+    """
+    asyncio.run(serve(build(), sock, secret))
+
+
+def run(build, listen='127.0.0.1', port=8443, workers=1, secret=None,
+        on_start=None):
+    """
+    Serve the webhook with several worker processes accepting from one
+    listening socket, each with its own event loop, application,
+    connections and caches. Blocks until the workers exit; SIGINT and
+    SIGTERM stop them.
+    :param build: function returning a new telegram.ext.Application,
+                  called in every worker
+    :param listen: address to listen on
+    :param port: port to listen on
+    :param workers: number of worker processes
+    :param secret: see handle
+    :param on_start: function called once the workers are started, in
+                     the parent process
+    """
+    sock = socket.create_server((listen, port), backlog=1024)
+    sock.setblocking(False)
+    logger.info('Webhook on http://%s:%d%s, %d workers',
+                listen, port, PATH, workers)
+    if workers == 1:
+        if on_start is not None:
+            on_start()
+        worker(build, sock, secret)
+        return
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=worker, args=(build, sock, secret))
+        for _ in range(workers)]
+    for process in processes:
+        process.start()
+    sock.close()
+    if on_start is not None:
+        on_start()
+
+    def terminate(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers got the SIGINT too
+        for process in processes:
+            process.join()